@@ -0,0 +1,109 @@
+import base64
+import binascii
+from collections import namedtuple
+
+from django.conf import settings
+
+
+# Keyset (cursor) pagination on the primary key.
+#
+# A page is fetched with "WHERE id > <last id of the previous page> ORDER BY id LIMIT n + 1", so
+# deep pages cost the same as the first one (no OFFSET scan) and rows inserted or deleted
+# between two requests never make a page skip or repeat items.
+#
+# Cursors are opaque strings passed back by the client as ?cursor=<next or previous>.
+# The page size can be chosen with ?page_size=<n>, up to PAGINATION_MAX_PAGE_SIZE.
+
+Page = namedtuple('Page', ['results', 'next', 'previous', 'pageSize'])
+
+NEXT = 'n'
+PREVIOUS = 'p'
+
+
+class InvalidPage(Exception):
+    pass
+
+
+def _default_page_size():
+    return getattr(settings, 'PAGINATION_DEFAULT_PAGE_SIZE', 20)
+
+
+def _max_page_size():
+    return getattr(settings, 'PAGINATION_MAX_PAGE_SIZE', 100)
+
+
+def encode_cursor(direction, boundary):
+    raw = f'{direction}:{boundary}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return NEXT, None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        direction, boundary = raw.split(':')
+        boundary = int(boundary)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidPage('Invalid cursor')
+    if direction not in (NEXT, PREVIOUS):
+        raise InvalidPage('Invalid cursor')
+    return direction, boundary
+
+
+# Pagination is opt-in, so that existing clients asking for the whole list keep working
+def is_paginated(request):
+    return 'cursor' in request.query_params or 'page_size' in request.query_params
+
+
+# Returns the (cursor, page size) requested, validated. Useful as part of a cache key
+def get_page_params(request):
+    cursor = request.query_params.get('cursor') or None
+    decode_cursor(cursor)
+
+    pageSize = request.query_params.get('page_size')
+    if pageSize is None:
+        return cursor, _default_page_size()
+    try:
+        pageSize = int(pageSize)
+    except ValueError:
+        raise InvalidPage('Invalid page size')
+    return cursor, max(1, min(pageSize, _max_page_size()))
+
+
+# To get a page of the queryset. descending=True pages from the newest (highest id) row
+def paginate(queryset, cursor=None, pageSize=None, descending=False):
+    pageSize = pageSize or _default_page_size()
+    direction, boundary = decode_cursor(cursor)
+
+    forwardOrder, backwardOrder = ('-id', 'id') if descending else ('id', '-id')
+    afterLookup, beforeLookup = ('id__lt', 'id__gt') if descending else ('id__gt', 'id__lt')
+
+    if direction == PREVIOUS:
+        # Walk backwards from the boundary, then flip the rows back into page order
+        rows = list(queryset.filter(**{beforeLookup: boundary}).order_by(backwardOrder)[:pageSize + 1])
+        hasMore = len(rows) > pageSize
+        rows = rows[:pageSize]
+        rows.reverse()
+        previous = encode_cursor(PREVIOUS, rows[0].id) if hasMore else None
+        next = encode_cursor(NEXT, rows[-1].id) if rows else None
+    else:
+        if boundary is not None:
+            queryset = queryset.filter(**{afterLookup: boundary})
+        rows = list(queryset.order_by(forwardOrder)[:pageSize + 1])
+        hasMore = len(rows) > pageSize
+        rows = rows[:pageSize]
+        next = encode_cursor(NEXT, rows[-1].id) if hasMore else None
+        previous = encode_cursor(PREVIOUS, rows[0].id) if boundary is not None and rows else None
+
+    return Page(rows, next, previous, pageSize)
+
+
+# Response body for a page, once its rows are serialized
+def page_data(page, results):
+    return {
+        'results': results,
+        'next': page.next,
+        'previous': page.previous,
+        'pageSize': page.pageSize,
+    }
@@ -1,15 +1,27 @@
-from rest_framework.serializers import ModelSerializer
+from rest_framework.serializers import ModelSerializer, SerializerMethodField
 from Categories.models import FoodItem, Category
+from Categories import images
 
 
 # Creates JSON objects out of the Python objects
 class FoodItemSerializer(ModelSerializer):
+    # Resized copies of the image, per format. See Categories/images.py
+    srcset = SerializerMethodField()
+
     class Meta:
         model = FoodItem
-        fields = '__all__'
+        exclude = ['imageVariants']
+
+    def get_srcset(self, foodItem):
+        return images.srcset(foodItem.image, foodItem.imageVariants)
 
 
 class CategorySerializer(ModelSerializer):
+    srcset = SerializerMethodField()
+
     class Meta:
         model = Category
-        fields = '__all__'
+        exclude = ['imageVariants']
+
+    def get_srcset(self, category):
+        return images.srcset(category.image, category.imageVariants)
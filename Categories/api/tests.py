@@ -1,3 +1,730 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import time
+from io import BytesIO
+from unittest import mock, skipIf, skipUnless
 
-# Create your tests here.
+import brotli
+import stripe
+from django.conf import settings
+from django.contrib.auth.models import Group, User
+from django.core.cache import caches
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import Client, TestCase, override_settings
+from PIL import Image
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from Categories import cache as catalogCache
+from Categories import images
+from Categories import menu_export
+from Categories import search
+from Categories.api import pagination
+from Categories.api.serializers import FoodItemSerializer
+from Categories.models import Category, FoodItem, Stripe
+from FromOurKitchen.models import ActiveOrders, Address, Cart, MobileNumber, Notification, OrderLine
+from crud.querybudget import QueryBudgetMixin
+
+MEDIA_ROOT = tempfile.mkdtemp()
+
+
+def image_upload(name='food.png'):
+    buffer = BytesIO()
+    Image.new('RGB', (8, 8), 'orange').save(buffer, 'PNG')
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+
+# Query budgets of the partner API routes (Categories/api/urls.py).
+# Every route is requested with 1 and with 100 rows (categories, food items of the logged in
+# category and orders), and has to stay within the same fixed budget: a query run per row (N+1)
+# fails the test. Requests are authenticated with a JWT, which costs 1 query (the user), except on the
+# read-only routes authenticated with its claims alone (see crud/tokens.py).
+@override_settings(
+    MEDIA_ROOT=MEDIA_ROOT,
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+    MENU_EXPORT_ON_CHANGE=False,
+)
+class QueryBudgetTests(QueryBudgetMixin, TestCase):
+    ROWS = (1, 100)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+
+    def setUp(self):
+        Group.objects.create(name='Category')
+        self.partner = User.objects.create_user('partner@example.com', 'partner@example.com', 'password')
+        self.category = Category.objects.create(user=self.partner, name='Pizza', image='images/pizza.jpg')
+        self.customer = User.objects.create_user('customer', 'customer@example.com', 'password')
+        MobileNumber.objects.create(user=self.customer, number=9876543210)
+        self.address = Address.objects.create(user=self.customer, area='Jammu', label='HOME')
+        self.token = str(RefreshToken.for_user(self.partner).access_token)
+
+    # To top up the rows of every kind to n
+    def populate(self, n):
+        other = User.objects.get_or_create(username='other@example.com')[0]
+        Category.objects.bulk_create([
+            Category(user=other, name=f'Category {number}', image='images/category.jpg')
+            for number in range(Category.objects.count(), n)
+        ])
+        FoodItem.objects.bulk_create([
+            FoodItem(category=self.category, name=f'Paneer {number}', description='Paneer pizza', price='120.50', image='images/food.jpg')
+            for number in range(FoodItem.objects.count(), n)
+        ])
+        foodItems = list(FoodItem.objects.order_by('id')[:3])
+        cart = Cart.objects.bulk_create([
+            Cart(user=self.customer, food=food, qty=1, pricePaise=12050, amountPaise=12050)
+            for food in foodItems if not Cart.objects.filter(user=self.customer, food=food).exists()
+        ]) or list(Cart.objects.filter(user=self.customer).select_related('food'))
+        for number in range(ActiveOrders.objects.count(), n):
+            order = ActiveOrders.objects.create(user=self.customer, address=self.address, category=self.category, totalPaise=12050 * len(cart))
+            OrderLine.objects.bulk_create([OrderLine.from_cart(order, item) for item in cart])
+
+        caches[settings.CATALOG_CACHE_ALIAS].clear()
+
+    def auth(self):
+        return {'HTTP_AUTHORIZATION': f'Bearer {self.token}'}
+
+    # Requests the route with 1 and then 100 rows, within the budget each time.
+    # What prepare() returns (outside of the budget) is passed to request()
+    def assertRouteBudget(self, budget, request, status=200, prepare=None):
+        for n in self.ROWS:
+            with self.subTest(rows=n):
+                self.populate(n)
+                args = [prepare()] if prepare else []
+                with self.assertQueryBudget(budget):
+                    response = request(*args)
+                self.assertEqual(response.status_code, status, getattr(response, 'data', response))
+
+    def test_routes(self):
+        self.assertRouteBudget(0, lambda: self.client.get('/partner-with-us/'))
+
+    def test_register(self):
+        count = iter(range(1000))
+        def register():
+            number = next(count)
+            return self.client.post('/partner-with-us/register/', {
+                'email': f'partner{number}@example.com', 'name': 'Dosa', 'address': 'Jammu', 'image': image_upload(),
+                'password': 'password', 'confirmPassword': 'password',
+            })
+        # Adding the user to the Category group reads its groups first (for the token role cache, see crud/tokens.py)
+        self.assertRouteBudget(8, register)
+
+    def test_token(self):
+        def token():
+            return self.client.post('/partner-with-us/api/token/', {'username': 'partner@example.com', 'password': 'password'})
+        self.assertRouteBudget(3, token)
+
+    def test_token_refresh(self):
+        def refresh(token):
+            return self.client.post('/partner-with-us/api/token/refresh/', {'refresh': token})
+        # The rotated token is checked by the revocation filter (see the customer API's test_token_refresh)
+        self.assertRouteBudget(6, refresh, prepare=lambda: str(RefreshToken.for_user(self.partner)))
+
+    def test_add_food_item(self):
+        def addFoodItem():
+            return self.client.post('/partner-with-us/add-food-item/', {
+                'name': 'Paneer Pizza', 'description': 'Paneer pizza', 'price': '120.50', 'image': image_upload(),
+            }, **self.auth())
+        self.assertRouteBudget(3, addFoodItem)
+
+    def test_manage_food_items(self):
+        self.assertRouteBudget(2, lambda: self.client.get('/partner-with-us/manage-food-items/', **self.auth()))
+        self.assertRouteBudget(2, lambda: self.client.get('/partner-with-us/manage-food-items/?page_size=100', **self.auth()))
+
+    def test_edit_food_items(self):
+        def editFoodItems(foodId):
+            return self.client.get(f'/partner-with-us/manage-food-items/{foodId}', **self.auth())
+        self.assertRouteBudget(3, editFoodItems, prepare=lambda: FoodItem.objects.last().id)
+
+    def test_update_food_item(self):
+        def updateFoodItem(foodId):
+            return self.client.post(f'/partner-with-us/manage-food-items/{foodId}/update', {
+                'name': 'Paneer Pizza', 'description': 'Paneer pizza', 'price': '150.00', 'image': 'undefined',
+            }, **self.auth())
+        self.assertRouteBudget(3, updateFoodItem, prepare=lambda: FoodItem.objects.last().id)
+
+    def test_delete_food_item(self):
+        def deleteFoodItem(foodId):
+            return self.client.delete(f'/partner-with-us/manage-food-items/{foodId}/delete', **self.auth())
+        self.assertRouteBudget(8, deleteFoodItem, prepare=lambda: FoodItem.objects.last().id)
+
+    def test_get_orders(self):
+        self.assertRouteBudget(3, lambda: self.client.get('/partner-with-us/get-orders/', **self.auth()))
+        self.assertEqual(len(self.client.get('/partner-with-us/get-orders/', **self.auth()).data), 100)
+
+    def test_order_board(self):
+        # The category, the ids of the new and changed orders, then the orders with their address and lines
+        self.assertRouteBudget(4, lambda: self.client.get('/partner-with-us/order-board/', **self.auth()))
+        board = self.client.get('/partner-with-us/order-board/', **self.auth()).data
+        self.assertEqual(len(board['results']), 100)
+
+        def poll(order):
+            return self.client.get('/partner-with-us/order-board/', {'since': board['since'], 'updated_after': board['updatedAfter']}, **self.auth())
+        self.assertRouteBudget(4, poll, prepare=lambda: ActiveOrders.objects.first().save())
+        # The changed order only, the later ones are already on the board
+        with override_settings(ORDER_BOARD_OVERLAP=0):
+            self.assertEqual([order['id'] for order in poll(None).data['results']], [ActiveOrders.objects.first().id])
+
+    def test_order_board_params(self):
+        response = self.client.get('/partner-with-us/order-board/?updated_after=yesterday', **self.auth())
+        self.assertEqual(response.status_code, 400)
+
+    def test_update_order_status(self):
+        def updateOrderStatus(orderId):
+            return self.client.post(f'/partner-with-us/update-order-status/{orderId}', **self.auth())
+        # The SMS is enqueued in a savepoint with the order (the mobile number and the outbox)
+        self.assertRouteBudget(9, updateOrderStatus, prepare=lambda: ActiveOrders.objects.last().id)
+
+    def test_update_orders_status(self):
+        # The category, then in a savepoint the update and the SMS enqueued, whatever the number of orders
+        def updateOrdersStatus(orderIds):
+            return self.client.post('/partner-with-us/update-order-status/', {'orders': orderIds}, content_type='application/json', **self.auth())
+        self.assertRouteBudget(7, updateOrdersStatus, prepare=lambda: list(ActiveOrders.objects.filter(active=True).values_list('id', flat=True)))
+
+    def test_update_orders_status_outcomes(self):
+        self.populate(3)
+        first, second, third = ActiveOrders.objects.order_by('id').values_list('id', flat=True)
+        ActiveOrders.objects.filter(id=second).update(active=False)
+        otherCategory = Category.objects.exclude(id=self.category.id).first()
+        ActiveOrders.objects.filter(id=third).update(category=otherCategory)
+
+        response = self.client.post(
+            '/partner-with-us/update-order-status/', {'orders': [first, second, third, first, 0]},
+            content_type='application/json', **self.auth(),
+        )
+        self.assertEqual(response.data['results'], [
+            {'id': first, 'outcome': 'delivered'},
+            {'id': second, 'outcome': 'already_delivered'},
+            {'id': third, 'outcome': 'not_found'},
+            {'id': 0, 'outcome': 'not_found'},
+        ])
+        self.assertFalse(ActiveOrders.objects.get(id=first).active)
+        self.assertTrue(ActiveOrders.objects.get(id=third).active)
+        # The customer of the delivered order only is texted
+        self.assertEqual(list(Notification.objects.values_list('key', 'to')), [(f'order.delivered:{first}', '+9876543210')])
+
+        for orderIds in (None, [], ['twelve'], list(range(101))):
+            response = self.client.post('/partner-with-us/update-order-status/', {'orders': orderIds}, content_type='application/json', **self.auth())
+            self.assertEqual(response.status_code, 400)
+
+    @mock.patch.object(stripe.AccountLink, 'create_async')
+    @mock.patch.object(stripe.Account, 'create_async')
+    def test_create_stripe_account(self, createAccount, createLink):
+        createAccount.return_value.id = 'acct_test'
+        createLink.return_value.url = 'https://connect.stripe.com/setup/test'
+        def createStripeAccount(deleted):
+            return self.client.post('/partner-with-us/create-stripe-account/', **self.auth())
+        self.assertRouteBudget(4, createStripeAccount, prepare=lambda: Stripe.objects.filter(category=self.category).delete())
+
+    @mock.patch.object(stripe.AccountLink, 'create_async')
+    def test_complete_stripe_account(self, createLink):
+        createLink.return_value.url = 'https://connect.stripe.com/setup/test'
+        Stripe.objects.create(category=self.category, accountID='acct_test')
+        # The user, and the Stripe account of their category (joined)
+        self.assertRouteBudget(2, lambda: self.client.post('/partner-with-us/complete-stripe-account/', **self.auth()))
+
+    @mock.patch.object(stripe.Account, 'retrieve_async')
+    def test_stripe_get_details(self, retrieve):
+        retrieve.return_value.details_submitted = True
+        retrieve.return_value.charges_enabled = True
+        Stripe.objects.create(category=self.category, accountID='acct_test')
+        self.assertRouteBudget(2, lambda: self.client.get('/partner-with-us/create-stripe-account/get-details/', **self.auth()), status=231)
+
+    @mock.patch.object(stripe.AccountLink, 'create_async')
+    def test_stripe_refresh_url(self, createLink):
+        createLink.return_value.url = 'https://connect.stripe.com/setup/test'
+        Stripe.objects.create(category=self.category, accountID='acct_test')
+        self.assertRouteBudget(2, lambda: self.client.get('/partner-with-us/create-stripe-account/refresh-url/', **self.auth()))
+
+    @mock.patch.object(stripe.Account, 'retrieve_async')
+    def test_stripe_return_url(self, retrieve):
+        retrieve.return_value.details_submitted = True
+        retrieve.return_value.charges_enabled = True
+        Stripe.objects.create(category=self.category, accountID='acct_test')
+        self.assertRouteBudget(2, lambda: self.client.get('/partner-with-us/create-stripe-account/return-url/', **self.auth()))
+
+
+# The async Stripe views (see crud/asyncviews.py)
+@override_settings(PAYMENTS_GATEWAY='crud.gateways.FakePaymentsGateway')
+class StripeAccountTests(TestCase):
+    def setUp(self):
+        self.partner = User.objects.create_user('partner@example.com', 'partner@example.com', 'password')
+        self.category = Category.objects.create(user=self.partner, name='Pizza', image='images/pizza.jpg')
+        self.headers = {'Authorization': f'Bearer {RefreshToken.for_user(self.partner).access_token}'}
+
+    def test_create_stripe_account(self):
+        response = self.client.post('/partner-with-us/create-stripe-account/', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        accountId = Stripe.objects.get(category=self.category).accountID
+        self.assertEqual(response.json(), [f'https://connect.stripe.com/setup/fake/{accountId}'])
+        self.assertEqual(self.client.post('/partner-with-us/create-stripe-account/', headers=self.headers).status_code, 412)
+        self.assertEqual(self.client.get('/partner-with-us/create-stripe-account/get-details/', headers=self.headers).status_code, 231)
+
+    def test_authentication(self):
+        self.assertEqual(self.client.post('/partner-with-us/create-stripe-account/').status_code, 401)
+        response = self.client.post('/partner-with-us/create-stripe-account/', HTTP_AUTHORIZATION='Bearer invalid')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(self.client.get('/partner-with-us/create-stripe-account/', headers=self.headers).status_code, 405)
+        # Authenticated by the header, no CSRF token needed (as with the DRF views)
+        client = Client(enforce_csrf_checks=True)
+        self.assertEqual(client.post('/partner-with-us/complete-stripe-account/', headers=self.headers).status_code, 412)
+        self.assertFalse(Stripe.objects.exists())
+
+    # The requests wait on Stripe at the same time, in the event loop. Their queries all run on the
+    # connection of the test, and are recorded by each of them
+    @override_settings(GATEWAY_FAKE_LATENCY=0.2, QUERY_BUDGET_WARNING=1000)
+    async def test_concurrent_requests(self):
+        await Stripe.objects.acreate(category=self.category, accountID='acct_test')
+        start = time.monotonic()
+        responses = await asyncio.gather(*[
+            self.async_client.get('/partner-with-us/create-stripe-account/get-details/', headers=self.headers)
+            for request in range(20)
+        ])
+        self.assertEqual({response.status_code for response in responses}, {231})
+        self.assertLess(time.monotonic() - start, 20 * 0.2 / 2)
+
+
+# The catalog cache (Categories/cache.py): saving or deleting a row bumps the version of the keys it
+# belongs to (see Categories/signals.py), once the transaction commits
+@override_settings(MENU_EXPORT_ON_CHANGE=False)
+class CatalogCacheTests(TestCase):
+    def setUp(self):
+        caches[settings.CATALOG_CACHE_ALIAS].clear()
+        partner = User.objects.create_user('partner@example.com', 'partner@example.com', 'password')
+        self.category = Category.objects.create(user=partner, name='Pizza', image='images/pizza.jpg')
+        self.other = Category.objects.create(user=partner, name='Dosa', image='images/dosa.jpg')
+        self.food = FoodItem.objects.create(category=self.category, name='Paneer', description='Paneer pizza', price='120.50', image='images/food.jpg')
+
+    # The version of a category's keys, or of the category list's
+    def version(self, category=None):
+        key = catalogCache._category_version_key(category.id) if category else catalogCache.CATEGORY_LIST_VERSION_KEY
+        return caches[settings.CATALOG_CACHE_ALIAS].get(key)
+
+    def menu(self, category):
+        return [food['name'] for food in self.client.get(f'/api/category/{category.id}').data]
+
+    def categories(self):
+        return [category['name'] for category in self.client.get('/api/category/').data]
+
+    def test_food_item_saved(self):
+        self.assertEqual(self.menu(self.category), ['Paneer'])
+        self.assertEqual(self.menu(self.other), [])
+        version, otherVersion = self.version(self.category), self.version(self.other)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.menu(self.category), ['Paneer'])
+
+        # Not before the transaction commits
+        with self.captureOnCommitCallbacks(execute=True):
+            self.food.name = 'Paneer Tikka'
+            self.food.save()
+            self.assertEqual(self.version(self.category), version)
+        self.assertEqual(self.version(self.category), version + 1)
+        self.assertEqual(self.menu(self.category), ['Paneer Tikka'])
+        # The other categories are still served from the cache
+        self.assertEqual(self.version(self.other), otherVersion)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.menu(self.other), [])
+
+    def test_food_item_moved(self):
+        self.menu(self.category), self.menu(self.other)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.food.category = self.other
+            self.food.save()
+        # Both menus
+        self.assertEqual((self.menu(self.category), self.menu(self.other)), ([], ['Paneer']))
+
+    def test_food_item_deleted(self):
+        self.menu(self.category)
+        version = self.version(self.category)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.food.delete()
+        self.assertEqual(self.version(self.category), version + 1)
+        self.assertEqual(self.menu(self.category), [])
+
+    def test_category_saved(self):
+        self.assertEqual(self.categories(), ['Pizza', 'Dosa'])
+        self.client.get(f'/api/category/info/{self.category.id}')
+        version, categoryVersion = self.version(), self.version(self.category)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.category.name = 'Pizza Hut'
+            self.category.save()
+        self.assertEqual((self.version(), self.version(self.category)), (version + 1, categoryVersion + 1))
+        self.assertEqual(self.categories(), ['Pizza Hut', 'Dosa'])
+        self.assertEqual(self.client.get(f'/api/category/info/{self.category.id}').data[0]['name'], 'Pizza Hut')
+
+    def test_category_deleted(self):
+        self.categories()
+        otherId = self.other.id
+        self.client.get(f'/api/category/info/{otherId}')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.other.delete()
+        self.assertEqual(self.categories(), ['Pizza'])
+        self.assertEqual(self.client.get(f'/api/category/info/{otherId}').data, [])
+
+    def test_evicted_version(self):
+        self.menu(self.category)
+        version = self.version(self.category)
+        # A new version doesn't point back to an entry cached under an earlier one
+        caches[settings.CATALOG_CACHE_ALIAS].delete(catalogCache._category_version_key(self.category.id))
+        FoodItem.objects.filter(id=self.food.id).update(name='Paneer Tikka')
+        time.sleep(0.002)
+        self.assertEqual(self.menu(self.category), ['Paneer Tikka'])
+        self.assertGreater(self.version(self.category), version)
+
+
+# Keyset pagination (Categories/api/pagination.py)
+@override_settings(MENU_EXPORT_ON_CHANGE=False, PAGINATION_MAX_PAGE_SIZE=5)
+class PaginationTests(TestCase):
+    def setUp(self):
+        caches[settings.CATALOG_CACHE_ALIAS].clear()
+        partner = User.objects.create_user('partner@example.com', 'partner@example.com', 'password')
+        self.category = Category.objects.create(user=partner, name='Pizza', image='images/pizza.jpg')
+        # The same name and price: the food items are only told apart by their id
+        FoodItem.objects.bulk_create([
+            FoodItem(category=self.category, name='Paneer', description='Paneer pizza', price='120.50', image='images/food.jpg')
+            for number in range(7)
+        ])
+        self.ids = list(FoodItem.objects.order_by('id').values_list('id', flat=True))
+
+    def page(self, **params):
+        return self.client.get(f'/api/category/{self.category.id}', params)
+
+    # The ids of a page, served or from paginate()
+    def ids_of(self, page):
+        if isinstance(page, pagination.Page):
+            return [row.id for row in page.results]
+        return [row['id'] for row in page['results']]
+
+    def test_pages(self):
+        pages = [self.page(page_size=3).data]
+        while pages[-1]['next']:
+            pages.append(self.page(page_size=3, cursor=pages[-1]['next']).data)
+        self.assertEqual([self.ids_of(page) for page in pages], [self.ids[:3], self.ids[3:6], self.ids[6:]])
+        self.assertIsNone(pages[0]['previous'])
+
+        # And back
+        self.assertEqual(self.page(page_size=3, cursor=pages[2]['previous']).data, pages[1])
+        previous = self.page(page_size=3, cursor=pages[1]['previous']).data
+        self.assertEqual(self.ids_of(previous), self.ids[:3])
+        self.assertIsNone(previous['previous'])
+
+    def test_rows_changed_between_pages(self):
+        queryset = FoodItem.objects.all()
+        first = pagination.paginate(queryset, None, 3)
+        # The first row and the next one deleted, a row added at the end
+        FoodItem.objects.filter(id__in=[self.ids[0], self.ids[3]]).delete()
+        added = FoodItem.objects.create(category=self.category, name='Paneer', description='Paneer pizza', price='120.50', image='images/food.jpg')
+
+        second = pagination.paginate(queryset, first.next, 3)
+        # Neither skipped nor repeated
+        self.assertEqual(self.ids_of(second), self.ids[4:7])
+        self.assertEqual(self.ids_of(pagination.paginate(queryset, second.next, 3)), [added.id])
+        self.assertEqual(self.ids_of(pagination.paginate(queryset, second.previous, 3)), self.ids[1:3])
+
+    def test_descending(self):
+        queryset = FoodItem.objects.all()
+        first = pagination.paginate(queryset, None, 4, descending=True)
+        self.assertEqual(self.ids_of(first), self.ids[::-1][:4])
+        second = pagination.paginate(queryset, first.next, 4, descending=True)
+        self.assertEqual((self.ids_of(second), second.next), (self.ids[::-1][4:], None))
+        self.assertEqual(self.ids_of(pagination.paginate(queryset, second.previous, 4, descending=True)), self.ids_of(first))
+
+    def test_past_the_end(self):
+        page = self.page(cursor=pagination.encode_cursor(pagination.NEXT, self.ids[-1])).data
+        self.assertEqual((page['results'], page['next'], page['previous']), ([], None, None))
+
+    def test_invalid_params(self):
+        for cursor in ('garbage', pagination.encode_cursor('x', 1), pagination.encode_cursor(pagination.NEXT, 'one'), '%%%'):
+            with self.subTest(cursor=cursor):
+                self.assertEqual(self.page(cursor=cursor).status_code, 400)
+                self.assertEqual(self.client.get('/api/category/', {'cursor': cursor}).status_code, 400)
+        self.assertEqual(self.page(page_size='ten').status_code, 400)
+        # Within 1 and PAGINATION_MAX_PAGE_SIZE
+        self.assertEqual(self.page(page_size=1000).data['pageSize'], 5)
+        self.assertEqual(len(self.page(page_size=0).data['results']), 1)
+
+
+# The static menu export (Categories/menu_export.py)
+@override_settings(MENU_EXPORT_ON_CHANGE=False)
+class MenuExportTests(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        exportRoot = override_settings(MENU_EXPORT_ROOT=self.root)
+        exportRoot.enable()
+        self.addCleanup(exportRoot.disable)
+
+        partner = User.objects.create_user('partner@example.com', 'partner@example.com', 'password')
+        self.category = Category.objects.create(user=partner, name='Pizza', image='images/pizza.jpg')
+        self.other = Category.objects.create(user=partner, name='Dosa', image='images/dosa.jpg')
+        self.food = FoodItem.objects.create(category=self.category, name='Paneer', description='Paneer pizza', price='120.50', image='images/food.jpg')
+        FoodItem.objects.create(category=self.other, name='Masala Dosa', description='Masala dosa', price='90.00', image='images/dosa.jpg')
+
+    def path(self, url):
+        return os.path.join(self.root, url.rsplit('/', 1)[-1])
+
+    def read(self, url):
+        with open(self.path(url), 'rb') as file:
+            return json.loads(file.read())
+
+    def test_export_menu(self):
+        # The categories and the food items
+        with self.assertNumQueries(2):
+            manifest = menu_export.export_menu()
+        self.assertRegex(manifest['index'], r'^/menu/index\.[0-9a-f]{12}\.json$')
+        self.assertIsNone(manifest['previousIndex'])
+        index = self.read(manifest['index'])
+        self.assertEqual([category['name'] for category in index], ['Pizza', 'Dosa'])
+        menu = self.read(index[0]['menu'])
+        self.assertEqual(menu['category']['id'], self.category.id)
+        self.assertEqual([food['name'] for food in menu['foodItems']], ['Paneer'])
+
+        # With gzip and brotli variants of the same content
+        with open(self.path(index[0]['menu']), 'rb') as file, gzip.open(self.path(index[0]['menu']) + '.gz') as compressed:
+            self.assertEqual(compressed.read(), file.read())
+        with open(self.path(index[0]['menu']), 'rb') as file, open(self.path(index[0]['menu']) + '.br', 'rb') as compressed:
+            self.assertEqual(brotli.decompress(compressed.read()), file.read())
+        # Exported again unchanged: the same files
+        self.assertEqual(menu_export.export_menu()['index'], manifest['index'])
+        self.assertEqual(self.client.get('/api/menu/manifest/').data['index'], manifest['index'])
+
+    def test_served(self):
+        manifest = menu_export.export_menu()
+        response = self.client.get(manifest['index'], HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(json.loads(gzip.decompress(b''.join(response.streaming_content))), self.read(manifest['index']))
+
+        # Brotli when the client accepts it
+        response = self.client.get(manifest['index'], HTTP_ACCEPT_ENCODING='gzip, deflate, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(json.loads(brotli.decompress(b''.join(response.streaming_content))), self.read(manifest['index']))
+
+    def test_export_category(self):
+        first = menu_export.export_menu()
+        firstIndex = self.read(first['index'])
+        FoodItem.objects.filter(id=self.food.id).update(name='Paneer Tikka')
+
+        # The categories, and the food items of the category re-exported
+        with self.assertNumQueries(2):
+            second = menu_export.export_category(self.category.id)
+        self.assertEqual(second['previousIndex'], first['index'])
+        secondIndex = self.read(second['index'])
+        self.assertNotEqual(secondIndex[0]['menu'], firstIndex[0]['menu'])
+        self.assertEqual([food['name'] for food in self.read(secondIndex[0]['menu'])['foodItems']], ['Paneer Tikka'])
+        # The other category keeps its file
+        self.assertEqual(secondIndex[1]['menu'], firstIndex[1]['menu'])
+
+        # The files of the current and previous index are kept, the older ones go
+        FoodItem.objects.filter(id=self.food.id).update(name='Paneer Butter Masala')
+        menu_export.export_category(self.category.id)
+        firstFiles = {first['index'].rsplit('/', 1)[-1], firstIndex[0]['menu'].rsplit('/', 1)[-1]}
+        self.assertEqual({name.removesuffix('.gz').removesuffix('.br') for name in menu_export.prune()}, firstFiles)
+        self.assertTrue(os.path.exists(self.path(second['index'])))
+        self.assertTrue(os.path.exists(self.path(firstIndex[1]['menu'])))
+        self.assertEqual(menu_export.prune(), [])
+
+    @override_settings(MENU_EXPORT_ON_CHANGE=True)
+    def test_on_change(self):
+        first = menu_export.export_menu()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.food.name = 'Paneer Tikka'
+            self.food.save()
+        manifest = menu_export.read_manifest()
+        self.assertEqual(manifest['previousIndex'], first['index'])
+        menu = self.read(self.read(manifest['index'])[0]['menu'])
+        self.assertEqual([food['name'] for food in menu['foodItems']], ['Paneer Tikka'])
+
+
+# The responsive image derivatives (Categories/images.py), generated once the upload is committed
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, MENU_EXPORT_ON_CHANGE=False, BACKGROUND_TASKS_EAGER=True, IMAGE_DERIVATIVE_WIDTHS=(320, 640, 1024))
+class ImageDerivativeTests(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+
+    def setUp(self):
+        caches[settings.CATALOG_CACHE_ALIAS].clear()
+        partner = User.objects.create_user('partner@example.com', 'partner@example.com', 'password')
+        self.category = Category.objects.create(user=partner, name='Pizza', image='images/pizza.jpg')
+
+    def upload(self, size=(800, 400), mode='RGBA'):
+        buffer = BytesIO()
+        Image.new(mode, size, 'orange').save(buffer, 'PNG')
+        return SimpleUploadedFile('food.png', buffer.getvalue(), content_type='image/png')
+
+    def add_food(self, image):
+        with self.captureOnCommitCallbacks(execute=True):
+            return FoodItem.objects.create(category=self.category, name='Paneer', description='Paneer pizza', price='120.50', image=image)
+
+    def test_derivatives(self):
+        food = self.add_food(self.upload())
+        food.refresh_from_db()
+        # The widths smaller than the original only
+        self.assertEqual(food.imageVariants, [320, 640])
+        for width, height in ((320, 160), (640, 320)):
+            for format in ('webp', 'jpeg'):
+                with default_storage.open(images.derivative_name(food.image.name, width, format)) as file:
+                    derivative = Image.open(file)
+                    self.assertEqual((derivative.format, derivative.size), (format.upper(), (width, height)))
+
+        stem = food.image.name.rsplit('/', 1)[-1].rsplit('.', 1)[0]
+        self.assertEqual(images.srcset(food.image, food.imageVariants), {
+            'webp': f'/media/images/derivatives/{stem}-320w.webp 320w, /media/images/derivatives/{stem}-640w.webp 640w',
+            'jpeg': f'/media/images/derivatives/{stem}-320w.jpg 320w, /media/images/derivatives/{stem}-640w.jpg 640w',
+        })
+        # Served with the food item
+        menu = self.client.get(f'/api/category/{self.category.id}').data
+        self.assertEqual(menu[0]['srcset'], images.srcset(food.image, [320, 640]))
+
+    def test_small_image(self):
+        food = self.add_food(self.upload(size=(200, 100), mode='RGB'))
+        food.refresh_from_db()
+        self.assertEqual(food.imageVariants, [])
+        self.assertIsNone(FoodItemSerializer(food).data['srcset'])
+
+    def test_image_replaced(self):
+        food = self.add_food(self.upload())
+        name = food.image.name
+        # A new upload resets the variants, until its own are generated
+        with self.captureOnCommitCallbacks(execute=False):
+            food.image = self.upload(size=(700, 350))
+            food.save()
+        food.refresh_from_db()
+        self.assertEqual(food.imageVariants, [])
+
+        # The derivatives of the previous image, done late, aren't recorded
+        self.assertEqual(images.process_image('FoodItem', food.id, name), [320, 640])
+        food.refresh_from_db()
+        self.assertEqual(food.imageVariants, [])
+        images.process_image('FoodItem', food.id, food.image.name)
+        food.refresh_from_db()
+        self.assertEqual(food.imageVariants, [320, 640])
+
+
+# The catalog search (Categories/search.py), with the in-process index unless on Postgres
+@override_settings(MENU_EXPORT_ON_CHANGE=False)
+class SearchTests(TestCase):
+    def setUp(self):
+        search._index = None
+        self.addCleanup(setattr, search, '_index', None)
+        partner = User.objects.create_user('partner@example.com', 'partner@example.com', 'password')
+        self.pizza = Category.objects.create(user=partner, name='Pizza', image='images/pizza.jpg')
+        self.paneerHouse = Category.objects.create(user=partner, name='Paneer House', image='images/paneer.jpg')
+        self.dosa = Category.objects.create(user=partner, name='Dosa', image='images/dosa.jpg')
+        self.food = {}
+        for category, name, description in (
+            (self.pizza, 'Paneer Pizza', 'Cottage cheese pizza'),
+            (self.pizza, 'Margherita', 'Tomato and basil pizza'),
+            (self.paneerHouse, 'Paneer Tikka', 'Grilled paneer'),
+            (self.paneerHouse, 'Dal', 'Lentils'),
+            (self.dosa, 'Masala Dosa', 'Potato filling'),
+        ):
+            self.food[name] = FoodItem.objects.create(category=category, name=name, description=description, price='120.50', image='images/food.jpg')
+
+    def names(self, query):
+        results = search.search(query)
+        foodNames = {food.id: name for name, food in self.food.items()}
+        categoryNames = {category.id: category.name for category in Category.objects.all()}
+        return [foodNames[id] for id in results['food']], [categoryNames[id] for id in results['category']]
+
+    def test_ranking(self):
+        # In the name, the category and the description first, in the category only last
+        self.assertEqual(self.names('paneer'), (['Paneer Tikka', 'Paneer Pizza', 'Dal'], ['Paneer House']))
+        # Matching more of the terms first
+        foods, categories = self.names('paneer pizza')
+        self.assertEqual(foods[0], 'Paneer Pizza')
+        self.assertEqual(set(foods[1:]), {'Margherita', 'Paneer Tikka', 'Dal'})
+        self.assertEqual(set(categories), {'Pizza', 'Paneer House'})
+        self.assertEqual(self.names('sushi'), ([], []))
+        self.assertEqual(self.names('  '), ([], []))
+
+    def test_prefix(self):
+        self.assertEqual(self.names('pan')[0], ['Paneer Tikka', 'Paneer Pizza', 'Dal'])
+        self.assertEqual(self.names('margh'), (['Margherita'], []))
+        # An exact match before a prefix one
+        self.assertEqual(self.names('do')[1], ['Dosa'])
+
+    def test_typos(self):
+        self.assertEqual(self.names('panner')[0], ['Paneer Tikka', 'Paneer Pizza', 'Dal'])
+        self.assertEqual(self.names('margerita'), (['Margherita'], []))
+        self.assertEqual(self.names('msaala'), (['Masala Dosa'], []))
+        self.assertEqual(self.names('Pizaz tikka')[0][0], 'Paneer Tikka')
+        # Short words must be exact
+        self.assertEqual(self.names('dak'), ([], []))
+
+    def test_search_view(self):
+        response = self.client.get('/api/search/', {'q': 'panner', 'limit': 2})
+        self.assertEqual([food['name'] for food in response.data['foodItems']], ['Paneer Tikka', 'Paneer Pizza'])
+        self.assertEqual([category['name'] for category in response.data['categories']], ['Paneer House'])
+        self.assertEqual(self.client.get('/api/search/').status_code, 400)
+
+    def test_tokenize(self):
+        self.assertEqual(search.tokenize('Crème Brûlée, 2 PCS'), ['creme', 'brulee', '2', 'pcs'])
+        self.assertEqual(search._edit_distance('panner', 'paneer', 2), 1)
+        # A transposition is one typo
+        self.assertEqual(search._edit_distance('dosa', 'dsoa', 1), 1)
+        self.assertEqual(search._edit_distance('dosa', 'pizza', 1), 2)
+
+    @skipIf(connection.vendor == 'postgresql', 'The database indexes are used instead')
+    def test_index_updates(self):
+        self.names('paneer')
+        # Kept in sync by the signals once the writes commit, without being rebuilt
+        with self.captureOnCommitCallbacks(execute=True):
+            butterChicken = FoodItem.objects.create(category=self.dosa, name='Butter Chicken', description='Creamy', price='250.00', image='')
+            self.food['Butter Chicken'] = butterChicken
+            paneerTikka = self.food['Paneer Tikka']
+            paneerTikka.name = 'Tandoori Tikka'
+            paneerTikka.save()
+            self.food['Tandoori Tikka'] = self.food.pop('Paneer Tikka')
+        with self.assertNumQueries(0):
+            results = search.search('butter')
+        self.assertEqual(results['food'], [butterChicken.id])
+        self.assertEqual(self.names('tandoori')[0], ['Tandoori Tikka'])
+        # Still found by its category and its description
+        self.assertEqual(self.names('paneer')[0], ['Paneer Pizza', 'Tandoori Tikka', 'Dal'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            butterChicken.delete()
+        self.assertEqual(self.names('butter'), ([], []))
+
+        # The food items are found by the new name of their category, not by the old one
+        with self.captureOnCommitCallbacks(execute=True):
+            self.dosa.name = 'South Indian'
+            self.dosa.save()
+        self.assertEqual(self.names('south'), (['Masala Dosa'], ['South Indian']))
+        self.assertEqual(self.names('dosa'), (['Masala Dosa'], []))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.paneerHouse.delete()
+        self.assertEqual(self.names('dal'), ([], []))
+        self.assertEqual(self.names('paneer'), (['Paneer Pizza'], []))
+
+    @skipUnless(connection.vendor == 'postgresql', 'Searched with the in-process index')
+    def test_postgres_search(self):
+        foods, categories = self.names('pan')
+        self.assertEqual((set(foods), categories), ({'Paneer Tikka', 'Paneer Pizza', 'Dal'}, ['Paneer House']))
+        self.assertIsNone(search._index)
+
+    # The in-process index is only a fallback, Postgres searches with its own indexes
+    def test_postgres(self):
+        with mock.patch.object(search, 'uses_postgres', return_value=True), mock.patch.object(search.connection, 'cursor') as cursor:
+            execute = cursor.return_value.__enter__.return_value.execute
+            cursor.return_value.__enter__.return_value.fetchall.side_effect = [[(self.food['Dal'].id,)], [(self.pizza.id,)]]
+            self.assertEqual(search.search('Pizza  pan pizza', 5), {'food': [self.food['Dal'].id], 'category': [self.pizza.id]})
+            params = execute.call_args.args[1]
+            self.assertEqual(params, {'tsquery': 'pizza:* & pan:*', 'text': 'pizza pan', 'limit': 5})
+
+        # Nor built, nor updated
+        with mock.patch.object(search, 'uses_postgres', return_value=True), self.captureOnCommitCallbacks(execute=True):
+            self.food['Dal'].save()
+        self.assertIsNone(search._index)
@@ -1,5 +1,6 @@
 from django.urls import path
 from . import views
+from crud import ratelimit
 from .views import MyTokenObtainPairView
 
 # Refer to: https://django-rest-framework-simplejwt.readthedocs.io/en/latest/getting_started.html#installation 
@@ -22,7 +23,10 @@ urlpatterns = [
 
     # To get all the orders of the logged in category
     path('get-orders/', views.getOrders, name='getOrders'),
+    path('order-board/', views.orderBoard, name='orderBoard'),
+    path('events/', views.orderEvents, name='orderEvents'),
     path('update-order-status/<int:id>', views.updateOrderStatus, name='updateOrderStatus'),
+    path('update-order-status/', views.updateOrdersStatus, name='updateOrdersStatus'),
 
     # For payment integration using Stripe
     path('create-stripe-account/', views.createStripeAccount, name='createStripeAccount'),
@@ -33,5 +37,5 @@ urlpatterns = [
 
     # For user authentication
     path('api/token/', MyTokenObtainPairView.as_view(), name='token_obtain_pair'),
-    path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+    path('api/token/refresh/', TokenRefreshView.as_view(throttle_classes=ratelimit.throttles('refresh', 'ip')), name='token_refresh'),
 ]
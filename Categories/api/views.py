@@ -1,25 +1,25 @@
-import os 
 from django.core.exceptions import ObjectDoesNotExist
 from django.db.utils import Error
 from django.contrib.auth.models import Group
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
 from rest_framework.response import Response
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, authentication_classes, permission_classes, throttle_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework import status
+from django.http import HttpResponse
 
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer 
 from rest_framework_simplejwt.views import TokenObtainPairView
+from rest_framework_simplejwt.exceptions import TokenError
 
-from twilio.rest import Client
-
-from FromOurKitchen.models import ActiveOrders, MobileNumber
-from FromOurKitchen.api.serializers import ActiveOrdersSerializer
+from FromOurKitchen.models import ActiveOrders
+from FromOurKitchen.api.serializers import ActiveOrdersSerializer, OrderBoardSerializer
+from FromOurKitchen import orders as kitchenOrders
 
 from Categories.models import Category, FoodItem, User, Stripe
 from .serializers import FoodItemSerializer
-
-import stripe
+from . import pagination
+from crud import asyncviews, events, gateways, ratelimit, tokens
 
 class MyTokenObtainPairSerializer(TokenObtainPairSerializer):
     @classmethod
@@ -27,23 +27,18 @@ class MyTokenObtainPairSerializer(TokenObtainPairSerializer):
     def get_token(cls, user):
         token = super().get_token(user)
 
-        # Add custom claims
-        token['username'] = user.username
-
-        if user.groups.filter(name="category").exists():
-            token['group'] = "category"
-        else:
-            token['group'] = "None"
-
-        # ...
-        return token
+        # Add custom claims (the username and the group, see crud/tokens.py)
+        return tokens.add_claims(token, user)
 
 
+# Same limits as the customer token view (FromOurKitchen/api/views.py)
 class MyTokenObtainPairView(TokenObtainPairView):
     serializer_class = MyTokenObtainPairSerializer
+    throttle_classes = ratelimit.throttles('login', 'ip', 'user')
 
 # User registration logic
 @api_view(['POST'])
+@throttle_classes(ratelimit.throttles('register', 'ip'))
 def register(request):
     email = request.data["email"]
     name = request.data["name"]
@@ -74,7 +69,7 @@ def register(request):
     # Associate user details with the Category model. Store the address, name etc.
     try:
         user = User.objects.get(username=email)
-        category = Category.objects.create(user=user, name=name, address=address, image=image)
+        category = Category.objects.create(user=user, name=name, image=image)
         category.save()
     except IntegrityError as e:
         return Response(e, status=status.HTTP_406_NOT_ACCEPTABLE)
@@ -120,11 +115,23 @@ def addFoodItem(request):
 
 
 # For category to view all the added food items
+# Pass ?cursor= and/or ?page_size= to get the food items one page at a time (see pagination.py)
 @api_view(['GET'])
+@authentication_classes([tokens.ClaimsAuthentication])
 @permission_classes([IsAuthenticated])
 def manageFoodItems(request):
-    category = Category.objects.get(user= request.user)
+    category = Category.objects.get(user_id=request.user.id)
     foodItems = FoodItem.objects.filter(category=category)
+
+    if pagination.is_paginated(request):
+        try:
+            cursor, pageSize = pagination.get_page_params(request)
+        except pagination.InvalidPage as e:
+            return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+        page = pagination.paginate(foodItems, cursor, pageSize)
+        serializer = FoodItemSerializer(page.results, many=True)
+        return Response(pagination.page_data(page, serializer.data))
+
     # Serialize the data for sending to frontend
     serializer = FoodItemSerializer(foodItems, many=True)
     return Response(serializer.data)
@@ -185,210 +192,213 @@ def deleteFoodItem(request, id):
 
 # To get all the orders of the requested category (logged in category)
 @api_view(['GET'])
+@authentication_classes([tokens.ClaimsAuthentication])
 @permission_classes([IsAuthenticated]) 
 def getOrders(request):
-    user = request.user
     try:
-        activeOrders = ActiveOrders.objects.filter(user=user, active=True)
-    except ActiveOrders.DoesNotExist:
-        return Response({'message': 'No active orders found for this user'}, status=status.HTTP_404_NOT_FOUND)
+        category = Category.objects.get(user_id=request.user.id)
+    except Category.DoesNotExist:
+        return Response('No category is associated with the logged in user', status=status.HTTP_404_NOT_FOUND)
+    activeOrders = ActiveOrdersSerializer.prefetch(ActiveOrders.objects.filter(category=category, active=True).order_by('id'))
     serializer = ActiveOrdersSerializer(activeOrders, many=True)
     return Response(serializer.data)
 
 
-# To update the order status as delivered
-@api_view(['POST'])
+# Order board of the logged in category, for kitchen tablets polling every few seconds.
+# The first request returns every active order. Each response has the watermarks to pass to the next
+# request, ?since=<since>&updated_after=<updatedAfter>, which then returns only the orders placed
+# or changed (e.g. delivered) since. An order can be returned twice, replace it by id (see orders.py)
+@api_view(['GET'])
+@authentication_classes([tokens.ClaimsAuthentication])
 @permission_classes([IsAuthenticated])
-def updateOrderStatus(request, id):
+def orderBoard(request):
+    try:
+        since, updatedAfter = kitchenOrders.get_board_params(request)
+    except kitchenOrders.InvalidBoardParams as e:
+        return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+    try:
+        category = Category.objects.get(user_id=request.user.id)
+    except Category.DoesNotExist:
+        return Response('No category is associated with the logged in user', status=status.HTTP_404_NOT_FOUND)
 
-    category = Category.objects.get(user=request.user)
-    order = ActiveOrders.objects.get(id=id, category=category)
-    order.active = False
-    order.save()
+    board = kitchenOrders.get_board(category.id, since, updatedAfter, prefetch=OrderBoardSerializer.prefetch)
+    return Response({
+        'results': OrderBoardSerializer(board.orders, many=True).data,
+        'since': board.since,
+        'updatedAfter': board.updatedAfter.isoformat(),
+    })
 
-    # --- To send the user a text SMS about the updated order status ----
 
-    # Get the mobile number of the user who placed the order
-    orderedBy = User.objects.get(id=order.user.id)
-    number = MobileNumber.objects.get(user=orderedBy).number
+# To push the order events (order.created, order.status) of the logged in category as server-sent
+# events, e.g. to refresh the order board (see crud/events.py). Not a DRF view, see the customer orderEvents
+async def orderEvents(request):
+    try:
+        token = events.get_access_token(request)
+    except TokenError as e:
+        return HttpResponse(str(e), status=status.HTTP_401_UNAUTHORIZED)
+    categoryId = await Category.objects.filter(user_id=token['user_id'], user__is_active=True).values_list('id', flat=True).afirst()
+    if categoryId is None:
+        return HttpResponse('No category is associated with the logged in user', status=status.HTTP_404_NOT_FOUND)
+    return await events.stream(f'category:{categoryId}', token)
 
-    # Find your Account SID and Auth Token at https://twilio.com/console
-    # and set the environment variables. See http://twil.io/secure
-    account_sid = os.getenv('TWILIO_ACCOUNT_SID')
-    auth_token = os.getenv('TWILIO_AUTH_TOKEN')
-    client = Client(account_sid, auth_token)
 
-    message = client.messages \
-                    .create(
-                        messaging_service_sid='MGf50dd0f886cfaa39b05a96200c338c37',
-                        to='+' + str(number),
-                        body="Your order #" + str(order.id) + " has been delivered! Thanks for ordering at From Our Kitchen ! " 
-                    )
+# To update the order status as delivered
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def updateOrderStatus(request, id):
 
-    print('Message sent ✅ ', message.status)
+    category = Category.objects.get(user=request.user)
+    order = ActiveOrdersSerializer.prefetch(ActiveOrders.objects.all()).get(id=id, category=category)
+    order.active = False
+    with transaction.atomic():
+        order.save()
+        # To send the user a text SMS about the updated order status (by the notifications worker)
+        kitchenOrders.notify_delivered([order.id])
+    kitchenOrders.publish_order_event(kitchenOrders.ORDER_STATUS, order)
 
     serializer = ActiveOrdersSerializer(order)
     return Response(serializer.data)
 
 
-# To create a new stripe account
+# To mark many orders of the logged in category as delivered at once, {"orders": [12, 15, ...]}.
+# Returns the outcome of each order: delivered, already_delivered or not_found (see orders.py)
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
-def createStripeAccount(request):
+def updateOrdersStatus(request):
+    try:
+        category = Category.objects.get(user=request.user)
+    except Category.DoesNotExist:
+        return Response('No category is associated with the logged in user', status=status.HTTP_404_NOT_FOUND)
+    try:
+        results = kitchenOrders.mark_delivered(category.id, request.data.get('orders'))
+    except kitchenOrders.InvalidStatusUpdate as e:
+        return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+    return Response({'results': results})
+
+
+# The Stripe views below are async: they wait on Stripe without holding a thread (see crud/asyncviews.py)
+
+# To create a new stripe account
+@asyncviews.api_view(['POST'])
+async def createStripeAccount(request):
     
     # Get the category for which stripe account has to be created
-    getCategory = Category.objects.get(user=request.user)
+    getCategory = await Category.objects.aget(user=request.user)
 
-    stripe.api_key = os.getenv("STRIPE_API_KEY") 
-    
     # Check if account is already created, if so then return back otherwise continue to create a stripe account for category
-    try:
-        getStripeData = Stripe.objects.get(category=getCategory)
-        return Response({'Stripe account already created'}, status=412)
-    except ObjectDoesNotExist:
-        pass
+    if await Stripe.objects.filter(category=getCategory).aexists():
+        return asyncviews.Response({'Stripe account already created'}, status=412)
 
+    await asyncviews.release_connection()
     # To create a stripe account
     # For more info refer to: https://stripe.com/docs/connect/enable-payment-acceptance-guide?platform=web#web-create-standard-account
-    response = stripe.Account.create(
-        type = "standard",
-        country = "US",
-        email = request.user.email, 
-
-    )
+    response = await gateways.payments().acreate_account(request.user.email)
     # TODO: Add business profile details later like name address etc. 
     # https://stripe.com/docs/api/accounts/create#create_account-business_profile
 
     # Store the stripe acccount ID of the category owner
-    stripeModel = Stripe.objects.create(category = getCategory, accountID=response.id)
-    stripeModel.save()
+    await Stripe.objects.acreate(category = getCategory, accountID=response.id)
     
     # To create an account link for user start the onboarding process.
     # Refer: https://stripe.com/docs/connect/enable-payment-acceptance-guide?platform=web#web-create-account-link
-    accountLinkResponse = stripe.AccountLink.create(
-        account = response.id,
-        # Get the deployed URL from env variables
-        refresh_url = "https://online-food-delivery-system.vercel.app/partner-with-us/account-setup/refresh-url",
-        return_url = "https://online-food-delivery-system.vercel.app/partner-with-us/account-setup/return-url",
-        type = "account_onboarding",
-    )
+    accountLinkURL = await gateways.payments().acreate_account_link(response.id)
 
     # Return the URL generated by stripe
-    return Response({accountLinkResponse.url})
+    return asyncviews.Response({accountLinkURL})
 
 
 
 # To complete a stripe account which already has stripe account created but not completed 
 # (all details are not provided as required by stripe)
-@api_view(['POST'])
-@permission_classes([IsAuthenticated])
-def completeStripeAccount(request):
+@asyncviews.api_view(['POST'])
+async def completeStripeAccount(request):
     
     # Check if stripe is created.
     # Only continue if account is created, but onboarding process is not completed
     try:
-        getCategory = Category.objects.get(user=request.user)
-        getStripeData = Stripe.objects.get(category=getCategory)
+        getStripeData = await Stripe.objects.aget(category__user=request.user)
     except ObjectDoesNotExist:
-        return Response({'Stripe account not created'}, status=status.HTTP_412_PRECONDITION_FAILED)
+        return asyncviews.Response({'Stripe account not created'}, status=status.HTTP_412_PRECONDITION_FAILED)
 
+    await asyncviews.release_connection()
     # To create an account link. 
     # Refer: https://stripe.com/docs/connect/enable-payment-acceptance-guide?platform=web#web-create-account-link
-    accountLinkResponse = stripe.AccountLink.create(
-        account = getStripeData.accountID,
-        # Get the hosted URL from env variables
-        refresh_url = "https://online-food-delivery-system.vercel.app/partner-with-us/account-setup/refresh-url",
-        return_url = "https://online-food-delivery-system.vercel.app/partner-with-us/account-setup/return-url",
-        type = "account_onboarding",
-    )
+    accountLinkURL = await gateways.payments().acreate_account_link(getStripeData.accountID)
 
     # Return the URL generated by stripe
-    return Response({accountLinkResponse.url})
+    return asyncviews.Response({accountLinkURL})
 
 
 # To get the stripe account details of the category.
 # This checks 3 different conditions, and passes it to frontend,using custom status codes, 
 # where frontend conditonally renders according to this data.
-@api_view(['GET'])
-@permission_classes([IsAuthenticated])
-def stripeGetDetails(request):
+@asyncviews.api_view(['GET'])
+async def stripeGetDetails(request):
     
 
     # CASE 1: Check if stripe account is not created.
     try:
-        getCategory = Category.objects.get(user=request.user)
-        getStripeData = Stripe.objects.get(category=getCategory)
+        getStripeData = await Stripe.objects.aget(category__user=request.user)
     except ObjectDoesNotExist:
-        return Response({'Stripe account does not exist'})
+        return asyncviews.Response({'Stripe account does not exist'})
 
     # CASE 2: Check if account is created, but the stripe onboarding process is not completed (all details are not provided)
-    stripe.api_key = os.getenv("STRIPE_API_KEY") 
 
+    await asyncviews.release_connection()
     # Retrieves the details of the stripe account from stripe's server
     # Refer: https://stripe.com/docs/api/accounts/retrieve
-    stripeAccount = stripe.Account.retrieve(getStripeData.accountID)
+    stripeAccount = await gateways.payments().aretrieve_account(getStripeData.accountID)
     details_submitted = stripeAccount.details_submitted
     charges_enabled = stripeAccount.charges_enabled
 
     if details_submitted == False or charges_enabled == False:
-        return Response({'Connect Onboarding Process not completed'}, status=230)
+        return asyncviews.Response({'Connect Onboarding Process not completed'}, status=230)
     
 
     # CASE 3: Account is created and all the details have also been provided
-    return Response({'Stripe account connected ✅'}, status=231)
+    return asyncviews.Response({'Stripe account connected ✅'}, status=231)
 
 
 # In the case when stripe onborading is not completed, the following function is called
 # Refer: https://stripe.com/docs/connect/enable-payment-acceptance-guide?platform=web#web-refresh-url
-@api_view(['GET'])
-@permission_classes([IsAuthenticated])
-def stripeRefreshURL(request):
-
-    getCategory = Category.objects.get(user=request.user)
+@asyncviews.api_view(['GET'])
+async def stripeRefreshURL(request):
 
     try:
-        getStripeData  = Stripe.objects.get(category=getCategory)
-        # To create an account link. 
-        # Refer: https://stripe.com/docs/connect/enable-payment-acceptance-guide?platform=web#web-create-account-link
-        accountLinkResponse = stripe.AccountLink.create(
-            account = getStripeData.accountID,
-            # Get the hosted URL from env variables
-            refresh_url = "https://online-food-delivery-system.vercel.app/partner-with-us/account-setup/refresh-url",
-            return_url = "https://online-food-delivery-system.vercel.app/partner-with-us/account-setup/return-url",
-            type = "account_onboarding",
-        )
+        getStripeData = await Stripe.objects.aget(category__user=request.user)
     except ObjectDoesNotExist:
-        return Response({'Stripe account not created'})
+        return asyncviews.Response({'Stripe account not created'})
 
+    await asyncviews.release_connection()
+    # To create an account link. 
+    # Refer: https://stripe.com/docs/connect/enable-payment-acceptance-guide?platform=web#web-create-account-link
+    accountLinkURL = await gateways.payments().acreate_account_link(getStripeData.accountID)
 
     # Return the URL generated by stripe
-    return Response({accountLinkResponse.url})
+    return asyncviews.Response({accountLinkURL})
 
 
 # If connect onborading is completed then this function is called
-@api_view(['GET'])
-@permission_classes([IsAuthenticated])
-def stripeReturnURL(request):
+@asyncviews.api_view(['GET'])
+async def stripeReturnURL(request):
 
-    stripe.api_key = os.getenv("STRIPE_API_KEY") 
-    
     try:
         # Get the category's stripe account ID stored in our database
-        getCategory = Category.objects.get(user=request.user)
-        getStripeData  = Stripe.objects.get(category=getCategory)
+        getStripeData = await Stripe.objects.aget(category__user=request.user)
     except ObjectDoesNotExist:
-        return Response({'Stripe account not created'})
+        return asyncviews.Response({'Stripe account not created'})
 
+    await asyncviews.release_connection()
     # Retrieves the details of the stripe account from stripe's server
     # Refer: https://stripe.com/docs/api/accounts/retrieve
-    stripeAccount = stripe.Account.retrieve(getStripeData.accountID)
+    stripeAccount = await gateways.payments().aretrieve_account(getStripeData.accountID)
     details_submitted = stripeAccount.details_submitted
     charges_enabled = stripeAccount.charges_enabled
 
     if details_submitted == False or charges_enabled == False:
-        return Response({'Connect Onboarding Process not completed'}, status=status.HTTP_412_PRECONDITION_FAILED)
+        return asyncviews.Response({'Connect Onboarding Process not completed'}, status=status.HTTP_412_PRECONDITION_FAILED)
 
-    return Response({'Stripe onboarding process completed successfully ✅'})
+    return asyncviews.Response({'Stripe onboarding process completed successfully ✅'})
 
 
 
@@ -406,7 +416,10 @@ def getRoutes(request):
         '/api/manage-food-items/<int:id>/update/',
         '/api/manage-food-items/<int:id>/delete/',
         '/api/get-orders/',
+        '/api/order-board/',
+        '/api/events/',
         '/api/update-order-status/<int:id>/',
+        '/api/update-order-status/',
         '/api/create-stripe-account/',
         '/api/complete-stripe-account/',
         '/api/create-stripe-account/get-details/',
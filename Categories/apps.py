@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class CategoriesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'Categories'
+
+    def ready(self):
+        # Connects the catalog cache invalidation signals
+        from . import signals  # noqa: F401
@@ -0,0 +1,124 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+
+# Cache for the public catalog reads (category list, a category's food items and a category's info).
+#
+# Every entry is stored under a versioned key, e.g. "catalog:category:4:food:v1737891234567".
+# Saving or deleting a Category/FoodItem only bumps the version of the affected category
+# (and of the category list when a Category changes), so the next read misses and rebuilds
+# while untouched categories keep being served from the cache. Old versions simply expire.
+#
+# The backend is chosen with the 'catalog' entry of settings.CACHES (local memory by default,
+# file or database based through the CATALOG_CACHE_BACKEND environment variable).
+
+CATEGORY_LIST_VERSION_KEY = 'catalog:categories:version'
+
+# Hit, miss and invalidation counters of this process
+_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+_statsLock = threading.Lock()
+
+# Marker to tell a cached None apart from a cache miss
+_MISSING = object()
+
+
+def _cache():
+    return caches[getattr(settings, 'CATALOG_CACHE_ALIAS', 'catalog')]
+
+
+def _timeout():
+    return getattr(settings, 'CATALOG_CACHE_TIMEOUT', 60 * 60)
+
+
+def _count(counter):
+    with _statsLock:
+        _stats[counter] += 1
+
+
+def _category_version_key(categoryId):
+    return f'catalog:category:{categoryId}:version'
+
+
+# Returns the current version of a key group, creating it if needed.
+# New versions start from the current time (in ms) instead of 1, so that a version key which was
+# evicted from the cache can never point back to an older entry which is still stored.
+def _version(versionKey):
+    cache = _cache()
+    version = cache.get(versionKey)
+    if version is None:
+        cache.add(versionKey, int(time.time() * 1000), timeout=None)
+        version = cache.get(versionKey)
+    return version
+
+
+def _get_or_build(key, build):
+    cache = _cache()
+    data = cache.get(key, _MISSING)
+    if data is not _MISSING:
+        _count('hits')
+        return data
+
+    _count('misses')
+    data = build()
+    cache.set(key, data, timeout=_timeout())
+    return data
+
+
+def _bump(versionKey):
+    try:
+        _cache().incr(versionKey)
+    except ValueError:
+        # Nothing has been cached under this version key yet, so there is nothing to invalidate
+        pass
+    _count('invalidations')
+
+
+# To get the serialized list of the categories, e.g. kind='all' or a kind naming a single page.
+# build() is only called on a cache miss
+def get_categories(build, kind='all'):
+    version = _version(CATEGORY_LIST_VERSION_KEY)
+    return _get_or_build(f'catalog:categories:{kind}:v{version}', build)
+
+
+# To get serialized data of a single category, e.g. kind='food' for its food items or kind='info'.
+# build() is only called on a cache miss
+def get_category_data(categoryId, kind, build):
+    version = _version(_category_version_key(categoryId))
+    return _get_or_build(f'catalog:category:{categoryId}:{kind}:v{version}', build)
+
+
+# To get the Stripe account id of a category (None if the category has none), for the checkout.
+# Stored with the category's data, so a change of its Stripe row (see Categories/signals.py) invalidates it.
+# build() is only called on a cache miss
+def get_payout_account(categoryId, build):
+    return get_category_data(categoryId, 'stripe', build)
+
+
+# Invalidation is deferred until the surrounding transaction commits. Invalidating earlier would let
+# a concurrent read cache the old rows again under the new version.
+def invalidate_category_list():
+    transaction.on_commit(lambda: _bump(CATEGORY_LIST_VERSION_KEY))
+
+
+def invalidate_category(categoryId):
+    transaction.on_commit(lambda: _bump(_category_version_key(categoryId)))
+
+
+# Hit, miss and invalidation counters of the current process
+def get_stats():
+    with _statsLock:
+        stats = dict(_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hitRatio'] = round(stats['hits'] / lookups, 4) if lookups else None
+    stats['backend'] = _cache().__class__.__name__
+    return stats
+
+
+def reset_stats():
+    with _statsLock:
+        for counter in _stats:
+            _stats[counter] = 0
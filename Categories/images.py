@@ -0,0 +1,97 @@
+import os
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+from Categories import cache as catalogCache
+from Categories import menu_export
+from Categories.models import Category, FoodItem
+from crud import background
+
+
+# Responsive image derivatives of the FoodItem and Category images.
+#
+# Once an image is uploaded, resized WebP and JPEG copies are generated in the 'images' background
+# pool at each width of IMAGE_DERIVATIVE_WIDTHS smaller than the original:
+#   images/Veg_Burger.jpg -> images/derivatives/Veg_Burger-320w.webp, images/derivatives/Veg_Burger-320w.jpg, ...
+# The generated widths are stored on the row (imageVariants), so serializers can build the srcset
+# without touching the storage.
+
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+EXTENSIONS = {'webp': 'webp', 'jpeg': 'jpg'}
+
+
+def _widths():
+    return getattr(settings, 'IMAGE_DERIVATIVE_WIDTHS', (320, 640, 1024))
+
+
+def derivative_name(name, width, format):
+    directory, fileName = os.path.split(name)
+    stem = os.path.splitext(fileName)[0]
+    return f'{directory}/derivatives/{stem}-{width}w.{EXTENSIONS[format]}'
+
+
+# srcset attribute values of an image, per format, e.g. {'webp': '/media/...-320w.webp 320w, ...', 'jpeg': ...}
+def srcset(image, widths):
+    if not image or not widths:
+        return None
+    return {
+        format: ', '.join(f'{default_storage.url(derivative_name(image.name, width, format))} {width}w' for width in widths)
+        for format in FORMATS
+    }
+
+
+# Writes the derivatives of an image and returns the widths generated
+def generate_derivatives(name):
+    with default_storage.open(name, 'rb') as file:
+        image = Image.open(file)
+        image.load()
+    # Apply the EXIF orientation, phones store most photos rotated
+    image = ImageOps.exif_transpose(image)
+
+    widths = [width for width in sorted(_widths()) if width < image.width]
+    for width in widths:
+        height = max(1, round(image.height * width / image.width))
+        resized = image.resize((width, height), Image.Resampling.LANCZOS)
+        for format, (pilFormat, options) in FORMATS.items():
+            # JPEG has no alpha channel
+            output = resized.convert('RGB') if pilFormat == 'JPEG' or resized.mode not in ('RGB', 'RGBA') else resized
+            buffer = BytesIO()
+            output.save(buffer, pilFormat, **options)
+
+            derivative = derivative_name(name, width, format)
+            # Keep the deterministic name, the storage would otherwise pick a new one
+            if default_storage.exists(derivative):
+                default_storage.delete(derivative)
+            default_storage.save(derivative, ContentFile(buffer.getvalue()))
+    return widths
+
+
+# Background task: generates the derivatives of a row's image and records them on the row
+def process_image(modelName, id, name):
+    model = {'FoodItem': FoodItem, 'Category': Category}[modelName]
+    widths = generate_derivatives(name)
+
+    # Only if the image wasn't replaced in the meantime. update() sends no signals, so the
+    # catalog cache and the static menu are refreshed here
+    if model.objects.filter(id=id, image=name).update(imageVariants=widths):
+        if model is FoodItem:
+            categoryId = model.objects.filter(id=id).values_list('category_id', flat=True).first()
+        else:
+            categoryId = id
+            catalogCache.invalidate_category_list()
+        if categoryId is not None:
+            catalogCache.invalidate_category(categoryId)
+            menu_export.on_catalog_change(categoryId)
+    return widths
+
+
+# Schedules the derivatives of a newly uploaded image, once the upload is committed
+def schedule(instance):
+    background.submit_on_commit('images', process_image, instance.__class__.__name__, instance.id, instance.image.name)
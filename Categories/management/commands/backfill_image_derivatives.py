@@ -0,0 +1,37 @@
+from concurrent.futures import as_completed
+
+from django.core.management.base import BaseCommand
+
+from Categories import images
+from Categories.models import Category, FoodItem
+from crud import background
+
+
+# Generates the resized copies of the images uploaded before the derivative pipeline existed
+# (or of every image with --force, e.g. after changing IMAGE_DERIVATIVE_WIDTHS)
+class Command(BaseCommand):
+    help = 'Generate the resized WebP/JPEG copies of the existing FoodItem and Category images'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='Regenerate images which already have derivatives')
+
+    def handle(self, *args, **options):
+        futures = {}
+        for model in (Category, FoodItem):
+            rows = model.objects.exclude(image='')
+            if not options['force']:
+                rows = rows.filter(imageVariants=[])
+            for id, name in rows.values_list('id', 'image'):
+                future = background.submit('images', images.process_image, model.__name__, id, name)
+                futures[future] = name
+
+        failed = 0
+        for future in as_completed(futures):
+            try:
+                widths = future.result()
+                self.stdout.write(f'{futures[future]}: {widths or "already small enough"}')
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f'{futures[future]}: {e}')
+
+        self.stdout.write(self.style.SUCCESS(f'Processed {len(futures) - failed} image(s) ✅, {failed} failed'))
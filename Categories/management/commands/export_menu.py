@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from Categories import menu_export
+
+
+# Renders the full menu to content-hashed JSON files (plus .gz/.br variants) in MENU_EXPORT_ROOT.
+# Run it as part of the build/release step; afterwards the on-change hook keeps the files current
+# when MENU_EXPORT_ON_CHANGE is enabled.
+class Command(BaseCommand):
+    help = 'Export every category with its food items to static, precompressed JSON files'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--prune',
+            action='store_true',
+            help='Delete exported files which are no longer referenced by the current or previous index',
+        )
+
+    def handle(self, *args, **options):
+        manifest = menu_export.export_menu()
+        self.stdout.write(self.style.SUCCESS(f"Menu exported ✅ {manifest['index']}"))
+
+        if options['prune']:
+            removed = menu_export.prune()
+            self.stdout.write(f'Removed {len(removed)} stale file(s)')
@@ -0,0 +1,191 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+from datetime import datetime
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+# Imported as a module, the serializers import this module indirectly (through Categories.images)
+from Categories.api import serializers
+from Categories.models import Category, FoodItem
+
+try:
+    import brotli
+except ImportError:
+    # In requirements.txt, the .br variants are only skipped where it isn't installed
+    brotli = None
+
+
+# Static export of the whole menu, served by WhiteNoise instead of Django views.
+#
+# Every file except the manifest is named after the hash of its content, so it never changes
+# once written and can be cached forever (see crud/middleware.py):
+#   category-<id>.<hash>.json  - a category with all its food items
+#   index.<hash>.json          - every category, with the URL of its category file
+#   manifest.json              - short lived pointer to the current index file
+# Each JSON file gets .gz and .br variants next to it, which WhiteNoise picks according to the
+# Accept-Encoding of the request.
+
+MANIFEST_NAME = 'manifest.json'
+HASHED_NAME_REGEX = re.compile(r'\.[0-9a-f]{12}\.json$')
+
+# Exports can be triggered from several threads (on-change hook), the index must be written by one at a time
+_exportLock = threading.Lock()
+
+
+def _root():
+    return settings.MENU_EXPORT_ROOT
+
+
+def _url(name):
+    return settings.MENU_EXPORT_URL.rstrip('/') + '/' + name
+
+
+def _dumps(data):
+    return json.dumps(data, cls=DjangoJSONEncoder, sort_keys=True, separators=(',', ':')).encode()
+
+
+def _write_atomic(path, content):
+    tmpPath = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmpPath, 'wb') as file:
+        file.write(content)
+    os.replace(tmpPath, path)
+
+
+# Writes <prefix>.<hash>.json and its compressed variants. Returns the file name.
+# Nothing is written if a file with the same content already exists.
+def _write_hashed(prefix, content):
+    name = f'{prefix}.{hashlib.sha256(content).hexdigest()[:12]}.json'
+    path = os.path.join(_root(), name)
+    if os.path.exists(path):
+        return name
+
+    # mtime=0 keeps the gzip output identical for identical content
+    _write_atomic(path + '.gz', gzip.compress(content, compresslevel=9, mtime=0))
+    if brotli is not None:
+        _write_atomic(path + '.br', brotli.compress(content))
+    # Written last, so the variants are already there when WhiteNoise first finds the file
+    _write_atomic(path, content)
+    return name
+
+
+def _category_file(category, foodItems):
+    data = {
+        'category': serializers.CategorySerializer(category).data,
+        'foodItems': serializers.FoodItemSerializer(foodItems, many=True).data,
+    }
+    return _write_hashed(f'category-{category.id}', _dumps(data))
+
+
+def _write_index(categories, categoryFiles, previousIndex):
+    index = []
+    for category in categories:
+        data = dict(serializers.CategorySerializer(category).data)
+        data['menu'] = _url(categoryFiles[category.id])
+        index.append(data)
+    indexName = _write_hashed('index', _dumps(index))
+
+    manifest = {
+        'index': _url(indexName),
+        'previousIndex': previousIndex if previousIndex != _url(indexName) else None,
+        'generatedAt': datetime.now().isoformat(timespec='seconds'),
+    }
+    _write_atomic(os.path.join(_root(), MANIFEST_NAME), _dumps(manifest))
+    return manifest
+
+
+# Returns the current manifest, or None if the menu has never been exported
+def read_manifest():
+    try:
+        with open(os.path.join(_root(), MANIFEST_NAME), 'rb') as file:
+            return json.loads(file.read())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _read_index(indexUrl):
+    if not indexUrl:
+        return []
+    name = indexUrl.rsplit('/', 1)[-1]
+    try:
+        with open(os.path.join(_root(), name), 'rb') as file:
+            return json.loads(file.read())
+    except (FileNotFoundError, ValueError):
+        return []
+
+
+# To export the whole menu: one file per category plus the index (2 queries)
+def export_menu():
+    with _exportLock:
+        os.makedirs(_root(), exist_ok=True)
+        previous = read_manifest() or {}
+
+        categories = list(Category.objects.all())
+        foodItems = {}
+        for foodItem in FoodItem.objects.order_by('id'):
+            foodItems.setdefault(foodItem.category_id, []).append(foodItem)
+
+        categoryFiles = {
+            category.id: _category_file(category, foodItems.get(category.id, []))
+            for category in categories
+        }
+        return _write_index(categories, categoryFiles, previous.get('index'))
+
+
+# To re-export a single category after it (or one of its food items) changed.
+# Other categories keep the files referenced by the current index. Falls back to a full export
+# if there is no usable index yet.
+def export_category(categoryId):
+    with _exportLock:
+        previous = read_manifest()
+        if previous is None:
+            exportedFiles = {}
+        else:
+            exportedFiles = {
+                entry['id']: entry['menu'].rsplit('/', 1)[-1]
+                for entry in _read_index(previous.get('index'))
+            }
+
+        categories = list(Category.objects.all())
+        categoryFiles = {}
+        for category in categories:
+            name = exportedFiles.get(category.id)
+            if category.id == categoryId or name is None or not os.path.exists(os.path.join(_root(), name)):
+                os.makedirs(_root(), exist_ok=True)
+                name = _category_file(category, FoodItem.objects.filter(category=category).order_by('id'))
+            categoryFiles[category.id] = name
+        return _write_index(categories, categoryFiles, previous and previous.get('index'))
+
+
+# To delete the exported files which neither the current nor the previous index refer to.
+# The previous generation is kept, so that clients which just read the old manifest can still
+# fetch the files it points at.
+def prune():
+    manifest = read_manifest()
+    if manifest is None:
+        return []
+
+    keep = set()
+    for indexUrl in (manifest.get('index'), manifest.get('previousIndex')):
+        if not indexUrl:
+            continue
+        keep.add(indexUrl.rsplit('/', 1)[-1])
+        keep.update(entry['menu'].rsplit('/', 1)[-1] for entry in _read_index(indexUrl))
+
+    removed = []
+    for name in os.listdir(_root()):
+        baseName = name[:-3] if name.endswith(('.gz', '.br')) else name
+        if HASHED_NAME_REGEX.search(baseName) and baseName not in keep:
+            os.remove(os.path.join(_root(), name))
+            removed.append(name)
+    return removed
+
+
+# On-change hook, called by the Category/FoodItem signals once the write is committed
+def on_catalog_change(categoryId):
+    if getattr(settings, 'MENU_EXPORT_ON_CHANGE', False):
+        export_category(categoryId)
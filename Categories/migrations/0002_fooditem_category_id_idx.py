@@ -0,0 +1,17 @@
+# Generated by Django 5.1.5 on 2026-10-18 21:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Categories', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='fooditem',
+            index=models.Index(fields=['category', 'id'], name='fooditem_category_id_idx'),
+        ),
+    ]
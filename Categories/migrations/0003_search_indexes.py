@@ -0,0 +1,45 @@
+from django.db import migrations
+
+
+# Full-text and trigram indexes used by the Postgres search backend (see Categories/search.py).
+# Other databases use the in-process search index, so nothing is created for them.
+
+FORWARD_SQL = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    # Must stay identical to FOOD_VECTOR_SQL in Categories/search.py, otherwise Postgres won't use it
+    '''CREATE INDEX IF NOT EXISTS fooditem_search_idx ON "Categories_fooditem" USING GIN (
+        (setweight(to_tsvector('simple', name), 'A') || setweight(to_tsvector('simple', description), 'C'))
+    )''',
+    'CREATE INDEX IF NOT EXISTS fooditem_name_trgm_idx ON "Categories_fooditem" USING GIN (name gin_trgm_ops)',
+    '''CREATE INDEX IF NOT EXISTS category_name_search_idx ON "Categories_category" USING GIN (
+        to_tsvector('simple', name)
+    )''',
+    'CREATE INDEX IF NOT EXISTS category_name_trgm_idx ON "Categories_category" USING GIN (name gin_trgm_ops)',
+]
+
+REVERSE_SQL = [
+    'DROP INDEX IF EXISTS fooditem_search_idx',
+    'DROP INDEX IF EXISTS fooditem_name_trgm_idx',
+    'DROP INDEX IF EXISTS category_name_search_idx',
+    'DROP INDEX IF EXISTS category_name_trgm_idx',
+]
+
+
+def run_on_postgres(statements):
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor != 'postgresql':
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Categories', '0002_fooditem_category_id_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(run_on_postgres(FORWARD_SQL), run_on_postgres(REVERSE_SQL)),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.5 on 2026-10-18 21:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Categories', '0003_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='imageVariants',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='fooditem',
+            name='imageVariants',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
@@ -7,6 +7,8 @@ class Category(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="category")
     name = models.CharField(max_length=64) 
     image = models.ImageField(upload_to='images/')
+    # Widths of the resized copies generated for the image (see Categories/images.py)
+    imageVariants = models.JSONField(default=list, blank=True)
 
     def __str__(self):
         return f"{self.user} : {self.name}"
@@ -29,6 +31,14 @@ class FoodItem(models.Model):
     description = models.CharField(max_length=320)
     price = models.DecimalField(max_digits=6, decimal_places=2)
     image = models.ImageField(upload_to='images/')
+    # Widths of the resized copies generated for the image (see Categories/images.py)
+    imageVariants = models.JSONField(default=list, blank=True)
+
+    class Meta:
+        indexes = [
+            # For the keyset pagination of a category's menu (WHERE category_id = ? AND id > ? ORDER BY id)
+            models.Index(fields=['category', 'id'], name='fooditem_category_id_idx'),
+        ]
 
     def __str__(self):
         return f"{self.name}"
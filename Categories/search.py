@@ -0,0 +1,407 @@
+import bisect
+import heapq
+import math
+import re
+import threading
+import time
+import unicodedata
+
+from django.conf import settings
+from django.db import connection
+
+from Categories.models import Category, FoodItem
+
+
+# Ranked search over food items (name, description and the name of their category) and categories.
+#
+# On Postgres the database does the work: a full-text GIN index on the food items and trigram
+# indexes for typo tolerance (see migration 0003_search_indexes).
+# On other databases (SQLite in development) an in-process inverted index is used instead. It is
+# built from the database on the first search and then kept in sync by the Category/FoodItem
+# signals of this process. Other processes pick up changes when their index gets rebuilt, after
+# SEARCH_INDEX_MAX_AGE seconds.
+#
+# Both backends support prefix matching ("pan" finds "Paneer") and typo tolerance ("panner"
+# finds "Paneer"), and return ids ranked from the best match.
+
+TOKEN_REGEX = re.compile(r'\w+')
+
+# Weight of each field in the score of a document
+FOOD_NAME_WEIGHT = 3.0
+FOOD_CATEGORY_WEIGHT = 1.5
+FOOD_DESCRIPTION_WEIGHT = 1.0
+CATEGORY_NAME_WEIGHT = 3.0
+
+# How much a query term matching a document term exactly, as a prefix or with a typo counts
+EXACT_MATCH = 1.0
+PREFIX_MATCH = 0.7
+FUZZY_MATCH = 0.5
+
+# Bounds keeping the cost of a query independent of the size of the catalog
+MAX_QUERY_TERMS = 8
+MAX_PREFIX_EXPANSIONS = 50
+MAX_FUZZY_EXPANSIONS = 20
+
+
+def tokenize(text):
+    # Lowercase and strip accents, so that "Crème" matches "creme"
+    text = text.lower()
+    if not text.isascii():
+        text = unicodedata.normalize('NFKD', text)
+        text = ''.join(char for char in text if not unicodedata.combining(char))
+    return TOKEN_REGEX.findall(text)
+
+
+# Words shorter than 4 letters must match exactly (or as a prefix), longer ones can have typos
+def _max_typos(term):
+    if len(term) < 4:
+        return 0
+    if len(term) < 8:
+        return 1
+    return 2
+
+
+def _deletes(term):
+    return {term[:i] + term[i + 1:] for i in range(len(term))}
+
+
+# Optimal string alignment distance (Levenshtein plus transpositions), giving up above maxDistance
+def _edit_distance(a, b, maxDistance):
+    if abs(len(a) - len(b)) > maxDistance:
+        return maxDistance + 1
+    previousRow = None
+    row = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        previousRow, row = row, [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            row[j] = min(previousRow[j] + 1, row[j - 1] + 1, previousRow[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                row[j] = min(row[j], beforePreviousRow[j - 2] + 1)
+        if min(row) > maxDistance:
+            return maxDistance + 1
+        beforePreviousRow = previousRow
+    return row[-1]
+
+
+class InMemorySearchIndex:
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        # term -> {document key: weighted term frequency}. Document keys are ('food', id) or ('category', id)
+        self.postings = {}
+        # Sorted vocabulary, for prefix lookups
+        self.terms = []
+        # Variant of a term with one letter removed -> terms, for typo tolerant lookups
+        self.deletes = {}
+        # document key -> (terms, length)
+        self.documents = {}
+        self.totalLength = 0
+        # Data needed to reindex the food items of a category when it is renamed
+        self.foods = {}
+        self.categoryNames = {}
+        self.categoryFoods = {}
+        self.builtAt = None
+
+    # ---- Building and incremental updates ----
+
+    def build(self):
+        foods = FoodItem.objects.values_list('id', 'name', 'description', 'category_id')
+        categories = Category.objects.values_list('id', 'name')
+        with self.lock:
+            self.clear()
+            for categoryId, name in categories:
+                self._index_category(categoryId, name)
+            for foodId, name, description, categoryId in foods:
+                self._index_food(foodId, name, description, categoryId)
+            self.builtAt = time.monotonic()
+
+    def is_stale(self):
+        maxAge = getattr(settings, 'SEARCH_INDEX_MAX_AGE', 300)
+        return self.builtAt is None or time.monotonic() - self.builtAt > maxAge
+
+    def update_food(self, foodId, name, description, categoryId):
+        with self.lock:
+            self._index_food(foodId, name, description, categoryId)
+
+    def remove_food(self, foodId):
+        with self.lock:
+            self._remove_food(foodId)
+
+    def update_category(self, categoryId, name):
+        with self.lock:
+            self._index_category(categoryId, name)
+            # The category name is part of its food items
+            for foodId in list(self.categoryFoods.get(categoryId, ())):
+                foodName, description, _ = self.foods[foodId]
+                self._index_food(foodId, foodName, description, categoryId)
+
+    def remove_category(self, categoryId):
+        with self.lock:
+            for foodId in list(self.categoryFoods.get(categoryId, ())):
+                self._remove_food(foodId)
+            self._remove_document(('category', categoryId))
+            self.categoryNames.pop(categoryId, None)
+            self.categoryFoods.pop(categoryId, None)
+
+    def _index_category(self, categoryId, name):
+        self.categoryNames[categoryId] = name
+        self._add_document(('category', categoryId), [(name, CATEGORY_NAME_WEIGHT)])
+
+    def _index_food(self, foodId, name, description, categoryId):
+        self._remove_food(foodId)
+        self.foods[foodId] = (name, description, categoryId)
+        self.categoryFoods.setdefault(categoryId, set()).add(foodId)
+        self._add_document(('food', foodId), [
+            (name, FOOD_NAME_WEIGHT),
+            (self.categoryNames.get(categoryId, ''), FOOD_CATEGORY_WEIGHT),
+            (description, FOOD_DESCRIPTION_WEIGHT),
+        ])
+
+    def _remove_food(self, foodId):
+        food = self.foods.pop(foodId, None)
+        if food is not None:
+            self.categoryFoods.get(food[2], set()).discard(foodId)
+        self._remove_document(('food', foodId))
+
+    def _add_document(self, key, fields):
+        self._remove_document(key)
+        frequencies = {}
+        length = 0
+        for text, weight in fields:
+            for term in tokenize(text):
+                frequencies[term] = frequencies.get(term, 0) + weight
+                length += 1
+
+        for term, frequency in frequencies.items():
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = {}
+                bisect.insort(self.terms, term)
+                for variant in _deletes(term):
+                    self.deletes.setdefault(variant, set()).add(term)
+            postings[key] = frequency
+
+        self.documents[key] = (tuple(frequencies), length)
+        self.totalLength += length
+
+    def _remove_document(self, key):
+        document = self.documents.pop(key, None)
+        if document is None:
+            return
+        terms, length = document
+        self.totalLength -= length
+        for term in terms:
+            postings = self.postings[term]
+            postings.pop(key, None)
+            if not postings:
+                del self.postings[term]
+                del self.terms[bisect.bisect_left(self.terms, term)]
+                for variant in _deletes(term):
+                    variantTerms = self.deletes[variant]
+                    variantTerms.discard(term)
+                    if not variantTerms:
+                        del self.deletes[variant]
+
+    # ---- Querying ----
+
+    # Terms of the index matching a query term, with how well they match
+    def _expand(self, queryTerm):
+        matches = {}
+        if queryTerm in self.postings:
+            matches[queryTerm] = EXACT_MATCH
+
+        start = bisect.bisect_left(self.terms, queryTerm)
+        for term in self.terms[start:start + MAX_PREFIX_EXPANSIONS + 1]:
+            if not term.startswith(queryTerm):
+                break
+            matches.setdefault(term, PREFIX_MATCH)
+
+        maxTypos = _max_typos(queryTerm)
+        if maxTypos:
+            candidates = set(self.deletes.get(queryTerm, ()))
+            for variant in _deletes(queryTerm):
+                if variant in self.postings:
+                    candidates.add(variant)
+                candidates.update(self.deletes.get(variant, ()))
+            fuzzy = sorted(
+                (term for term in candidates
+                 if term not in matches and _edit_distance(queryTerm, term, maxTypos) <= maxTypos),
+                key=lambda term: -len(self.postings[term]),
+            )
+            for term in fuzzy[:MAX_FUZZY_EXPANSIONS]:
+                matches[term] = FUZZY_MATCH
+        return matches
+
+    # Returns {'food': [ids], 'category': [ids]}, best matches first
+    def search(self, query, limit):
+        queryTerms = list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TERMS]
+        results = {'food': [], 'category': []}
+        if not queryTerms:
+            return results
+
+        with self.lock:
+            documentCount = len(self.documents) or 1
+            averageLength = self.totalLength / documentCount or 1
+            scores = {}
+            matchedTerms = {}
+            for queryTerm in queryTerms:
+                best = {}
+                for term, quality in self._expand(queryTerm).items():
+                    postings = self.postings[term]
+                    idf = math.log(1 + (documentCount - len(postings) + 0.5) / (len(postings) + 0.5))
+                    for key, frequency in postings.items():
+                        length = self.documents[key][1]
+                        norm = self.K1 * (1 - self.B + self.B * length / averageLength)
+                        score = quality * idf * frequency * (self.K1 + 1) / (frequency + norm)
+                        if score > best.get(key, 0):
+                            best[key] = score
+                for key, score in best.items():
+                    scores[key] = scores.get(key, 0) + score
+                    matchedTerms[key] = matchedTerms.get(key, 0) + 1
+
+        # Documents matching more of the query terms always come first
+        for kind in results:
+            ranked = heapq.nlargest(
+                limit,
+                (key for key in scores if key[0] == kind),
+                key=lambda key: (matchedTerms[key], scores[key], -key[1]),
+            )
+            results[kind] = [key[1] for key in ranked]
+        return results
+
+
+# Index of this process. Built on the first search, then rebuilt in the background when it gets
+# stale, so that searches keep being answered by the previous index in the meantime
+_index = None
+_indexLock = threading.Lock()
+_rebuilding = False
+
+
+def _rebuild(inBackground=False):
+    global _index, _rebuilding
+    try:
+        index = InMemorySearchIndex()
+        index.build()
+        _index = index
+    finally:
+        _rebuilding = False
+        if inBackground:
+            # The thread's own database connection would otherwise stay open
+            connection.close()
+
+
+def _get_index():
+    global _rebuilding
+    if _index is None:
+        with _indexLock:
+            if _index is None:
+                _rebuilding = True
+                _rebuild()
+    elif _index.is_stale() and not _rebuilding:
+        with _indexLock:
+            if not _rebuilding:
+                _rebuilding = True
+                threading.Thread(target=_rebuild, args=(True,), name='search-index-rebuild', daemon=True).start()
+    return _index
+
+
+# ---- Postgres backend ----
+
+# Must stay identical to the expression of the fooditem_search_idx index (migration 0003_search_indexes)
+FOOD_VECTOR_SQL = (
+    "(setweight(to_tsvector('simple', f.name), 'A') || setweight(to_tsvector('simple', f.description), 'C'))"
+)
+
+POSTGRES_FOOD_QUERY = f'''
+WITH q AS (SELECT to_tsquery('simple', %(tsquery)s) AS query),
+matches AS (
+    SELECT f.id FROM "Categories_fooditem" f, q WHERE {FOOD_VECTOR_SQL} @@ q.query
+    UNION
+    SELECT f.id FROM "Categories_fooditem" f WHERE %(text)s <%% f.name
+    UNION
+    SELECT f.id FROM "Categories_fooditem" f JOIN "Categories_category" c ON c.id = f.category_id, q
+    WHERE to_tsvector('simple', c.name) @@ q.query OR %(text)s <%% c.name
+)
+SELECT f.id
+FROM matches m
+JOIN "Categories_fooditem" f ON f.id = m.id
+JOIN "Categories_category" c ON c.id = f.category_id, q
+ORDER BY
+    ts_rank({FOOD_VECTOR_SQL}, q.query) * 2
+    + CASE WHEN to_tsvector('simple', c.name) @@ q.query THEN 0.5 ELSE 0 END
+    + word_similarity(%(text)s, f.name) DESC,
+    f.id
+LIMIT %(limit)s
+'''
+
+POSTGRES_CATEGORY_QUERY = '''
+WITH q AS (SELECT to_tsquery('simple', %(tsquery)s) AS query)
+SELECT c.id
+FROM "Categories_category" c, q
+WHERE to_tsvector('simple', c.name) @@ q.query OR %(text)s <%% c.name
+ORDER BY ts_rank(to_tsvector('simple', c.name), q.query) + word_similarity(%(text)s, c.name) DESC, c.id
+LIMIT %(limit)s
+'''
+
+
+def _postgres_search(query, limit):
+    queryTerms = list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TERMS]
+    results = {'food': [], 'category': []}
+    if not queryTerms:
+        return results
+
+    params = {
+        # Every term has to match, each one as a prefix. Terms only contain word characters
+        'tsquery': ' & '.join(f'{term}:*' for term in queryTerms),
+        'text': ' '.join(queryTerms),
+        'limit': limit,
+    }
+    with connection.cursor() as cursor:
+        cursor.execute(POSTGRES_FOOD_QUERY, params)
+        results['food'] = [row[0] for row in cursor.fetchall()]
+        cursor.execute(POSTGRES_CATEGORY_QUERY, params)
+        results['category'] = [row[0] for row in cursor.fetchall()]
+    return results
+
+
+def uses_postgres():
+    return connection.vendor == 'postgresql'
+
+
+# To search the catalog. Returns {'food': [ids], 'category': [ids]}, best matches first
+def search(query, limit=20):
+    if uses_postgres():
+        return _postgres_search(query, limit)
+    return _get_index().search(query, limit)
+
+
+# ---- Incremental updates, called by the Category/FoodItem signals ----
+
+def on_food_saved(food):
+    # Nothing to update before the first search, the index will be built from the database
+    if _index is not None and not uses_postgres():
+        _index.update_food(food.id, food.name, food.description, food.category_id)
+
+
+def on_food_deleted(foodId):
+    # Nothing to update before the first search, the index will be built from the database
+    if _index is not None and not uses_postgres():
+        _index.remove_food(foodId)
+
+
+def on_category_saved(category):
+    # Nothing to update before the first search, the index will be built from the database
+    if _index is not None and not uses_postgres():
+        _index.update_category(category.id, category.name)
+
+
+def on_category_deleted(categoryId):
+    # Nothing to update before the first search, the index will be built from the database
+    if _index is not None and not uses_postgres():
+        _index.remove_category(categoryId)
@@ -0,0 +1,104 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_init, post_save, pre_save
+from django.dispatch import receiver
+
+from Categories import cache as catalogCache
+from Categories import images
+from Categories import menu_export
+from Categories import search
+from Categories.models import Category, FoodItem, Stripe
+
+
+# Remember the category a food item was loaded with, so that moving it to another category
+# invalidates both menus without an extra query
+@receiver(post_init, sender=FoodItem)
+def remember_food_category(sender, instance, **kwargs):
+    instance._loadedCategoryId = instance.category_id
+
+
+# Remember the image a row was loaded with, to only resize newly uploaded images
+@receiver(post_init, sender=FoodItem)
+@receiver(post_init, sender=Category)
+def remember_image(sender, instance, **kwargs):
+    instance._loadedImage = instance.image.name
+
+
+@receiver(pre_save, sender=FoodItem)
+@receiver(pre_save, sender=Category)
+def reset_image_variants(sender, instance, raw=False, **kwargs):
+    # A new row, a freshly uploaded file (not yet written to the storage) or a different file name
+    instance._imageChanged = not raw and (
+        instance._state.adding
+        or not instance.image._committed
+        or instance.image.name != instance._loadedImage
+    )
+    if instance._imageChanged:
+        # The resized copies belong to the previous image
+        instance.imageVariants = []
+
+
+# Generates the resized copies of a new image in the background (Categories/images.py)
+@receiver(post_save, sender=FoodItem)
+@receiver(post_save, sender=Category)
+def resize_image(sender, instance, **kwargs):
+    if getattr(instance, '_imageChanged', False) and instance.image:
+        images.schedule(instance)
+    instance._imageChanged = False
+    instance._loadedImage = instance.image.name
+
+
+# Covers every write path: the partner views (add/update/delete food item), the admin and the shell
+@receiver(post_save, sender=FoodItem)
+@receiver(post_delete, sender=FoodItem)
+def invalidate_food_category(sender, instance, **kwargs):
+    categoryIds = {instance.category_id}
+    previousCategoryId = getattr(instance, '_loadedCategoryId', None)
+    if previousCategoryId is not None:
+        categoryIds.add(previousCategoryId)
+    instance._loadedCategoryId = instance.category_id
+
+    for categoryId in categoryIds:
+        catalogCache.invalidate_category(categoryId)
+        # Re-export the static menu file of the category (no-op unless MENU_EXPORT_ON_CHANGE is set)
+        transaction.on_commit(lambda categoryId=categoryId: menu_export.on_catalog_change(categoryId))
+
+
+# Keeps the in-process search index in sync (the Postgres backend relies on database indexes instead)
+@receiver(post_save, sender=FoodItem)
+def index_food(sender, instance, **kwargs):
+    transaction.on_commit(lambda: search.on_food_saved(instance))
+
+
+@receiver(post_delete, sender=FoodItem)
+def unindex_food(sender, instance, **kwargs):
+    foodId = instance.id
+    transaction.on_commit(lambda: search.on_food_deleted(foodId))
+
+
+@receiver(post_save, sender=Category)
+def index_category(sender, instance, **kwargs):
+    transaction.on_commit(lambda: search.on_category_saved(instance))
+
+
+@receiver(post_delete, sender=Category)
+def unindex_category(sender, instance, **kwargs):
+    categoryId = instance.id
+    transaction.on_commit(lambda: search.on_category_deleted(categoryId))
+
+
+# A category shows up in the category list as well as in its own info/menu entries
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_category(sender, instance, **kwargs):
+    # The id is read now, as a deleted instance has lost it by the time the transaction commits
+    categoryId = instance.id
+    catalogCache.invalidate_category_list()
+    catalogCache.invalidate_category(categoryId)
+    transaction.on_commit(lambda: menu_export.on_catalog_change(categoryId))
+
+
+# The checkout reads the Stripe account of a category from the cache (see checkout.get_quote)
+@receiver(post_save, sender=Stripe)
+@receiver(post_delete, sender=Stripe)
+def invalidate_payout_account(sender, instance, **kwargs):
+    catalogCache.invalidate_category(instance.category_id)
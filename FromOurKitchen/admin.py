@@ -1,12 +1,16 @@
 from django.contrib import admin
-from .models import Cart, Address, ActiveOrders, MobileNumber
+from .models import Cart, UserCart, Address, ActiveOrders, OrderLine, MobileNumber, Notification, StripeEvent
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.contrib.auth.models import User
 
 # For admin view
 admin.site.register(ActiveOrders)
+admin.site.register(OrderLine)
 admin.site.register(Cart)
+admin.site.register(UserCart)
 admin.site.register(Address)
+admin.site.register(Notification)
+admin.site.register(StripeEvent)
 
 
 # To display the user's phone number as a field in the admin view of user's model
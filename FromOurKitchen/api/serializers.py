@@ -1,11 +1,16 @@
 from rest_framework.serializers import ModelSerializer
 from Categories.api.serializers import CategorySerializer, FoodItemSerializer
-from FromOurKitchen.models import Cart, Address, User, ActiveOrders
+from FromOurKitchen.models import Cart, Address, User, ActiveOrders, OrderLine, rupees
 from rest_framework import serializers
+from django.db.models import OuterRef, Prefetch, Subquery, Sum
+from django.db.models.functions import Coalesce
 
 # Creates JSON objects out of the Python objects
 class CartSerializer(ModelSerializer):
     food = FoodItemSerializer(read_only=True)
+    # Stored in paise, returned in rupees (see the Cart model)
+    amount = serializers.DecimalField(max_digits=6, decimal_places=2, read_only=True)
+    totalAmount = serializers.DecimalField(max_digits=7, decimal_places=2, read_only=True)
     class Meta:
         model = Cart
         fields = ['id', 'user', 'food', 'qty', 'amount', 'totalAmount']
@@ -23,10 +28,65 @@ class UserSerializer(ModelSerializer):
         fields = ['email', 'username', 'first_name', 'last_name']
 
 
+# An order line, in the shape of a cart item (CartSerializer), from the copy of the food item made
+# when the order was placed. totalAmount is the total of the order
+class OrderLineSerializer(ModelSerializer):
+    user = serializers.IntegerField(source='order.user_id', read_only=True)
+    food = serializers.SerializerMethodField()
+    amount = serializers.DecimalField(max_digits=7, decimal_places=2, read_only=True)
+    totalAmount = serializers.DecimalField(source='order.totalAmount', max_digits=8, decimal_places=2, read_only=True)
+
+    class Meta:
+        model = OrderLine
+        fields = ['id', 'user', 'food', 'qty', 'amount', 'totalAmount']
+
+    def get_food(self, line):
+        return {
+            'id': line.food_id,
+            'name': line.name,
+            'price': str(line.price),
+            'image': line.image.url if line.image else None,
+        }
+
+
 class ActiveOrdersSerializer(ModelSerializer):
-    cart = CartSerializer(read_only=True, many=True)
+    # The order lines, named cart as the cart items used to be
+    cart = OrderLineSerializer(source='lines', many=True, read_only=True)
     address = AddressSerializer(read_only=True)
+    totalAmount = serializers.DecimalField(max_digits=8, decimal_places=2, read_only=True)
     
     class Meta:
         model = ActiveOrders
-        fields = ['id', 'cart', 'address', 'date', 'time', 'active']
+        fields = ['id', 'cart', 'totalAmount', 'address', 'date', 'time', 'active']
+
+    # To load everything the serializer reads along with the orders (2 queries in total, whatever the number of orders)
+    @staticmethod
+    def prefetch(orders):
+        return orders.select_related('address').prefetch_related(Prefetch('lines', queryset=OrderLine.objects.order_by('id')))
+
+
+# ActiveOrdersSerializer with the time of the last change, for the order board of a category
+class OrderBoardSerializer(ActiveOrdersSerializer):
+    class Meta(ActiveOrdersSerializer.Meta):
+        fields = ActiveOrdersSerializer.Meta.fields + ['updated']
+
+
+# Compact version of ActiveOrdersSerializer: the number of items and the total of each order,
+# without the cart items
+class ActiveOrdersSummarySerializer(ModelSerializer):
+    itemCount = serializers.IntegerField(read_only=True)
+    totalAmount = serializers.SerializerMethodField()
+    address = AddressSerializer(read_only=True)
+
+    class Meta:
+        model = ActiveOrders
+        fields = ['id', 'itemCount', 'totalAmount', 'address', 'date', 'time', 'active']
+
+    # To count the items of each order in the same query as the orders
+    @staticmethod
+    def annotate(orders):
+        itemCount = OrderLine.objects.filter(order=OuterRef('pk')).values('order').annotate(qty=Sum('qty')).values('qty')
+        return orders.select_related('address').annotate(itemCount=Coalesce(Subquery(itemCount), 0))
+
+    def get_totalAmount(self, order):
+        return str(rupees(order.totalPaise))
@@ -1,3 +1,1379 @@
-from django.test import TestCase
+import asyncio
+import json
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import stripe
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import Group, User
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import OperationalError, connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+
+from Categories.models import Category, FoodItem, Stripe
+from Categories import search as catalogSearch
+from FromOurKitchen import archive as orderArchive
+from FromOurKitchen import cart as userCart
+from FromOurKitchen import checkout as userCheckout
+from FromOurKitchen import notifications
+from FromOurKitchen import stripe_events as stripeEvents
+from FromOurKitchen import orders as userOrders
+from FromOurKitchen import otp
+from FromOurKitchen.management.commands import generate_stripe_events as generateStripeEvents
+from FromOurKitchen.models import ActiveOrders, Address, Cart, CheckoutSession, MobileNumber, Notification, OneTimeCode, OrderArchivePartition, OrderLine, StripeEvent, UserCart
+from crud import events, gateways, ratelimit, revocation, tokens
+from crud.querybudget import QueryBudgetMixin
+from crud.storage import ContentAddressedStorage
+
+MEDIA_ROOT = tempfile.mkdtemp()
+
+
+# Query budgets of the customer API routes (FromOurKitchen/api/urls.py).
+# Every route is requested with 1 and with 100 rows (categories, food items, cart items, addresses
+# and orders), and has to stay within the same fixed budget: a query run per row (N+1) fails the test.
+# Requests are authenticated with a JWT, which costs 1 query (the user), except on the read-only
+# routes authenticated with its claims alone (see crud/tokens.py).
+@override_settings(
+    MEDIA_ROOT=MEDIA_ROOT,
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+    MENU_EXPORT_ON_CHANGE=False,
+    OTP_PROVIDER='FromOurKitchen.notifications.FakeProvider',
+)
+class QueryBudgetTests(QueryBudgetMixin, TestCase):
+    ROWS = (1, 100)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+
+    def setUp(self):
+        self.user = User.objects.create_user('customer', 'customer@example.com', 'password')
+        MobileNumber.objects.create(user=self.user, number=9876543210)
+        self.partner = User.objects.create_user('partner@example.com', 'partner@example.com', 'password')
+        self.category = Category.objects.create(user=self.partner, name='Pizza', image='images/pizza.jpg')
+        Stripe.objects.create(category=self.category, accountID='acct_test')
+        self.address = Address.objects.create(user=self.user, area='Jammu', label='HOME')
+        self.token = str(RefreshToken.for_user(self.user).access_token)
+
+    # To top up the rows of every kind to n
+    def populate(self, n):
+        categories = Category.objects.count()
+        Category.objects.bulk_create([
+            Category(user=self.partner, name=f'Category {number}', image='images/category.jpg')
+            for number in range(categories, n)
+        ])
+        foodItems = FoodItem.objects.count()
+        FoodItem.objects.bulk_create([
+            FoodItem(category=self.category, name=f'Paneer {number}', description='Paneer pizza', price='120.50', image='images/food.jpg')
+            for number in range(foodItems, n)
+        ])
+        inCart = set(Cart.objects.filter(user=self.user).values_list('food_id', flat=True))
+        newItems = [
+            Cart(user=self.user, food=food, qty=2, pricePaise=12050, amountPaise=24100)
+            for food in FoodItem.objects.order_by('id')[:n] if food.id not in inCart
+        ]
+        Cart.objects.bulk_create(newItems)
+        UserCart.objects.update_or_create(user=self.user, defaults={'totalPaise': 24100 * Cart.objects.filter(user=self.user).count()})
+        Address.objects.bulk_create([
+            Address(user=self.user, area=f'Area {number}', label='WORK') for number in range(Address.objects.count(), n)
+        ])
+        cart = list(Cart.objects.filter(user=self.user).select_related('food')[:3])
+        for number in range(ActiveOrders.objects.count(), n):
+            order = ActiveOrders.objects.create(user=self.user, address=self.address, totalPaise=24100 * len(cart))
+            OrderLine.objects.bulk_create([OrderLine.from_cart(order, item) for item in cart])
+
+        # Every request reads from the database, not from the catalog cache or the search index
+        caches[settings.CATALOG_CACHE_ALIAS].clear()
+        catalogSearch._index = None
+
+    def auth(self):
+        return {'HTTP_AUTHORIZATION': f'Bearer {self.token}'}
+
+    # Requests the route with 1 and then 100 rows, within the budget each time.
+    # What prepare() returns (outside of the budget) is passed to request()
+    def assertRouteBudget(self, budget, request, status=200, prepare=None):
+        for n in self.ROWS:
+            with self.subTest(rows=n):
+                self.populate(n)
+                args = [prepare()] if prepare else []
+                with self.assertQueryBudget(budget):
+                    response = request(*args)
+                self.assertEqual(response.status_code, status, getattr(response, 'data', response))
+
+    def test_routes(self):
+        self.assertRouteBudget(0, lambda: self.client.get('/api/'))
+
+    def test_register(self):
+        count = iter(range(1000))
+        def register():
+            number = next(count)
+            return self.client.post('/api/register/', {
+                'username': f'user{number}', 'email': f'user{number}@example.com', 'number': 9000000000 + number,
+                'password': 'password', 'confirmPassword': 'password',
+            })
+        self.assertRouteBudget(6, register)
+
+    def test_token(self):
+        self.assertRouteBudget(3, lambda: self.client.post('/api/token/', {'username': 'customer', 'password': 'password'}))
+
+    def test_token_refresh(self):
+        def refresh(token):
+            return self.client.post('/api/token/refresh/', {'refresh': token})
+        # The user, the rotated token blacklisted (its outstanding row, then the insert in a savepoint), and
+        # a sync of the revocation filter (at most every TOKEN_REVOCATION_SYNC_INTERVAL seconds) instead
+        # of a blacklist lookup (see crud/revocation.py)
+        self.assertRouteBudget(6, refresh, prepare=lambda: str(RefreshToken.for_user(self.user)))
+
+    def test_custom_login(self):
+        self.assertRouteBudget(3, lambda: self.client.post('/api/custom-login/', {'number': 9876543210}))
+
+    def test_mobile_send_message(self):
+        count = iter(range(1000))
+        # The code of the number issued locally (looked up, then inserted in a savepoint), in a savepoint.
+        # Then the message is sent, without a query
+        self.assertRouteBudget(6, lambda: self.client.post('/api/mobile-send-message/', {'number': f'91987654{next(count):04d}'}))
+
+    def test_mobile_verification(self):
+        count = iter(range(1000))
+        def issue():
+            number = f'91987654{next(count):04d}'
+            return number, otp.issue('+' + number)
+        # The code of the number locked and checked locally, in a savepoint
+        self.assertRouteBudget(4, lambda args: self.client.post('/api/mobile-verification/', {'number': args[0], 'code': args[1]}), prepare=issue)
+
+    def test_category(self):
+        self.assertRouteBudget(1, lambda: self.client.get('/api/category/'))
+        self.assertRouteBudget(1, lambda: self.client.get('/api/category/?page_size=100'))
+
+    def test_categories_food(self):
+        self.assertRouteBudget(2, lambda: self.client.get(f'/api/category/{self.category.id}'))
+        self.assertRouteBudget(2, lambda: self.client.get(f'/api/category/{self.category.id}?page_size=100'))
+
+    def test_category_info(self):
+        self.assertRouteBudget(1, lambda: self.client.get(f'/api/category/info/{self.category.id}'))
+
+    def test_catalog_cache_stats(self):
+        self.user.is_staff = True
+        self.user.save()
+        self.assertRouteBudget(1, lambda: self.client.get('/api/catalog/cache-stats/', **self.auth()))
+
+    def test_query_stats(self):
+        self.user.is_staff = True
+        self.user.save()
+        self.assertRouteBudget(1, lambda: self.client.get('/api/query-stats/', **self.auth()))
+
+    def test_notification_stats(self):
+        self.user.is_staff = True
+        self.user.save()
+        self.assertRouteBudget(5, lambda: self.client.get('/api/notification-stats/', **self.auth()))
+
+    def test_rate_limit_stats(self):
+        self.user.is_staff = True
+        self.user.save()
+        # An admin token, authenticated with its claims
+        token = str(tokens.add_claims(AccessToken.for_user(self.user), self.user))
+        self.assertRouteBudget(0, lambda: self.client.get('/api/rate-limit-stats/', HTTP_AUTHORIZATION=f'Bearer {token}'))
+        self.assertEqual(self.client.get('/api/rate-limit-stats/', **self.auth()).status_code, 403)
+
+    def test_menu_manifest(self):
+        with override_settings(MENU_EXPORT_ROOT=MEDIA_ROOT):
+            self.assertRouteBudget(0, lambda: self.client.get('/api/menu/manifest/'), status=404)
+
+    def test_search(self):
+        # Building the search index (2 queries), then the matched rows (2 queries)
+        self.assertRouteBudget(4, lambda: self.client.get('/api/search/?q=paneer'))
+
+    def test_get_cart_items(self):
+        self.assertRouteBudget(1, lambda: self.client.get('/api/get-cart-items/', **self.auth()))
+
+    def test_add_to_cart(self):
+        # Transaction savepoint, 2 upserts, then the added item
+        def addToCart(foodId):
+            return self.client.post(f'/api/add-to-cart/{foodId}', **self.auth())
+        self.assertRouteBudget(6, addToCart, prepare=lambda: FoodItem.objects.last().id)
+
+    def test_remove_from_cart(self):
+        def removeFromCart(foodId):
+            return self.client.post(f'/api/remove-from-cart/{foodId}', **self.auth())
+        self.assertRouteBudget(5, removeFromCart, prepare=lambda: FoodItem.objects.first().id)
+
+    def test_update_cart(self):
+        # Prices, insert of the missing items, locked items, their update and the total, inside a savepoint,
+        # then the updated cart
+        def updateCart(foodIds):
+            return self.client.post('/api/update-cart/', {'items': [
+                {'food_id': foodIds[0], 'delta': 1}, {'food_id': foodIds[0], 'delta': 1},
+                {'food_id': foodIds[-1], 'qty': 5}, {'food_id': foodIds[-1], 'delta': -1},
+            ]}, content_type='application/json', **self.auth())
+        self.assertRouteBudget(9, updateCart, prepare=lambda: list(FoodItem.objects.values_list('id', flat=True)))
+
+    def test_add_address(self):
+        self.assertRouteBudget(2, lambda: self.client.post('/api/add-address/', {'area': 'Jammu', 'label': 'HOME'}, **self.auth()))
+
+    def test_get_address(self):
+        self.assertRouteBudget(1, lambda: self.client.get('/api/get-address/', **self.auth()))
+
+    @override_settings(STRIPE_CHECKOUT_ACCOUNT='acct_platform')
+    @mock.patch.object(stripe.checkout.Session, 'create_async')
+    def test_checkout(self, create):
+        create.return_value.id = 'cs_test'
+        create.return_value.url = 'https://checkout.stripe.com/test'
+        def checkout():
+            return self.client.post('/api/checkout/', {'address': {'id': self.address.id}}, content_type='application/json', **self.auth())
+        # A new session each time, the cart changing (1 then 100 items). The user, the cart items (with
+        # their food item and category), no session for them, the Stripe account (not cached yet), the
+        # user's last order (for the idempotency key), the expired sessions deleted and the pending one
+        # saved (in a savepoint), then once Stripe answered, the pending session completed
+        self.assertRouteBudget(10, checkout, status=303)
+        self.assertEqual(len(create.call_args.kwargs['line_items']), 100)
+        self.assertEqual(len({call.kwargs['idempotency_key'] for call in create.call_args_list}), 2)
+
+        # The same cart again: the session created for it
+        self.assertRouteBudget(6, checkout, status=303)
+        self.assertEqual(create.call_count, 2)
+
+    @mock.patch.object(stripe.Webhook, 'construct_event')
+    def test_webhook(self, constructEvent):
+        count = iter(range(1000))
+        def webhook():
+            event = {
+                'id': f'evt_{next(count)}', 'type': 'checkout.session.completed',
+                'data': {'object': {
+                    'id': 'cs_test', 'payment_intent': 'pi_test', 'amount_total': 24100 * 100,
+                    'metadata': {'user': str(self.user.id), 'addressID': str(self.address.id)},
+                }},
+            }
+            constructEvent.return_value = event
+            return self.client.post('/api/webhook/', json.dumps(event), content_type='application/json', HTTP_STRIPE_SIGNATURE='t=1,v1=test')
+        # Inside a savepoint: the event saved, processed later
+        self.assertRouteBudget(3, webhook)
+        self.assertEqual(StripeEvent.objects.filter(status=StripeEvent.PENDING).count(), 2)
+
+        # Processing the events: a single order for the checkout session, of the cart with 100 items
+        checkoutSession, = generateStripeEvents.build_sessions(self.user, 1)
+        checkoutSession.sessionId = 'cs_test'
+        checkoutSession.save()
+        self.assertEqual(stripeEvents.process_events(), (2, 0))
+        order = ActiveOrders.objects.get(checkoutSession='cs_test')
+        self.assertEqual(order.lines.count(), 100)
+        self.assertEqual(order.totalPaise, 24100 * 100)
+        self.assertEqual(order.category_id, self.category.id)
+        self.assertEqual(Notification.objects.get(key=f'order.placed:{order.id}').body, 'From Our Kitchen: Order Placed (100 item(s), Rs.24100.00).\nHappy Eating!')
+        self.assertEqual(userCart.get_total(self.user), 0)
+
+    def test_get_orders(self):
+        # The whole history, and its last page, look up the archive partitions (none here)
+        self.assertRouteBudget(3, lambda: self.client.get('/api/get-orders/', **self.auth()))
+        self.assertRouteBudget(3, lambda: self.client.get('/api/get-orders/?page_size=100', **self.auth()))
+        self.assertRouteBudget(2, lambda: self.client.get('/api/get-orders/?summary=1', **self.auth()))
+        self.assertRouteBudget(2, lambda: self.client.get('/api/get-orders/?summary=1&page_size=100', **self.auth()))
+
+    def test_get_user_info(self):
+        self.assertRouteBudget(1, lambda: self.client.get('/api/get-user-info/', **self.auth()))
+
+
+# The cart mutations (FromOurKitchen/cart.py): the total of the user's cart is always the sum of the
+# amounts of its items
+class CartTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('customer', 'customer@example.com', 'password')
+        partner = User.objects.create_user('partner@example.com', 'partner@example.com', 'password')
+        category = Category.objects.create(user=partner, name='Pizza', image='images/pizza.jpg')
+        self.paneer = FoodItem.objects.create(category=category, name='Paneer', description='Paneer pizza', price='120.50', image='images/food.jpg')
+        self.dosa = FoodItem.objects.create(category=category, name='Dosa', description='Masala dosa', price='99.99', image='images/food.jpg')
+
+    def items(self):
+        return {item.food_id: (item.qty, item.pricePaise, item.amountPaise) for item in Cart.objects.filter(user=self.user)}
+
+    def assertTotal(self, totalPaise):
+        self.assertEqual(userCart.get_total(self.user), totalPaise)
+        self.assertEqual(sum(amountPaise for qty, pricePaise, amountPaise in self.items().values()), totalPaise)
+
+    def test_add_and_remove(self):
+        self.assertTrue(userCart.add_item(self.user, self.paneer.id))
+        self.assertTrue(userCart.add_item(self.user, self.paneer.id))
+        self.assertTrue(userCart.add_item(self.user, self.dosa.id))
+        self.assertEqual(self.items(), {self.paneer.id: (2, 12050, 24100), self.dosa.id: (1, 9999, 9999)})
+        self.assertTotal(34099)
+        self.assertFalse(userCart.add_item(self.user, 0))
+
+        # The price when the item was added, until it's removed
+        FoodItem.objects.filter(id=self.paneer.id).update(price='130.00')
+        userCart.add_item(self.user, self.paneer.id)
+        self.assertEqual(self.items()[self.paneer.id], (3, 12050, 36150))
+        for removal in range(3):
+            self.assertTrue(userCart.remove_item(self.user, self.paneer.id))
+        self.assertFalse(userCart.remove_item(self.user, self.paneer.id))
+        self.assertEqual(self.items()[self.paneer.id], (0, 12050, 0))
+        userCart.add_item(self.user, self.paneer.id)
+        self.assertEqual(self.items()[self.paneer.id], (1, 13000, 13000))
+        self.assertTotal(22999)
+        self.assertEqual([item.food_id for item in userCart.get_items(self.user)], [self.paneer.id, self.dosa.id])
+
+    def test_update_items(self):
+        userCart.add_item(self.user, self.paneer.id)
+        userCart.update_items(self.user, [
+            {'food_id': self.paneer.id, 'delta': 2}, {'food_id': self.dosa.id, 'qty': 4}, {'food_id': self.dosa.id, 'delta': -1},
+        ])
+        self.assertEqual(self.items(), {self.paneer.id: (3, 12050, 36150), self.dosa.id: (3, 9999, 29997)})
+        self.assertTotal(66147)
+        # Never below 0
+        userCart.update_items(self.user, [{'food_id': self.paneer.id, 'delta': -5}])
+        self.assertTotal(29997)
+        # All or nothing
+        with self.assertRaises(FoodItem.DoesNotExist):
+            userCart.update_items(self.user, [{'food_id': self.dosa.id, 'qty': 1}, {'food_id': 0, 'qty': 1}])
+        self.assertTotal(29997)
+        for changes in ([], [{'food_id': self.dosa.id}], [{'food_id': self.dosa.id, 'qty': -1}]):
+            with self.assertRaises(userCart.InvalidCartUpdate):
+                userCart.update_items(self.user, changes)
+
+    def test_reprice_items(self):
+        userCart.update_items(self.user, [{'food_id': self.paneer.id, 'qty': 2}, {'food_id': self.dosa.id, 'qty': 1}])
+        FoodItem.objects.filter(id=self.paneer.id).update(price='99.50')
+        self.assertEqual([item.food_id for item in userCart.reprice_items(self.user)], [self.paneer.id])
+        self.assertEqual(self.items()[self.paneer.id], (2, 9950, 19900))
+        self.assertTotal(29899)
+        self.assertEqual(userCart.reprice_items(self.user), [])
+
+
+# Concurrent mutations of the same cart don't lose an update. SQLite runs a single write transaction at
+# a time: a transaction finding the database locked was rolled back whole, and is retried
+class ConcurrentCartTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('customer', 'customer@example.com', 'password')
+        partner = User.objects.create_user('partner@example.com', 'partner@example.com', 'password')
+        # Without an image, there's nothing to resize once committed
+        category = Category.objects.create(user=partner, name='Pizza', image='')
+        self.paneer = FoodItem.objects.create(category=category, name='Paneer', description='Paneer pizza', price='120.50', image='')
+        self.dosa = FoodItem.objects.create(category=category, name='Dosa', description='Masala dosa', price='99.99', image='')
+
+    def run_concurrently(self, *tasks):
+        barrier = threading.Barrier(len(tasks))
+        results = [[] for task in tasks]
+        def run(task, taskResults):
+            try:
+                barrier.wait()
+                for mutation in task:
+                    while True:
+                        try:
+                            taskResults.append(mutation())
+                            break
+                        except OperationalError:
+                            time.sleep(0.001)
+            finally:
+                connection.close()
+        threads = [threading.Thread(target=run, args=(task, taskResults)) for task, taskResults in zip(tasks, results)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_mutations(self):
+        userCart.update_items(self.user, [{'food_id': self.dosa.id, 'qty': 10}])
+        add = lambda foodId: lambda: userCart.add_item(self.user, foodId)
+        results = self.run_concurrently(
+            [add(self.paneer.id)] * 20,
+            [add(self.paneer.id)] * 20,
+            [lambda: userCart.update_items(self.user, [{'food_id': self.paneer.id, 'delta': 1}])] * 10,
+            [lambda: userCart.remove_item(self.user, self.dosa.id)] * 15,
+        )
+
+        removed = results[3].count(True)
+        self.assertEqual(removed, 10)
+        items = {item.food_id: item for item in Cart.objects.filter(user=self.user)}
+        self.assertEqual((items[self.paneer.id].qty, items[self.paneer.id].amountPaise), (50, 50 * 12050))
+        self.assertEqual((items[self.dosa.id].qty, items[self.dosa.id].amountPaise), (0, 0))
+        self.assertEqual(userCart.get_total(self.user), 50 * 12050)
+
+
+# The lines of an order placed are a copy of what was paid for: later changes to the food items
+# don't change them (see OrderLine)
+@override_settings(PAYMENTS_GATEWAY='crud.gateways.FakePaymentsGateway', MENU_EXPORT_ON_CHANGE=False)
+class OrderLineTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('customer', 'customer@example.com', 'password')
+        partner = User.objects.create_user('partner@example.com', 'partner@example.com', 'password')
+        category = Category.objects.create(user=partner, name='Pizza', image='images/pizza.jpg')
+        Stripe.objects.create(category=category, accountID='acct_test')
+        self.paneer = FoodItem.objects.create(category=category, name='Paneer', description='Paneer pizza', price='120.50', image='images/food.jpg')
+        self.dosa = FoodItem.objects.create(category=category, name='Dosa', description='Masala dosa', price='99.99', image='images/food.jpg')
+        address = Address.objects.create(user=self.user, area='Jammu', label='HOME')
+        self.partnerAuth = {'HTTP_AUTHORIZATION': f'Bearer {RefreshToken.for_user(partner).access_token}'}
+        caches[settings.CATALOG_CACHE_ALIAS].clear()
+
+        # Checked out and paid
+        userCart.update_items(self.user, [{'food_id': self.paneer.id, 'qty': 2}, {'food_id': self.dosa.id, 'qty': 1}])
+        checkoutSession, = CheckoutSession.objects.bulk_create(generateStripeEvents.build_sessions(self.user, 1))
+        stripeEvents.complete_checkout(generateStripeEvents.build_event(checkoutSession, address.id)['data']['object'])
+        self.order = ActiveOrders.objects.get()
+
+    def lines(self):
+        return list(OrderLine.objects.filter(order=self.order).order_by('id').values_list('food_id', 'name', 'qty', 'pricePaise', 'amountPaise'))
+
+    def test_price_changed(self):
+        response = self.client.post(f'/partner-with-us/manage-food-items/{self.paneer.id}/update', {
+            'name': 'Paneer', 'description': 'Paneer pizza', 'price': '150.00', 'image': 'undefined',
+        }, **self.partnerAuth)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(FoodItem.objects.get(id=self.paneer.id).price, Decimal('150.00'))
+
+        self.assertEqual(self.lines(), [(self.paneer.id, 'Paneer', 2, 12050, 24100), (self.dosa.id, 'Dosa', 1, 9999, 9999)])
+        self.assertEqual(ActiveOrders.objects.get(id=self.order.id).totalPaise, 34099)
+
+    def test_food_item_deleted(self):
+        response = self.client.delete(f'/partner-with-us/manage-food-items/{self.paneer.id}/delete', **self.partnerAuth)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(FoodItem.objects.filter(id=self.paneer.id).exists())
+
+        # The line stays, without its food item
+        self.assertEqual(self.lines(), [(None, 'Paneer', 2, 12050, 24100), (self.dosa.id, 'Dosa', 1, 9999, 9999)])
+        self.assertEqual(ActiveOrders.objects.get(id=self.order.id).totalPaise, 34099)
+
+
+# A data migration, from the rows created at the migration before (with the models of then) to the
+# migration after
+class MigrationTestCase(TransactionTestCase):
+    before = after = None
+
+    def setUp(self):
+        self.executor = MigrationExecutor(connection)
+        self.latest = self.executor.loader.graph.leaf_nodes()
+        self.executor.migrate(self.before)
+        self.apps = self.executor.loader.project_state(self.before).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(self.latest)
+
+    def migrate(self):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(self.after)
+        return executor.loader.project_state(self.after).apps
+
+
+# The conversion of the carts to paise (migrations 0003 to 0005), from the rupee amounts of the cart
+# items, as stored before
+class CartMigrationTests(MigrationTestCase):
+    before = [('FromOurKitchen', '0003_usercart')]
+    after = [('FromOurKitchen', '0005_remove_cart_amounts')]
+
+    def test_convert_carts(self):
+        User = self.apps.get_model('auth', 'User')
+        Category = self.apps.get_model('Categories', 'Category')
+        FoodItem = self.apps.get_model('Categories', 'FoodItem')
+        Address = self.apps.get_model('FromOurKitchen', 'Address')
+        Cart = self.apps.get_model('FromOurKitchen', 'Cart')
+        ActiveOrders = self.apps.get_model('FromOurKitchen', 'ActiveOrders')
+
+        customer = User.objects.create(username='customer')
+        other = User.objects.create(username='other')
+        category = Category.objects.create(user=other, name='Pizza', image='images/pizza.jpg')
+        paneer = FoodItem.objects.create(category=category, name='Paneer', description='Paneer pizza', price='130.00', image='')
+        dosa = FoodItem.objects.create(category=category, name='Dosa', description='Masala dosa', price='99.00', image='')
+        address = Address.objects.create(user=customer, area='Jammu', label='HOME')
+
+        # Added at 120.50, then again at 125.00 (a duplicate item of the same food item)
+        first = Cart.objects.create(user=customer, food=paneer, qty=2, amount='241.00')
+        duplicate = Cart.objects.create(user=customer, food=paneer, qty=1, amount='125.00')
+        # Removed: the current price
+        removed = Cart.objects.create(user=customer, food=dosa, qty=0, amount='0')
+        # 100.00 for 3, rounded to the paisa
+        rounded = Cart.objects.create(user=other, food=dosa, qty=3, amount='100.00')
+        bothItems = ActiveOrders.objects.create(user=customer, address=address)
+        bothItems.cart.set([first, duplicate])
+        duplicateOnly = ActiveOrders.objects.create(user=customer, address=address)
+        duplicateOnly.cart.set([duplicate])
+
+        apps = self.migrate()
+        Cart = apps.get_model('FromOurKitchen', 'Cart')
+        UserCart = apps.get_model('FromOurKitchen', 'UserCart')
+        ActiveOrders = apps.get_model('FromOurKitchen', 'ActiveOrders')
+
+        # The duplicate merged into the first item, at the first item's price
+        self.assertEqual(
+            {item.id: (item.qty, item.pricePaise, item.amountPaise) for item in Cart.objects.all()},
+            {first.id: (3, 12050, 36150), removed.id: (0, 9900, 0), rounded.id: (3, 3333, 9999)},
+        )
+        self.assertEqual(dict(UserCart.objects.values_list('user_id', 'totalPaise')), {customer.id: 36150, other.id: 9999})
+        # The orders refer to the first item, once
+        self.assertEqual(list(ActiveOrders.objects.get(id=bothItems.id).cart.values_list('id', flat=True)), [first.id])
+        self.assertEqual(list(ActiveOrders.objects.get(id=duplicateOnly.id).cart.values_list('id', flat=True)), [first.id])
+
+
+# The order lines copied from the cart items of the orders (migration 0010), as they were then
+class OrderLineMigrationTests(MigrationTestCase):
+    before = [('FromOurKitchen', '0009_orderline')]
+    after = [('FromOurKitchen', '0010_copy_order_lines')]
+
+    def test_copy_order_lines(self):
+        User = self.apps.get_model('auth', 'User')
+        Category = self.apps.get_model('Categories', 'Category')
+        FoodItem = self.apps.get_model('Categories', 'FoodItem')
+        Address = self.apps.get_model('FromOurKitchen', 'Address')
+        Cart = self.apps.get_model('FromOurKitchen', 'Cart')
+        ActiveOrders = self.apps.get_model('FromOurKitchen', 'ActiveOrders')
+
+        customer = User.objects.create(username='customer')
+        partner = User.objects.create(username='partner')
+        category = Category.objects.create(user=partner, name='Pizza', image='')
+        paneer = FoodItem.objects.create(category=category, name='Paneer', description='Paneer pizza', price='130.00', image='images/paneer.jpg')
+        dosa = FoodItem.objects.create(category=category, name='Dosa', description='Masala dosa', price='99.00', image='images/dosa.jpg')
+        address = Address.objects.create(user=customer, area='Jammu', label='HOME')
+
+        # Added at 120.50, since then the price changed
+        first = Cart.objects.create(user=customer, food=paneer, qty=2, pricePaise=12050, amountPaise=24100)
+        second = Cart.objects.create(user=customer, food=dosa, qty=3, pricePaise=9900, amountPaise=29700)
+        # Removed since: not part of the order
+        removed = Cart.objects.create(user=partner, food=dosa, qty=0, pricePaise=9900, amountPaise=0)
+        bothItems = ActiveOrders.objects.create(user=customer, address=address)
+        bothItems.cart.set([first, second])
+        withRemoved = ActiveOrders.objects.create(user=customer, address=address)
+        withRemoved.cart.set([first, removed])
+        empty = ActiveOrders.objects.create(user=customer, address=address)
+
+        apps = self.migrate()
+        ActiveOrders = apps.get_model('FromOurKitchen', 'ActiveOrders')
+        OrderLine = apps.get_model('FromOurKitchen', 'OrderLine')
+
+        def lines(order):
+            return list(OrderLine.objects.filter(order_id=order.id).order_by('id').values_list('food_id', 'name', 'image', 'qty', 'pricePaise', 'amountPaise'))
+
+        self.assertEqual(lines(bothItems), [
+            (paneer.id, 'Paneer', 'images/paneer.jpg', 2, 12050, 24100), (dosa.id, 'Dosa', 'images/dosa.jpg', 3, 9900, 29700),
+        ])
+        self.assertEqual(lines(withRemoved), [(paneer.id, 'Paneer', 'images/paneer.jpg', 2, 12050, 24100)])
+        self.assertEqual(lines(empty), [])
+        self.assertEqual(
+            dict(ActiveOrders.objects.values_list('id', 'totalPaise')),
+            {bothItems.id: 53800, withRemoved.id: 24100, empty.id: 0},
+        )
+
+
+# Order events pushed to the customers and to the partners (crud/events.py), with the in-process backend
+class OrderEventsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('customer', 'customer@example.com', 'password')
+        self.partner = User.objects.create_user('partner@example.com', 'partner@example.com', 'password')
+        self.category = Category.objects.create(user=self.partner, name='Pizza', image='images/pizza.jpg')
+        address = Address.objects.create(user=self.user, area='Jammu', label='HOME')
+        self.order = ActiveOrders.objects.create(user=self.user, address=address, category=self.category)
+
+    def tearDown(self):
+        events.broker.subscriptions.clear()
+
+    async def connect(self, url, user):
+        token = await sync_to_async(lambda: str(RefreshToken.for_user(user).access_token))()
+        response = await self.async_client.get(url, {'token': token})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = response.streaming_content
+        self.assertEqual(await anext(stream), b'retry: 3000\n\n')
+        return stream
+
+    # Publishes the order event, as a view does, and commits
+    async def publish(self, eventType):
+        def publish():
+            with self.captureOnCommitCallbacks(execute=True):
+                userOrders.publish_order_event(eventType, self.order)
+        await sync_to_async(publish)()
+
+    async def test_customer_events(self):
+        stream = await self.connect('/api/events/', self.user)
+        events.broker.deliver(f'user:{self.user.id + 1}', {'type': 'order.created', 'data': {'order': 0}})
+        self.order.active = False
+        await self.publish(userOrders.ORDER_STATUS)
+
+        # Only the events of the user
+        event = await asyncio.wait_for(anext(stream), 1)
+        self.assertEqual(event, f'event: order.status\ndata: {{"order": {self.order.id}, "active": false}}\n\n'.encode())
+
+    async def test_partner_events(self):
+        stream = await self.connect('/partner-with-us/events/', self.partner)
+        await self.publish(userOrders.ORDER_CREATED)
+        event = await asyncio.wait_for(anext(stream), 1)
+        self.assertTrue(event.startswith(b'event: order.created\n'))
+
+    async def test_lost_events(self):
+        with override_settings(EVENTS_QUEUE_SIZE=1):
+            stream = await self.connect('/api/events/', self.user)
+        for number in range(3):
+            events.broker.deliver(f'user:{self.user.id}', {'type': 'order.created', 'data': {'order': number}})
+        await asyncio.sleep(0)
+        self.assertTrue((await anext(stream)).startswith(b'event: order.created\n'))
+        self.assertEqual(await anext(stream), b'event: resync\ndata: {}\n\n')
+
+    async def test_invalid_token(self):
+        response = await self.async_client.get('/api/events/', {'token': 'invalid'})
+        self.assertEqual(response.status_code, 401)
+        response = await self.async_client.get('/partner-with-us/events/')
+        self.assertEqual(response.status_code, 401)
+
+
+# Delivered orders moved to the archive (FromOurKitchen/archive.py) are still part of the order history
+@override_settings(ORDER_ARCHIVE_AFTER_DAYS=30)
+class OrderArchiveTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('customer', 'customer@example.com', 'password')
+        other = User.objects.create_user('other', 'other@example.com', 'password')
+        partner = User.objects.create_user('partner@example.com', 'partner@example.com', 'password')
+        category = Category.objects.create(user=partner, name='Pizza', image='images/pizza.jpg')
+        food = FoodItem.objects.create(category=category, name='Paneer', description='Paneer pizza', price='120.50', image='images/food.jpg')
+        address = Address.objects.create(user=self.user, area='Jammu', label='HOME')
+        self.token = str(RefreshToken.for_user(self.user).access_token)
+
+        # Orders of 100, 60 and 40 days ago (the first ones, in different months) and of today,
+        # one in two delivered, interleaved with another user's orders
+        today = date.today()
+        days = [100] * 4 + [60] * 4 + [40] * 4 + [0] * 4
+        for number, daysAgo in enumerate(days):
+            for user in (self.user, other):
+                order = ActiveOrders.objects.create(user=user, address=address, category=category, active=number % 2 == 0, totalPaise=12050 * (number + 1))
+                OrderLine.objects.create(order=order, food=food, name='Paneer', image='images/food.jpg', qty=number + 1, pricePaise=12050, amountPaise=12050 * (number + 1))
+                ActiveOrders.objects.filter(id=order.id).update(date=today - timedelta(days=daysAgo))
+
+    def history(self, query=''):
+        return self.client.get(f'/api/get-orders/{query}', HTTP_AUTHORIZATION=f'Bearer {self.token}').data
+
+    def test_archive_orders(self):
+        before = self.history()
+        summaryBefore = self.history('?summary=1')
+
+        # 3 batches of 2 orders: the delivered orders older than 30 days, of both users
+        self.assertEqual(orderArchive.archive_orders(batchSize=2, maxBatches=3), 6)
+        self.assertEqual(orderArchive.archive_orders(batchSize=2), 6)
+        self.assertEqual(ActiveOrders.objects.filter(active=False).count(), 4)
+        self.assertEqual(OrderArchivePartition.objects.count(), 3 if (date.today() - timedelta(days=40)).month != (date.today() - timedelta(days=60)).month else 2)
+
+        # The same history, whole or page by page, forward and back
+        self.assertEqual(self.history(), before)
+        self.assertEqual(self.history('?summary=1'), summaryBefore)
+        pages, cursor = [], ''
+        while cursor is not None:
+            page = self.history(f'?page_size=3&cursor={cursor}')
+            pages.append(page)
+            cursor = page['next']
+        self.assertEqual([order for page in pages for order in page['results']], before)
+        self.assertEqual(self.history(f'?page_size=3&cursor={pages[-1]["previous"]}'), pages[-2])
+
+    def test_recent_page(self):
+        orderArchive.archive_orders()
+        # A page of recent orders doesn't read the archive: the user and the orders (with their lines)
+        with self.assertQueryBudget(3):
+            page = self.history('?page_size=2')
+        self.assertEqual(len(page['results']), 2)
+
+    def test_date_range(self):
+        before = self.history()
+        orderArchive.archive_orders()
+        today = date.today()
+
+        # Within the live orders: neither the partitions nor the archive are read (the user, the
+        # orders and their lines)
+        since = (today - timedelta(days=7)).isoformat()
+        with self.assertQueryBudget(3):
+            orders = self.history(f'?since={since}')
+        self.assertEqual(orders, [order for order in before if order['date'] >= since])
+
+        # A single day of the archive: only its month table is read
+        day = (today - timedelta(days=60)).isoformat()
+        with CaptureQueriesContext(connection) as queries:
+            orders = self.history(f'?since={day}&until={day}')
+        self.assertEqual(orders, [order for order in before if order['date'] == day])
+        archiveQueries = [query['sql'] for query in queries.captured_queries if f'{orderArchive.PARENT_TABLE}_' in query['sql']]
+        self.assertEqual(len(archiveQueries), 1)
+        self.assertIn(orderArchive.table_name(today - timedelta(days=60)), archiveQueries[0])
+        self.assertNotIn(orderArchive.table_name(today - timedelta(days=100)), archiveQueries[0])
+
+        self.assertEqual(self.client.get('/api/get-orders/?since=yesterday', HTTP_AUTHORIZATION=f'Bearer {self.token}').status_code, 400)
+        self.assertEqual(self.client.get(f'/api/get-orders/?since={today}&until={day}', HTTP_AUTHORIZATION=f'Bearer {self.token}').status_code, 400)
+
+    def test_archive_after_days(self):
+        with self.assertRaises(ValueError):
+            orderArchive.archive_orders(olderThanDays=10)
+
+
+# The text SMS outbox (FromOurKitchen/notifications.py), sent with the fake provider
+@override_settings(
+    NOTIFICATIONS_PROVIDER='FromOurKitchen.notifications.FakeProvider',
+    NOTIFICATIONS_MAX_ATTEMPTS=2,
+    NOTIFICATIONS_RETRY_DELAY=60,
+)
+class NotificationTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        notifications.FakeProvider.outbox.clear()
+
+    def test_enqueue(self):
+        notifications.enqueue([('order.delivered:1', '+9876543210', 'Delivered'), ('order.delivered:2', '+9876543211', 'Delivered')])
+        # Already enqueued
+        notifications.enqueue([('order.delivered:1', '+9876543210', 'Delivered again')])
+        self.assertEqual(list(Notification.objects.order_by('id').values_list('key', 'body')), [
+            ('order.delivered:1', 'Delivered'), ('order.delivered:2', 'Delivered'),
+        ])
+
+    def test_send_notifications(self):
+        notifications.enqueue([(f'order.delivered:{number}', f'+98765432{number:02d}', 'Delivered') for number in range(25)])
+        # Each batch: the claim (select and update in a savepoint) and the outcomes (a single update),
+        # whatever the size of the batch. Then the claim finding none
+        with self.assertQueryBudget(3 * 5 + 3):
+            self.assertEqual(notifications.send_notifications(batchSize=10, concurrency=4), (25, 0))
+        self.assertEqual(len(notifications.FakeProvider.outbox), 25)
+        self.assertFalse(Notification.objects.exclude(status=Notification.SENT).exists())
+        # Nothing left to send
+        self.assertEqual(notifications.send_notifications(), (0, 0))
+        self.assertEqual(len(notifications.FakeProvider.outbox), 25)
+
+    def test_retries(self):
+        notifications.enqueue([('order.delivered:1', '+9876543210', 'Delivered')])
+        with mock.patch.object(notifications.FakeProvider, 'send', side_effect=Exception('Provider down')):
+            self.assertEqual(notifications.send_notifications(), (0, 1))
+            message = Notification.objects.get()
+            self.assertEqual((message.status, message.attempts, message.error), (Notification.PENDING, 1, 'Provider down'))
+            # Not due before the backoff
+            self.assertEqual(notifications.send_notifications(), (0, 0))
+
+            Notification.objects.update(nextAttempt=message.nextAttempt - timedelta(seconds=60))
+            self.assertEqual(notifications.send_notifications(), (0, 1))
+            # Given up after NOTIFICATIONS_MAX_ATTEMPTS
+            self.assertEqual(Notification.objects.get().status, Notification.FAILED)
+
+        stats = notifications.get_stats()
+        self.assertEqual((stats['pending'], stats['failed']), (0, 1))
+        self.assertIsNotNone(stats['latencyMs']['max'])
+
+
+# The Stripe webhook events (FromOurKitchen/stripe_events.py), signed as Stripe signs them
+@override_settings(BACKGROUND_TASKS_EAGER=True, PAYMENTS_GATEWAY='crud.gateways.FakePaymentsGateway', STRIPE_WEBHOOK_SECRET='whsec_test')
+class StripeEventTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('customer', 'customer@example.com', 'password')
+        partner = User.objects.create_user('partner@example.com', 'partner@example.com', 'password')
+        category = Category.objects.create(user=partner, name='Pizza', image='images/pizza.jpg')
+        Stripe.objects.create(category=category, accountID='acct_test')
+        self.food = FoodItem.objects.create(category=category, name='Paneer', description='Paneer pizza', price='120.50', image='images/food.jpg')
+        Cart.objects.create(user=self.user, food=self.food, qty=2, pricePaise=12050, amountPaise=24100)
+        UserCart.objects.create(user=self.user, totalPaise=24100)
+        self.address = Address.objects.create(user=self.user, area='Jammu', label='HOME')
+        caches[settings.CATALOG_CACHE_ALIAS].clear()
+        # Checked out
+        self.checkoutSession, = CheckoutSession.objects.bulk_create(generateStripeEvents.build_sessions(self.user, 1))
+
+    def post(self, payload, secret='whsec_test'):
+        return self.client.post('/api/webhook/', payload, content_type='application/json', HTTP_STRIPE_SIGNATURE=gateways.sign_webhook(payload, secret))
+
+    def test_redelivered_event(self):
+        payload = json.dumps(generateStripeEvents.build_event(self.checkoutSession, self.address.id))
+        for delivery in range(2):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(self.post(payload).status_code, 200)
+        # Saved and processed once, by the background task
+        stripeEvent = StripeEvent.objects.get()
+        self.assertEqual((stripeEvent.status, stripeEvent.attempts), (StripeEvent.PROCESSED, 1))
+        order = ActiveOrders.objects.get()
+        self.assertEqual((order.totalPaise, order.checkoutSession), (24100, json.loads(payload)['data']['object']['id']))
+
+        # Replaying the event doesn't place the order again
+        self.assertEqual(stripeEvents.replay([stripeEvent]), (1, 0))
+        self.assertEqual(ActiveOrders.objects.count(), 1)
+
+    def test_cart_changed(self):
+        # After the checkout, the cart changed: the order is what was paid for, and the items added
+        # since stay in the cart
+        userCart.add_item(self.user, self.food.id)
+        self.food.price = '99.00'
+        self.food.save()
+        stripeEvents.complete_checkout(generateStripeEvents.build_event(self.checkoutSession, self.address.id)['data']['object'])
+        order = ActiveOrders.objects.get()
+        self.assertEqual(order.totalPaise, 24100)
+        self.assertEqual(list(order.lines.values_list('qty', 'pricePaise', 'amountPaise')), [(2, 12050, 24100)])
+        self.assertEqual((Cart.objects.get(user=self.user).qty, userCart.get_total(self.user)), (1, 12050))
+
+    def test_amount_paid(self):
+        session = generateStripeEvents.build_event(self.checkoutSession, self.address.id)['data']['object']
+        with self.assertRaises(stripeEvents.InvalidCheckout):
+            stripeEvents.complete_checkout(dict(session, amount_total=12050))
+        with self.assertRaises(stripeEvents.InvalidCheckout):
+            stripeEvents.complete_checkout(dict(session, id='cs_unknown'))
+        self.assertFalse(ActiveOrders.objects.exists())
+        self.assertEqual(userCart.get_total(self.user), 24100)
+
+    def test_invalid_signature(self):
+        payload = json.dumps(generateStripeEvents.build_event(self.checkoutSession, self.address.id))
+        self.assertEqual(self.post(payload, secret='whsec_other').status_code, 400)
+        self.assertFalse(StripeEvent.objects.exists())
+
+    @override_settings(STRIPE_EVENTS_MAX_ATTEMPTS=2)
+    def test_retries(self):
+        event = generateStripeEvents.build_event(self.checkoutSession, 0)
+        self.post(json.dumps(event))
+        # The address doesn't exist
+        self.assertEqual(stripeEvents.process_events(), (0, 1))
+        stripeEvent = StripeEvent.objects.get()
+        self.assertEqual((stripeEvent.status, stripeEvent.attempts), (StripeEvent.PENDING, 1))
+        # Not due before the backoff
+        self.assertEqual(stripeEvents.process_events(), (0, 0))
+
+        StripeEvent.objects.update(nextAttempt=stripeEvent.received)
+        self.assertEqual(stripeEvents.process_events(), (0, 1))
+        self.assertEqual(StripeEvent.objects.get().status, StripeEvent.FAILED)
+        self.assertFalse(ActiveOrders.objects.exists())
+
+    def test_unhandled_event(self):
+        self.post(json.dumps({'id': 'evt_1', 'object': 'event', 'type': 'payout.paid', 'data': {'object': {'id': 'po_1'}}}))
+        self.assertEqual(stripeEvents.process_events(), (1, 0))
+        self.assertEqual(StripeEvent.objects.get().status, StripeEvent.PROCESSED)
+
+
+# Idempotent checkout (FromOurKitchen/checkout.py)
+@override_settings(STRIPE_CHECKOUT_ACCOUNT='acct_platform')
+@mock.patch.object(stripe.checkout.Session, 'create_async')
+class CheckoutSessionTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('customer', 'customer@example.com', 'password')
+        partner = User.objects.create_user('partner@example.com', 'partner@example.com', 'password')
+        category = Category.objects.create(user=partner, name='Pizza', image='images/pizza.jpg')
+        Stripe.objects.create(category=category, accountID='acct_test')
+        self.food = FoodItem.objects.create(category=category, name='Paneer', description='Paneer pizza', price='120.50', image='images/food.jpg')
+        self.address = Address.objects.create(user=self.user, area='Jammu', label='HOME')
+        self.token = str(RefreshToken.for_user(self.user).access_token)
+        # The Stripe accounts cached by the other tests (the ids are reused)
+        caches[settings.CATALOG_CACHE_ALIAS].clear()
+
+    def checkout(self, address=None):
+        return self.client.post(
+            '/api/checkout/', {'address': {'id': (address or self.address).id}},
+            content_type='application/json', HTTP_AUTHORIZATION=f'Bearer {self.token}',
+        )
+
+    def test_same_cart(self, create):
+        create.side_effect = lambda **kwargs: mock.Mock(id=f'cs_{create.call_count}', url=f'https://checkout.stripe.com/{create.call_count}')
+        self.assertEqual(self.checkout().status_code, 400)
+
+        userCart.add_item(self.user, self.food.id)
+        first = self.checkout().json()
+        self.assertEqual(self.checkout().json(), first)
+        self.assertEqual(create.call_count, 1)
+
+        # Another address, or another cart
+        other = Address.objects.create(user=self.user, area='Delhi', label='WORK')
+        self.assertNotEqual(self.checkout(other).json(), first)
+        userCart.add_item(self.user, self.food.id)
+        self.assertNotEqual(self.checkout().json(), first)
+        self.assertEqual(create.call_count, 3)
+
+        # Once paid, its items are out of the cart, and the same cart is a new order
+        userCart.remove_item(self.user, self.food.id)
+        stripeEvents.complete_checkout({'id': 'cs_1', 'amount_total': 12050, 'metadata': {'user': str(self.user.id), 'addressID': str(self.address.id)}})
+        self.assertEqual(self.checkout().status_code, 400)
+        userCart.add_item(self.user, self.food.id)
+        self.assertNotEqual(self.checkout().json(), first)
+        self.assertEqual(create.call_count, 4)
+        self.assertEqual(len({call.kwargs['idempotency_key'] for call in create.call_args_list}), 4)
+
+
+    def test_concurrent_checkout(self, create):
+        create.side_effect = lambda **kwargs: mock.Mock(id='cs_test', url='https://checkout.stripe.com/test')
+        userCart.add_item(self.user, self.food.id)
+        # Another checkout of the user is creating its session: Stripe isn't called
+        pending = userCheckout._claim(self.user, 'key', userCheckout.get_quote(list(userCart.get_items(self.user))), datetime.now())
+        self.assertEqual(self.checkout().status_code, 409)
+        self.assertEqual(create.call_count, 0)
+
+        # Left by a request which died, it's taken over once expired
+        CheckoutSession.objects.filter(id=pending.id).update(expires=datetime.now())
+        self.assertEqual(self.checkout().status_code, 303)
+        self.assertEqual(list(CheckoutSession.objects.values_list('sessionId', flat=True)), ['cs_test'])
+
+    def test_retry(self, create):
+        create.side_effect = lambda **kwargs: mock.Mock(id='cs_test', url='https://checkout.stripe.com/test')
+        userCart.add_item(self.user, self.food.id)
+        # A checkout retried later in the same idempotency window, its session not saved the first
+        # time: Stripe gets the same key with the same parameters
+        start = (int(time.time()) // userCheckout.IDEMPOTENCY_WINDOW + 1) * userCheckout.IDEMPOTENCY_WINDOW
+        for now in (start + 10, start + userCheckout.IDEMPOTENCY_WINDOW - 10):
+            with mock.patch('FromOurKitchen.checkout.time') as clock:
+                clock.time.return_value = now
+                self.assertEqual(self.checkout().status_code, 303)
+            CheckoutSession.objects.all().delete()
+        first, retry = create.call_args_list
+        self.assertEqual(retry.kwargs, first.kwargs)
+        self.assertEqual(first.kwargs['expires_at'], start + userCheckout.IDEMPOTENCY_WINDOW + 1800)
+
+    def test_stripe_errors(self, create):
+        userCart.add_item(self.user, self.food.id)
+        create.side_effect = stripe.error.IdempotencyError('Keys for idempotent requests can only be used with the same parameters', code='idempotency_key_in_use')
+        self.assertEqual(self.checkout().status_code, 409)
+        create.side_effect = stripe.error.APIConnectionError('Network error')
+        self.assertEqual(self.checkout().status_code, 502)
+        # The failed checkouts left no pending session behind
+        self.assertFalse(CheckoutSession.objects.exists())
+
+        create.side_effect = lambda **kwargs: mock.Mock(id='cs_test', url='https://checkout.stripe.com/test')
+        self.assertEqual(self.checkout().status_code, 303)
+
+    def test_prices_changed(self, create):
+        create.side_effect = lambda **kwargs: mock.Mock(id='cs_test', url='https://checkout.stripe.com/test')
+        userCart.add_item(self.user, self.food.id)
+        userCart.add_item(self.user, self.food.id)
+        self.food.price = '99.00'
+        self.food.save()
+
+        # The cart takes the current price, to be reviewed before checking out again
+        self.assertEqual(self.checkout().status_code, 409)
+        self.assertEqual(create.call_count, 0)
+        self.assertEqual(userCart.get_total(self.user), 19800)
+
+        self.assertEqual(self.checkout().status_code, 303)
+        lineItem, = create.call_args.kwargs['line_items']
+        self.assertEqual((lineItem['price_data']['unit_amount'], lineItem['quantity']), (9900, 2))
+        self.assertEqual(create.call_args.kwargs['payment_intent_data']['transfer_data']['destination'], 'acct_test')
+
+    def test_payout_account_cache(self, create):
+        userCart.add_item(self.user, self.food.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            Stripe.objects.filter(category=self.food.category).delete()
+        self.assertEqual(self.checkout().status_code, 412)
+
+        # Cached (the missing account as well), until the category's Stripe row changes
+        cart = list(userCart.get_items(self.user))
+        with self.assertNumQueries(0):
+            self.assertRaises(userCheckout.NoPayoutAccount, userCheckout.get_quote, cart)
+        with self.captureOnCommitCallbacks(execute=True):
+            Stripe.objects.create(category=self.food.category, accountID='acct_other')
+        self.assertEqual(userCheckout.get_quote(cart).accountId, 'acct_other')
+        with self.assertNumQueries(0):
+            quote = userCheckout.get_quote(cart)
+        self.assertEqual((quote.categoryId, quote.totalPaise, len(quote.line_items())), (self.food.category_id, 12050, 1))
+
+# The token service (crud/tokens.py)
+class TokenTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('partner@example.com', 'partner@example.com', 'password')
+        self.group = Group.objects.create(name='Category')
+        caches[getattr(settings, 'TOKEN_CACHE_ALIAS', 'default')].clear()
+
+    def claims(self):
+        return AccessToken(str(tokens.for_user(self.user).access_token))
+
+    def test_role_cached(self):
+        self.assertEqual(self.claims()['group'], tokens.NO_ROLE)
+        with self.assertNumQueries(1):
+            # The outstanding refresh token only, not the user's groups
+            self.assertEqual(self.claims()['group'], tokens.NO_ROLE)
+
+        # Adding the user to the group (either way) or removing it changes the role
+        with self.captureOnCommitCallbacks(execute=True):
+            self.group.user_set.add(self.user)
+        self.assertEqual(self.claims()['group'], tokens.CATEGORY_ROLE)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.groups.remove(self.group)
+        self.assertEqual(self.claims()['group'], tokens.NO_ROLE)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.groups.add(self.group)
+        self.assertEqual(self.claims()['group'], tokens.CATEGORY_ROLE)
+        # As does renaming the group
+        with self.captureOnCommitCallbacks(execute=True):
+            self.group.name = 'Partner'
+            self.group.save()
+        self.assertEqual(self.claims()['group'], tokens.NO_ROLE)
+
+    def test_claims_authentication(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.groups.add(self.group)
+        token = str(tokens.for_user(self.user).access_token)
+        request = RequestFactory().get('/', HTTP_AUTHORIZATION=f'Bearer {token}')
+        with self.assertNumQueries(0):
+            user, validatedToken = tokens.ClaimsAuthentication().authenticate(request)
+        self.assertEqual((user.id, user.username, user.role, user.is_partner), (self.user.id, self.user.username, tokens.CATEGORY_ROLE, True))
+
+        # Trusted until the token expires, the user isn't loaded
+        User.objects.filter(id=self.user.id).update(is_active=False)
+        response = self.client.get('/api/get-address/', HTTP_AUTHORIZATION=f'Bearer {token}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get('/api/get-user-info/', HTTP_AUTHORIZATION=f'Bearer {token}').status_code, 401)
+
+
+# Revoked refresh tokens (crud/revocation.py). Each RevocationFilter stands for the filter of a
+# worker process, sharing the database with the others
+@override_settings(TOKEN_REVOCATION_SYNC_INTERVAL=3600)
+class RevocationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('customer', 'customer@example.com', 'password')
+
+    def worker(self):
+        worker = revocation.RevocationFilter()
+        worker.sync()
+        return worker
+
+    # To refresh the token through the given worker
+    def refresh(self, worker, token):
+        with mock.patch.object(revocation, '_filter', worker):
+            return self.client.post('/api/token/refresh/', {'refresh': token})
+
+    def test_refresh_rotates_once(self):
+        worker = self.worker()
+        token = str(tokens.for_user(self.user))
+        response = self.refresh(worker, token)
+        self.assertEqual(response.status_code, 200)
+        # The blacklist isn't queried to check the token
+        self.assertEqual(worker.get_stats()['lookups'], 0)
+
+        self.assertEqual(self.refresh(worker, token).status_code, 401)
+        self.assertEqual(self.refresh(worker, response.data['refresh']).status_code, 200)
+
+    def test_propagation_across_workers(self):
+        first, second = self.worker(), self.worker()
+        refreshToken = tokens.for_user(self.user)
+        token, jti = str(refreshToken), refreshToken['jti']
+        self.assertEqual(self.refresh(first, token).status_code, 200)
+        self.assertTrue(first.is_revoked(jti))
+
+        # Not synced yet: the second worker still lets the token through its filter, but the token
+        # can't be rotated again
+        self.assertFalse(second.is_revoked(jti))
+        self.assertEqual(self.refresh(second, token).status_code, 401)
+
+        # Synced, without a lookup
+        with override_settings(TOKEN_REVOCATION_SYNC_INTERVAL=0):
+            with self.assertNumQueries(1):
+                self.assertTrue(second.is_revoked(jti))
+        self.assertEqual(second.get_stats()['lookups'], 0)
+
+    def test_late_commit(self):
+        worker = self.worker()
+        token = tokens.for_user(self.user)
+        # Blacklisted by a transaction committed after the sync, with an earlier blacklisted_at
+        blacklisted = BlacklistedToken.objects.create(token=OutstandingToken.objects.get(jti=token['jti']))
+        BlacklistedToken.objects.filter(id=blacklisted.id).update(blacklisted_at=worker.syncedAt - timedelta(seconds=1))
+        with override_settings(TOKEN_REVOCATION_SYNC_INTERVAL=0):
+            self.assertTrue(worker.is_revoked(token['jti']))
+
+    def test_false_positive(self):
+        worker = self.worker()
+        token = tokens.for_user(self.user)
+        # Every id is "maybe revoked"
+        worker.bloom.bits[:] = b'\xff' * len(worker.bloom.bits)
+        with self.assertNumQueries(1):
+            self.assertFalse(worker.is_revoked(token['jti']))
+        # Remembered
+        with self.assertNumQueries(0):
+            self.assertFalse(worker.is_revoked(token['jti']))
+        # Until revoked
+        self.assertEqual(self.refresh(worker, str(token)).status_code, 200)
+        with self.assertNumQueries(0):
+            self.assertTrue(worker.is_revoked(token['jti']))
+
+    def test_bloom_filter(self):
+        bloom = revocation.BloomFilter(1000, 0.01)
+        for number in range(1000):
+            bloom.add(f'revoked-{number}')
+        self.assertTrue(all(f'revoked-{number}' in bloom for number in range(1000)))
+        falsePositives = sum(f'other-{number}' in bloom for number in range(10000))
+        self.assertLess(falsePositives, 300)
+
+    def test_prune_tokens(self):
+        expired = [tokens.for_user(self.user) for number in range(5)]
+        live = tokens.for_user(self.user)
+        OutstandingToken.objects.filter(jti__in=[token['jti'] for token in expired]).update(expires_at=datetime(2020, 1, 1))
+        for token in expired[:3] + [live]:
+            token.blacklist()
+
+        self.assertEqual(revocation.prune_tokens(batchSize=2), 5)
+        self.assertEqual(list(OutstandingToken.objects.values_list('jti', flat=True)), [live['jti']])
+        self.assertEqual(BlacklistedToken.objects.get().token.jti, live['jti'])
+        self.assertEqual(revocation.prune_tokens(), 0)
+
+# Uploads served by WhiteNoise (crud/middleware.py)
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class MediaServingTests(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+
+    async def test_disk_lookups(self):
+        name = await sync_to_async(default_storage.save)('images/food.png', ContentFile(b'image'))
+        with mock.patch('crud.middleware.sync_to_async', wraps=sync_to_async) as inThread:
+            response = await self.async_client.get(f'/media/{name}')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('immutable', response['Cache-Control'])
+            response.close()
+            # Remembered, as it never changes
+            (await self.async_client.get(f'/media/{name}')).close()
+            self.assertEqual((await self.async_client.get('/media/images/missing.png')).status_code, 404)
+            # The API isn't looked up on disk
+            self.assertEqual((await self.async_client.get('/api/category/')).status_code, 200)
+        self.assertEqual(inThread.call_count, 2)
+
+    def test_cdn_url(self):
+        storage = ContentAddressedStorage(location=MEDIA_ROOT, base_url='https://cdn.example.com/media/')
+        self.assertEqual(storage.url('images/food.png'), 'https://cdn.example.com/media/images/food.png')
+
+
+# The gateways to Stripe and Twilio (crud/gateways.py)
+class GatewayTests(TestCase):
+    def test_sdks_imported_on_first_use(self):
+        # Loading the app (the URLs and the views) doesn't import the SDKs
+        code = 'import sys, django; django.setup(); import crud.urls; print(" ".join(sorted({"stripe", "twilio"} & set(sys.modules))))'
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, cwd=settings.BASE_DIR, check=True)
+        self.assertEqual(result.stdout.strip(), '')
+
+    @override_settings(PAYMENTS_GATEWAY='crud.gateways.FakePaymentsGateway', STRIPE_WEBHOOK_SECRET='whsec_test')
+    def test_fake_payments(self):
+        payload = json.dumps({'id': 'evt_test', 'type': 'checkout.session.completed'})
+        self.assertEqual(gateways.payments().construct_event(payload, gateways.sign_webhook(payload, 'whsec_test'))['id'], 'evt_test')
+        with self.assertRaises(gateways.InvalidWebhook):
+            gateways.payments().construct_event(payload, gateways.sign_webhook(payload, 'whsec_other'))
+        with self.assertRaises(gateways.InvalidWebhook):
+            gateways.payments().construct_event(payload, 'v1=')
+        # The same gateway, for the whole process
+        self.assertIs(gateways.payments(), gateways.payments())
+
+    @override_settings(STRIPE_CHECKOUT_ACCOUNT=None)
+    @mock.patch.object(stripe.checkout.Session, 'create')
+    def test_required_settings(self, create):
+        # No account of the original deployment to fall back on
+        with self.assertRaises(ImproperlyConfigured):
+            gateways.payments().create_checkout_session(idempotencyKey='key', mode='payment')
+        self.assertEqual(create.call_count, 0)
+
+    @override_settings(MESSAGING_GATEWAY='crud.gateways.FakeMessagingGateway')
+    def test_fake_messaging(self):
+        gateways.messaging().send_sms('+919876543210', 'Order delivered')
+        self.assertIn(('+919876543210', 'Order delivered'), gateways.messaging().outbox)
+        asyncio.run(gateways.messaging().asend_sms('+919876543210', 'Order picked up'))
+        self.assertIn(('+919876543210', 'Order picked up'), gateways.messaging().outbox)
+
+    @override_settings(TWILIO_ACCOUNT_SID='ACtest', TWILIO_AUTH_TOKEN='token', TWILIO_MESSAGING_SERVICE_SID='MGtest')
+    def test_twilio_async(self):
+        from twilio.base.exceptions import TwilioRestException
+        from twilio.rest.api.v2010.account.message import MessageList
+
+        gateway = gateways.TwilioGateway()
+
+        async def send():
+            client = gateway._async_client()
+            try:
+                return await gateway.asend_sms('+919876543210', 'Order delivered'), client
+            finally:
+                await client.http_client.close()
+
+        with mock.patch.object(MessageList, 'create_async', return_value=SimpleNamespace(status='accepted')) as create:
+            (message, client), (other, otherClient) = asyncio.run(send()), asyncio.run(send())
+        self.assertEqual(message.status, 'accepted')
+        create.assert_called_with(messaging_service_sid='MGtest', to='+919876543210', body='Order delivered')
+        # A client per event loop
+        self.assertIsNot(client, otherClient)
+
+        with mock.patch.object(MessageList, 'create_async', side_effect=TwilioRestException(400, 'url', 'Invalid To number', 21211)):
+            with self.assertRaises(gateways.MessagingError) as context:
+                asyncio.run(send())
+        self.assertEqual(context.exception.code, 21211)
+
+
+@override_settings(OTP_PROVIDER='FromOurKitchen.notifications.FakeProvider')
+class OtpTests(TestCase):
+    NUMBER = '+919876543210'
+
+    def setUp(self):
+        notifications.FakeProvider.outbox.clear()
+
+    def issue(self):
+        return otp.issue(self.NUMBER)
+
+    def test_issue(self):
+        code = self.issue()
+        self.assertRegex(code, r'^\d{6}$')
+        # Only the hash of the code is stored, the code is only in the message
+        oneTimeCode = OneTimeCode.objects.get(number=self.NUMBER)
+        self.assertNotIn(code, oneTimeCode.codeHash)
+        self.assertEqual(len(notifications.FakeProvider.outbox), 1)
+        to, body = notifications.FakeProvider.outbox[0]
+        self.assertEqual(to, self.NUMBER)
+        self.assertIn(code, body)
+
+        with self.assertRaises(otp.InvalidNumber):
+            otp.issue('919876543210')
+
+    def test_check(self):
+        code = self.issue()
+        self.assertEqual(otp.check(self.NUMBER, code), otp.APPROVED)
+        # Used once
+        self.assertEqual(otp.check(self.NUMBER, code), otp.EXPIRED)
+        self.assertEqual(otp.check('+919999999999', code), otp.EXPIRED)
+
+    @override_settings(OTP_MAX_ATTEMPTS=3)
+    def test_attempts(self):
+        code = self.issue()
+        wrong = f'{(int(code) + 1) % 1000000:06d}'
+        self.assertEqual([otp.check(self.NUMBER, wrong) for attempt in range(3)], [otp.INVALID] * 3)
+        # The right code isn't accepted anymore
+        self.assertEqual(otp.check(self.NUMBER, code), otp.TOO_MANY_ATTEMPTS)
+
+    @override_settings(OTP_TTL=60)
+    def test_expiry(self):
+        code = self.issue()
+        OneTimeCode.objects.filter(number=self.NUMBER).update(expires=datetime.now() - timedelta(seconds=1))
+        self.assertEqual(otp.check(self.NUMBER, code), otp.EXPIRED)
+
+    @override_settings(OTP_RESEND_INTERVAL=30, OTP_MAX_SENDS=2, OTP_SEND_WINDOW=3600)
+    def test_rate_limit(self):
+        self.issue()
+        with self.assertRaises(otp.RateLimited) as context:
+            self.issue()
+        self.assertLessEqual(context.exception.retryAfter, 31)
+
+        # Past the resend interval, the code sent last replaces the previous one
+        OneTimeCode.objects.filter(number=self.NUMBER).update(sent=datetime.now() - timedelta(seconds=31))
+        code = self.issue()
+        OneTimeCode.objects.filter(number=self.NUMBER).update(sent=datetime.now() - timedelta(seconds=31))
+        with self.assertRaises(otp.RateLimited) as context:
+            self.issue()
+        self.assertGreater(context.exception.retryAfter, 31)
+        self.assertEqual(len(notifications.FakeProvider.outbox), 2)
+        self.assertEqual(otp.check(self.NUMBER, code), otp.APPROVED)
+
+        # A new window
+        OneTimeCode.objects.filter(number=self.NUMBER).update(windowStart=datetime.now() - timedelta(seconds=3600), sent=datetime.now() - timedelta(seconds=31))
+        self.issue()
+        self.assertEqual(OneTimeCode.objects.get(number=self.NUMBER).sends, 1)
+
+    def test_delivery_failed(self):
+        # Sent with Twilio by default, whatever the NOTIFICATIONS_PROVIDER
+        with override_settings(NOTIFICATIONS_PROVIDER='FromOurKitchen.notifications.FakeProvider'):
+            del settings.OTP_PROVIDER
+            self.assertIsInstance(otp.get_provider(), notifications.TwilioProvider)
+
+        with mock.patch.object(notifications.FakeProvider, 'send', side_effect=gateways.MessagingError('Invalid To number', 21211)):
+            with self.assertRaises(otp.DeliveryFailed) as context:
+                self.issue()
+            self.assertEqual(context.exception.code, 21211)
+        # The view sends it asynchronously
+        with mock.patch.object(notifications.FakeProvider, 'asend', side_effect=gateways.MessagingError('Invalid To number', 21211)):
+            self.assertEqual(self.client.post('/api/mobile-send-message/', {'number': '919876543210'}).status_code, 405)
+        with mock.patch.object(notifications.FakeProvider, 'asend', side_effect=gateways.MessagingError('Service unavailable')):
+            self.assertEqual(self.client.post('/api/mobile-send-message/', {'number': '919876543210'}).status_code, 502)
+        # The codes which couldn't be sent aren't valid, and another one can be sent right away
+        self.assertEqual(OneTimeCode.objects.get(number=self.NUMBER).codeHash, '')
+        code = self.issue()
+        self.assertEqual(otp.check(self.NUMBER, code), otp.APPROVED)
+
+    def test_views(self):
+        response = self.client.post('/api/mobile-send-message/', {'number': '919876543210'})
+        self.assertEqual(response.status_code, 200)
+        code = re.search(r'\d{6}', notifications.FakeProvider.outbox[0][1]).group()
+
+        response = self.client.post('/api/mobile-send-message/', {'number': '919876543210'})
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+        self.assertEqual(self.client.post('/api/mobile-send-message/', {'number': '12'}).status_code, 405)
+        self.assertEqual(self.client.get('/api/mobile-send-message/').status_code, 405)
+
+        self.assertEqual(self.client.post('/api/mobile-verification/', {'number': '919876543210', 'code': 'abcdef'}).status_code, 412)
+        self.assertEqual(self.client.post('/api/mobile-verification/', {'number': '919876543210', 'code': code}).status_code, 200)
+        self.assertEqual(self.client.post('/api/mobile-verification/', {'number': '919876543210', 'code': code}).status_code, 406)
+
+
+class RateLimitTests(TestCase):
+    def setUp(self):
+        ratelimit.get_backend().clear()
+        user = User.objects.create_user('customer', 'customer@example.com', 'password')
+        MobileNumber.objects.create(user=user, number=9876543210)
+
+    def test_bucket(self):
+        backend = ratelimit.LocalBackend()
+        with mock.patch('crud.ratelimit.time.monotonic', return_value=1000.0) as monotonic:
+            self.assertEqual([backend.take('key', 3, 60) for request in range(3)], [0, 0, 0])
+            # A token every 20 seconds
+            self.assertAlmostEqual(backend.take('key', 3, 60), 20)
+            monotonic.return_value = 1010.0
+            self.assertAlmostEqual(backend.take('key', 3, 60), 10)
+            monotonic.return_value = 1020.0
+            self.assertEqual(backend.take('key', 3, 60), 0)
+            # Other keys have their own bucket
+            self.assertEqual(backend.take('other', 3, 60), 0)
+
+    def test_cache_backend(self):
+        backend = ratelimit.CacheBackend()
+        key = f'ratelimit:test:{datetime.now().timestamp()}'
+        self.assertEqual([backend.take(key, 2, 60) for request in range(2)], [0, 0])
+        self.assertGreater(backend.take(key, 2, 60), 0)
+
+    @override_settings(RATELIMIT_RATES={'login.ip': '10/min', 'login.number': '2/min'})
+    def test_throttled(self):
+        login = lambda number: self.client.post('/api/custom-login/', {'number': number})
+        self.assertEqual([login(9876543210).status_code for request in range(2)], [200, 200])
+        response = login('+9876543210')
+        self.assertEqual(response.status_code, 429)
+        self.assertGreaterEqual(int(response['Retry-After']), 1)
+        # Another number, from the same client
+        self.assertEqual(login(9000000000).status_code, 406)
+        self.assertGreaterEqual(ratelimit.get_stats()['throttled']['login.number'], 1)
+
+    @override_settings(RATELIMIT_RATES={'sms.ip': '10/min', 'sms.number': '1/min'}, OTP_PROVIDER='FromOurKitchen.notifications.FakeProvider')
+    def test_async_view_throttled(self):
+        send = lambda number: self.client.post('/api/mobile-send-message/', {'number': number})
+        self.assertEqual(send('919876543210').status_code, 200)
+        # Throttled before a code is issued
+        with mock.patch.object(otp, 'aissue') as issue:
+            response = send('+919876543210')
+        self.assertEqual(response.status_code, 429)
+        self.assertGreaterEqual(int(response['Retry-After']), 1)
+        self.assertEqual(issue.call_count, 0)
+        self.assertGreaterEqual(ratelimit.get_stats()['throttled']['sms.number'], 1)
+
+    @override_settings(RATELIMIT_RATES={'login.ip': '10/min', 'login.user': '1/min'})
+    def test_token_throttled(self):
+        token = lambda: self.client.post('/api/token/', {'username': 'customer', 'password': 'wrong'})
+        self.assertEqual(token().status_code, 401)
+        # Throttled before the password is checked
+        self.assertEqual(token().status_code, 429)
+
+    @override_settings(RATELIMIT_ENABLED=False, RATELIMIT_RATES={'login.number': '1/min'})
+    def test_disabled(self):
+        self.assertEqual([self.client.post('/api/custom-login/', {'number': 9876543210}).status_code for request in range(2)], [200, 200])
+
+    @override_settings(RATELIMIT_MAX_IN_FLIGHT=4, RATELIMIT_SHED_AT={'low': 0.5, 'normal': 0.75})
+    def test_shedding(self):
+        shedder = ratelimit.Shedder()
+        self.assertEqual([shedder.admit(ratelimit.LOW) for request in range(3)], [True, True, False])
+        self.assertEqual([shedder.admit(ratelimit.NORMAL) for request in range(2)], [True, False])
+        self.assertEqual([shedder.admit(ratelimit.HIGH) for request in range(2)], [True, False])
+        shedder.release()
+        self.assertTrue(shedder.admit(ratelimit.HIGH))
+
+        self.assertEqual(ratelimit.get_lane('/api/checkout/'), ratelimit.HIGH)
+        self.assertEqual(ratelimit.get_lane('/api/token/refresh/'), ratelimit.LOW)
+        self.assertEqual(ratelimit.get_lane('/api/category/'), ratelimit.NORMAL)
+
+    @override_settings(RATELIMIT_MAX_IN_FLIGHT=4, RATELIMIT_SHED_AT={'low': 0.5, 'normal': 0.75})
+    def test_shedding_middleware(self):
+        shedder = ratelimit.get_shedder()
+        # Requests of other clients in flight
+        with mock.patch.object(shedder, 'inFlight', 2):
+            response = self.client.post('/api/custom-login/', {'number': 9876543210})
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response['Retry-After'], '5')
+            self.assertEqual(self.client.get('/api/category/').status_code, 200)
+            self.assertEqual(shedder.inFlight, 2)
@@ -1,5 +1,6 @@
 from django.urls import path
 from . import views
+from crud import ratelimit
 from .views import MyTokenObtainPairView
 
 # urlpatterns = [
@@ -24,11 +25,18 @@ urlpatterns = [
     path('category/', views.category, name="category"),
     path('category/<int:id>', views.categoriesFood, name="categoriesFood"),
     path('category/info/<int:id>', views.categoryInfo, name="categoryInfo"),
+    path('catalog/cache-stats/', views.catalogCacheStats, name="catalogCacheStats"),
+    path('query-stats/', views.queryStats, name="queryStats"),
+    path('notification-stats/', views.notificationStats, name="notificationStats"),
+    path('rate-limit-stats/', views.rateLimitStats, name="rateLimitStats"),
+    path('menu/manifest/', views.menuManifest, name="menuManifest"),
+    path('search/', views.search, name="search"),
     
-    # To get, add or remove item(s) from user's cart
+    # To get, add or remove item(s) from user's cart (one at a time, or several at once)
     path('get-cart-items/', views.getCartItems, name="getCartItems"),
     path('add-to-cart/<int:id>', views.addToCart, name="addToCart"),
     path('remove-from-cart/<int:id>', views.removeFromCart, name="removeFromCart"),
+    path('update-cart/', views.updateCart, name="updateCart"),
 
     # To add a user's address, and to get all the address added by the user
     path('add-address/', views.addAddress, name='addAddress'),
@@ -38,11 +46,12 @@ urlpatterns = [
     path('checkout/', views.checkout, name='checkout'),
     path('webhook/', views.webhook_received, name='webhookReceived'), 
     path('get-orders/', views.getOrders, name='getOrders'),
+    path('events/', views.orderEvents, name='orderEvents'),
     path('get-user-info/', views.getUserInfo, name='getUserInfo'),
  
     # For user authentication
     path('token/', MyTokenObtainPairView.as_view(), name='token_obtain_pair'),
-    path('token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+    path('token/refresh/', TokenRefreshView.as_view(throttle_classes=ratelimit.throttles('refresh', 'ip')), name='token_refresh'),
 
     path('custom-login/', views.customLogin, name='customLogin'),
 ]
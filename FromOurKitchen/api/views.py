@@ -1,68 +1,66 @@
-import os 
+import logging
+
+from asgiref.sync import sync_to_async
 from django.shortcuts import render
 from django.http import HttpResponse
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import IntegrityError
 from rest_framework import status
 from rest_framework.response import Response
-from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.decorators import api_view, authentication_classes, permission_classes, throttle_classes
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from rest_framework_simplejwt.views import TokenObtainPairView
-from rest_framework_simplejwt.tokens import RefreshToken
-
-from twilio.rest import Client
 
-from FromOurKitchen.models import Cart, User, Address, ActiveOrders, MobileNumber
-from FromOurKitchen.api.serializers import AddressSerializer, UserSerializer, ActiveOrdersSerializer
+from FromOurKitchen.models import User, Address, ActiveOrders, MobileNumber
+from FromOurKitchen.api.serializers import AddressSerializer, UserSerializer, ActiveOrdersSerializer, ActiveOrdersSummarySerializer
+from FromOurKitchen import cart as userCart
+from FromOurKitchen import checkout as userCheckout
+from FromOurKitchen import archive as orderArchive
+from FromOurKitchen import notifications
+from FromOurKitchen import otp
+from FromOurKitchen import stripe_events as stripeEvents
 
 from Categories.models import Category, FoodItem, Stripe
 from Categories.api.serializers import CategorySerializer, FoodItemSerializer
+from Categories.api import pagination
+from Categories import cache as catalogCache
+from Categories import menu_export
+from Categories import search as catalogSearch
+from crud import asyncviews, events, gateways, querybudget, ratelimit, tokens
+from rest_framework_simplejwt.exceptions import TokenError
+
+logger = logging.getLogger(__name__)
 
-import stripe 
 
 class MyTokenObtainPairSerializer(TokenObtainPairSerializer):
     @classmethod
     def get_token(cls, user):
         token = super().get_token(user)
 
-        # Add custom claims
-        token['username'] = user.username
-        
-        if user.groups.filter(name="category").exists():
-            token['group'] = "category"
-        else:
-            token['group'] = "None"
-        # ...
-
-        return token
+        # Add custom claims (the username and the group, see crud/tokens.py)
+        return tokens.add_claims(token, user)
 
+# Rate limited per client and per username (see crud/ratelimit.py), before the password is checked
 class MyTokenObtainPairView(TokenObtainPairView):
     serializer_class = MyTokenObtainPairSerializer
+    throttle_classes = ratelimit.throttles('login', 'ip', 'user')
 
 @api_view(['POST'])
+@throttle_classes(ratelimit.throttles('login', 'ip', 'number'))
 def customLogin(request):
     number = request.data['number']
     print('CUSTOM LOGIN')
     # Custom user authentication 
     
     try: 
-        getUserID = MobileNumber.objects.get(number=number).user.id
-        user = User.objects.get(id=getUserID)
+        user = MobileNumber.objects.select_related('user').get(number=number).user
     except ObjectDoesNotExist:
         return Response({'No user exists with that number ⚠️'}, status=status.HTTP_406_NOT_ACCEPTABLE)
 
-    refresh = RefreshToken.for_user(user)
-
-    # Add custom claims
-    refresh['username'] = user.username
-    
-    if user.groups.filter(name="category").exists():
-        refresh['group'] = "category"
-    else:
-        refresh['group'] = "None"
-    # ...
+    # With the custom claims (see crud/tokens.py)
+    refresh = tokens.for_user(user)
 
     return Response({
         'refresh': str(refresh),
@@ -72,6 +70,7 @@ def customLogin(request):
 
 # User registration logic
 @api_view(['GET', 'POST'])
+@throttle_classes(ratelimit.throttles('register', 'ip'))
 def register(request):
     username = request.data["username"]
     email = request.data["email"]
@@ -99,205 +98,251 @@ def register(request):
     return Response('Registered Successfully from backend')
 
 
-# Refer: https://www.twilio.com/docs/verify/api?code-sample=code-step-2-send-a-verification-token&code-language=Python&code-sdk-version=7.x
 # To send a text message with verification code to the requested mobile
-@api_view(['POST'])
-def mobileSendMessage(request):
+# The code is issued locally (see FromOurKitchen/otp.py), then sent: the request fails if it couldn't be
+# Async: waits on Twilio without holding a thread (see crud/asyncviews.py)
+@asyncviews.api_view(['POST'], authenticated=False, throttles=ratelimit.throttles('sms', 'ip', 'number'))
+async def mobileSendMessage(request):
     
     mobileNumber = request.data.get('number')  # Use .get() to avoid KeyError
     
     if not mobileNumber:  
-        return Response({'error': 'Mobile number is required'}, status=status.HTTP_400_BAD_REQUEST)
-
-    # Find your Account SID and Auth Token at https://twilio.com/console
-    # and set the environment variables. See http://twil.io/secure
-    account_sid = os.getenv('TWILIO_ACCOUNT_SID')
-    auth_token = os.getenv('TWILIO_AUTH_TOKEN')
-    client = Client(account_sid, auth_token)
+        return asyncviews.Response({'error': 'Mobile number is required'}, status=status.HTTP_400_BAD_REQUEST)
 
     try:
-        verification = client.verify \
-                            .services('VA24bec30d6e651140847153a21208a2f6') \
-                            .verifications \
-                            .create(to='+' + mobileNumber, channel='sms')
-
-        print(verification.status)
-        return Response({'Message Sent ✅'})
-
-    except Exception as exception:
-        # Check twilio's error code from here: https://www.twilio.com/docs/verify/api/v1/error-codes
-        if exception.code == 60200:
-            return Response({'Invalid Phone Number'}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
-        elif exception.code == 60203:
-            return Response({'Max attempts reached. Try sending message after some time ⚠️'}, status=status.HTTP_429_TOO_MANY_REQUESTS)
-        else:
-            return Response({'An unknown error occurred while sending message 🔴'}, status=status.HTTP_429_TOO_MANY_REQUESTS)
-
-
-# Refer: https://www.twilio.com/docs/verify/api?code-sample=code-step-3-check-the-verification-token&code-language=Python&code-sdk-version=7.x
-# To verify the verification code sent by Twilio to the user's mobile
+        await otp.aissue('+' + mobileNumber)
+        return asyncviews.Response({'Message Sent ✅'})
+
+    except otp.InvalidNumber:
+        return asyncviews.Response({'Invalid Phone Number'}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
+    except otp.RateLimited as exception:
+        response = asyncviews.Response(
+            {'Max attempts reached. Try sending message after some time ⚠️'}, status=status.HTTP_429_TOO_MANY_REQUESTS,
+        )
+        response['Retry-After'] = str(exception.retryAfter)
+        return response
+    except otp.DeliveryFailed as exception:
+        if exception.code in otp.INVALID_NUMBER_CODES:
+            return asyncviews.Response({'Invalid Phone Number'}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
+        return asyncviews.Response({'An unknown error occurred while sending message 🔴'}, status=status.HTTP_502_BAD_GATEWAY)
+
+
+# To verify the verification code sent to the user's mobile
+# Checked locally against the hash of the code issued (see FromOurKitchen/otp.py)
 @api_view(['POST'])
+@throttle_classes(ratelimit.throttles('verify', 'ip', 'number'))
 def mobileVerification(request):    
     mobileNumber = request.data['number']
     verificationCode = request.data['code']
 
-    # Find your Account SID and Auth Token at https://twilio.com/console
-    # and set the environment variables. See http://twil.io/secure
-    account_sid = os.getenv('TWILIO_ACCOUNT_SID')
-    auth_token = os.getenv('TWILIO_AUTH_TOKEN')
-    client = Client(account_sid, auth_token)
-
-    try:
-        verification_check = client.verify \
-                                .services('VA24bec30d6e651140847153a21208a2f6') \
-                                .verification_checks \
-                                .create(to= '+' + mobileNumber , code= verificationCode )
+    verificationStatus = otp.check('+' + mobileNumber, verificationCode)
 
-        if verification_check.status == 'approved':
-            return Response({'Phone number verified ✅'})
-        elif verification_check.status == 'pending':
-            return Response({'Invalid verification code ⚠️'}, status=status.HTTP_412_PRECONDITION_FAILED)
-        else:
-            return Response({verification_check}, status=status.HTTP_406_NOT_ACCEPTABLE)
-
-
-    except Exception as exception:
-        # Check Twilio's error codes from here: https://www.twilio.com/docs/verify/api/v1/error-codes
-        if exception.code == 60202:
-            return Response({'Max verification attempt reached. Try after some time ⚠️'})
-        else:
-            return Response({'An unknown error occurred while verifying code 🔴'}, status=status.HTTP_429_TOO_MANY_REQUESTS)
+    if verificationStatus == otp.APPROVED:
+        return Response({'Phone number verified ✅'})
+    elif verificationStatus == otp.INVALID:
+        return Response({'Invalid verification code ⚠️'}, status=status.HTTP_412_PRECONDITION_FAILED)
+    elif verificationStatus == otp.TOO_MANY_ATTEMPTS:
+        return Response({'Max verification attempt reached. Try after some time ⚠️'}, status=status.HTTP_429_TOO_MANY_REQUESTS)
+    else:
+        return Response({'Verification code expired, send a new one ⚠️'}, status=status.HTTP_406_NOT_ACCEPTABLE)
 
 
 # To view all the available/registered categories
+# Served from the catalog cache, which is invalidated whenever a category is saved or deleted.
+# Pass ?cursor= and/or ?page_size= to get the categories one page at a time (see Categories/api/pagination.py)
 @api_view(['GET'])
 def category(request):
-    # Uses the category model from the 'Categories' app
-    categories = Category.objects.all()
-    # Serialize the data for sending to frontend
-    serializer = CategorySerializer(categories, many=True)
-    return Response(serializer.data)
+    if pagination.is_paginated(request):
+        try:
+            cursor, pageSize = pagination.get_page_params(request)
+        except pagination.InvalidPage as e:
+            return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+
+        def buildPage():
+            page = pagination.paginate(Category.objects.all(), cursor, pageSize)
+            return pagination.page_data(page, list(CategorySerializer(page.results, many=True).data))
+
+        return Response(catalogCache.get_categories(buildPage, kind=f'page:{cursor}:{pageSize}'))
+
+    def build():
+        # Uses the category model from the 'Categories' app
+        categories = Category.objects.all()
+        # Serialize the data for sending to frontend
+        return list(CategorySerializer(categories, many=True).data)
+
+    return Response(catalogCache.get_categories(build))
     
 
 # To get the food items of the requested category. (food items added by that category)
+# Served from the catalog cache, which is invalidated whenever a food item of this category changes.
+# Pass ?cursor= and/or ?page_size= to get the food items one page at a time
 @api_view(['GET'])
 def categoriesFood(request, id):
+    if pagination.is_paginated(request):
+        try:
+            cursor, pageSize = pagination.get_page_params(request)
+        except pagination.InvalidPage as e:
+            return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+
+        def build():
+            # Get the requested category
+            category = Category.objects.get(id=id)
+            page = pagination.paginate(FoodItem.objects.filter(category=category), cursor, pageSize)
+            return pagination.page_data(page, list(FoodItemSerializer(page.results, many=True).data))
+
+        kind = f'food:page:{cursor}:{pageSize}'
+    else:
+        def build():
+            # Get the requested category
+            category = Category.objects.get(id=id)
+            # Get the food items of the above category
+            categoriesFood = FoodItem.objects.filter(category = category)
+            return list(FoodItemSerializer(categoriesFood, many=True).data)
+
+        kind = 'food'
+
     try:
-        # Get the requested category
-        category = Category.objects.get(id=id)
-        # Get the food items of the above category
-        categoriesFood = FoodItem.objects.filter(category = category)
-    except :
+        data = catalogCache.get_category_data(id, kind, build)
+    except Category.DoesNotExist:
         return Response('Not found', status=status.HTTP_404_NOT_FOUND)
     
-    serializer = FoodItemSerializer(categoriesFood, many=True)
-    return Response(serializer.data)
+    return Response(data)
+
+
+# To get the URL of the current static menu export (see Categories/menu_export.py).
+# Clients can fetch the whole menu from there without going through Django.
+@api_view(['GET'])
+def menuManifest(request):
+    manifest = menu_export.read_manifest()
+    if manifest is None:
+        return Response('Menu has not been exported yet', status=status.HTTP_404_NOT_FOUND)
+    return Response(manifest)
 
 
 # To get the info of the requested category
 @api_view(['GET'])
 def categoryInfo(request, id):
-    try:
+    def build():
         # Get the requested category
         category = Category.objects.filter(id=id)
-    except KeyError:
-        return Response('Not found', status=status.HTTP_404_NOT_FOUND)
+        return list(CategorySerializer(category, many=True).data)
 
-    serializer = CategorySerializer(category, many=True)
-    return Response(serializer.data)
+    return Response(catalogCache.get_category_data(id, 'info', build))
+
+
+# Hit, miss and invalidation counters of the catalog cache (for the current process)
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def catalogCacheStats(request):
+    return Response(catalogCache.get_stats())
+
+
+# Pending, sent and failed text SMS, and the send latency. Refer to FromOurKitchen/notifications.py
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def notificationStats(request):
+    return Response(notifications.get_stats())
+
+
+# Throttled requests per scope, shed requests per lane and requests in flight (for the current process).
+# Refer to crud/ratelimit.py. Authenticated with the claims of the token alone, so reading the stats
+# doesn't reach the database
+@api_view(['GET'])
+@authentication_classes([tokens.ClaimsAuthentication])
+@permission_classes([IsAdminUser])
+def rateLimitStats(request):
+    return Response(ratelimit.get_stats())
+
+
+# Queries and DB time of each view (for the current process). Refer to crud/querybudget.py
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def queryStats(request):
+    return Response(querybudget.get_stats())
+
+
+# To search the food items (by name, description and category name) and the categories.
+# Matches are ranked, words can be typed partially ("pan") or with a typo ("panner").
+# Refer to Categories/search.py for more info
+@api_view(['GET'])
+def search(request):
+    query = request.query_params.get('q', '').strip()
+    if not query:
+        return Response('A search query is required', status=status.HTTP_400_BAD_REQUEST)
+    try:
+        limit = min(int(request.query_params.get('limit', 20)), 50)
+    except ValueError:
+        return Response('Invalid limit', status=status.HTTP_400_BAD_REQUEST)
+
+    results = catalogSearch.search(query, max(limit, 1))
+
+    # Fetch the matched rows in one query each, and keep them in the ranked order
+    foodItems = FoodItem.objects.in_bulk(results['food'])
+    categories = Category.objects.in_bulk(results['category'])
+    return Response({
+        'categories': CategorySerializer([categories[id] for id in results['category'] if id in categories], many=True).data,
+        'foodItems': FoodItemSerializer([foodItems[id] for id in results['food'] if id in foodItems], many=True).data,
+    })
 
 
 # To get the items in the cart of the requested user
 @api_view(['GET'])
+@authentication_classes([tokens.ClaimsAuthentication])
 @permission_classes([IsAuthenticated])
 def getCartItems(request):    
-    cart = Cart.objects.filter(user=request.user)
+    cart = userCart.get_items(request.user)
     # Custom serializer function is used for serializing the data. Refer to the Cart Model for more info about the serializer
     return Response([cart.serializer() for cart in cart])
     
 
 # To add a food item to cart
+# If the user's cart contains the requested food item, then its quantity is increased by 1,
+# else it's added with quantity 1. Refer to FromOurKitchen/cart.py for more info
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def addToCart(request, id):
-    # Add the food item to the user's cart
-    try:
-        # Get the requested foodItem
-        food = FoodItem.objects.get(id=id)
-
-        # For adding the item to cart
-
-        # If the user's cart contains the requested food item, then increase it's quantity by 1
-        try:
-            getFood =  Cart.objects.get(food=food, user=request.user)
-            getFood.qty += 1
-            # Update the amount of the food item added in cart in accordance of it's quantity
-            getFood.amount = float(food.price * getFood.qty)
-            getFood.save()
-        # If the cart doesn't contain the food, then add it to cart and set quantity to 1
-        except ObjectDoesNotExist :
-            addItem = Cart(user=request.user, food=food, qty=1, amount=food.price)
-            addItem.save()
-            
-        # Update the cart's totalAmount by adding the current food item's price
-        oldTotalAmount = Cart.objects.filter(user=request.user).first().totalAmount
-        Cart.objects.filter(user=request.user).update(totalAmount = float(oldTotalAmount+food.price))
-        
-
-        # Get the added cart item of the requested user (for passing to serializer)
-        cart = Cart.objects.get(user=request.user, food=id)
-    
     # If a request is made with an invalid food ID, i.e food item doesn't exist, then return error
-    except KeyError:
+    if not userCart.add_item(request.user, id):
         return Response('Not found', status=status.HTTP_404_NOT_FOUND)
+
+    # Get the added cart item of the requested user (for passing to serializer)
+    cart = userCart.get_item(request.user, id)
     
     # Serialize the cart for sending to frontend in appropriate format
     return Response(cart.serializer())
     
 
 # To remove a food item from cart
+# Decreases the quantity of the food item in the user's cart by 1 (the item is removed at 0)
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def removeFromCart(request, id):
-    # Remove the food item from the user's cart
-    try:
-        # Get the requested foodItem
-        food = FoodItem.objects.get(id=id)
-        # If the user's cart contains the requested food item, then decrease it's quantity by 1
-        try:
-            getFood =  Cart.objects.get(food=food, user=request.user)
-            # If the item's quantity is more than 1, then decrease it's quantity
-            if getFood.qty > 1:
-                getFood.qty -= 1
-                # Update the amount of the food items removed from cart in accordance with its quantity
-                getFood.amount = food.price * getFood.qty
-                getFood.save()
-            # If the item's quantity is 1 i.e the last item, then delete the item
-            elif getFood.qty == 1:
-                getFood.delete()
-            # Else throw an error if qty is less than 1
-            else :
-                # If food qty is already 0, then return
-                return Response('Food already removed from cart', status=status.HTTP_406_NOT_ACCEPTABLE)
-                
-
-        # If the cart doesn't contain the food, then return
-        except ObjectDoesNotExist :
-            return Response('Food is not present in the cart', status=status.HTTP_404_NOT_FOUND)
-        try:
-            # Update the cart's totalAmount by subtracting the current food item's price
-            oldTotalAmount = Cart.objects.filter(user=request.user).first().totalAmount
-            Cart.objects.filter(user=request.user).update(totalAmount = float(oldTotalAmount-food.price))
-        except AttributeError:
-            pass    
-
-    # If a request is made with an invalid food ID, i.e food item doesn't exist, then return error
-    except KeyError:
-        return Response('Not found', status=status.HTTP_404_NOT_FOUND)
+    # If the cart doesn't contain the food, then return
+    if not userCart.remove_item(request.user, id):
+        return Response('Food is not present in the cart', status=status.HTTP_404_NOT_FOUND)
     
     return Response('Removed from cart')
 
 
+# To apply several changes to the cart at once, e.g. a quick "+ + + -" on the menu.
+# Takes a list of changes, each one setting the quantity of a food item or changing it by a delta:
+#   {"items": [{"food_id": 3, "qty": 2}, {"food_id": 5, "delta": -1}]}
+# The changes are applied in order, all or nothing. Returns the updated cart (same as getCartItems)
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def updateCart(request):
+    changes = request.data if isinstance(request.data, list) else request.data.get('items')
+    try:
+        userCart.update_items(request.user, changes)
+    except userCart.InvalidCartUpdate as e:
+        return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+    except FoodItem.DoesNotExist:
+        return Response('Not found', status=status.HTTP_404_NOT_FOUND)
+
+    cart = userCart.get_items(request.user)
+    return Response([cart.serializer() for cart in cart])
+
+
 # To add an address of a user
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
@@ -313,10 +358,11 @@ def addAddress(request):
 
 # To get all the added address of a user
 @api_view(['GET'])
+@authentication_classes([tokens.ClaimsAuthentication])
 @permission_classes([IsAuthenticated])
 def getAddress(request):
 
-    address = Address.objects.filter(user=request.user)
+    address = Address.objects.filter(user_id=request.user.id)
     serializer = AddressSerializer(address, many=True)
 
     
@@ -326,46 +372,25 @@ def getAddress(request):
 
 # To place an order of a customer with the requested data
 # Creates a Stripe checkout session and returns back a URL to redirect to.
+# Checking out the same cart again (e.g. a double-click) returns the same session, until it expires.
 # Refer: https://stripe.com/docs/connect/enable-payment-acceptance-guide?platform=web#web-create-checkout for more information.
-@api_view(['POST'])
-@permission_classes([IsAuthenticated])  
-def checkout(request):
+# Async: waits on Stripe without holding a thread (see crud/asyncviews.py)
+@asyncviews.api_view(['POST'])
+async def checkout(request):
 
-    stripe.api_key = 'sk_test_51QmXiwGxJCMHsai04rgrfwstnIM16SB5jS2oTor9UFRbOWy0skksq0mVoRNgWItynzq3Bb3cGaP46Xq9v2hWgAUA004e6WwLXJ'
-    
-    # Get the cart items of the user
-    cart = Cart.objects.filter(user=request.user)
     # Get the chosen delivery address passed from the frontend
     addressID = request.data['address'].get('id')
 
-    # Get the category, from which the user wishes to buy food from
-    getCartFoodID = cart.first().food.id
-    getCategory = FoodItem.objects.get(id=getCartFoodID).category
-    # Get the associated stripe account ID of the category. (Stored when category signed up with Stripe)
-    accountID = Stripe.objects.get(category=getCategory).accountID
-    
-    line_items = []
-    for item in cart:
-        # Create a price object for each food item in the cart
-        price_data = {
-            'currency': 'inr',  # Ensure currency is correct as per your needs
-            'unit_amount': int(item.food.price * 100),  # Convert price to cents (as Stripe expects amounts in cents)
-            'product_data': {
-                'name': item.food.name,
-                'description': item.food.description,
-            },
-        }
-        
-        line_items.append({
-            'price_data': price_data,
-            'quantity': item.qty,
-        })
-
-    # To create a stripe checkout session which returns back the checkout session url
-    try:
-        session = stripe.checkout.Session.create(
+    # To create a stripe checkout session for the quote of the user's cart (see FromOurKitchen/checkout.py),
+    # when the same cart isn't already being paid
+    async def createSession(quote, idempotencyKey, expiresAt):
+        await asyncviews.release_connection()
+        # To create a stripe checkout session which returns back the checkout session url
+        return await gateways.payments().acreate_checkout_session(
+            # A retried request gets the session created by the first one
+            idempotencyKey = idempotencyKey,
             payment_method_types=['card'],
-            line_items=line_items,
+            line_items=quote.line_items(),
             mode='payment',
             currency='inr',
             success_url= 'https://online-food-delivery-system.vercel.app/my-account',
@@ -376,37 +401,45 @@ def checkout(request):
                 "user" : str(request.user.id),
                 "addressID" : str(addressID), 
             }, 
+            # The payment goes to the Stripe account of the category the food is ordered from
+            # (stored when the category signed up with Stripe)
             payment_intent_data={
                 'transfer_data':{
-                    'destination':'acct_1QnQVMGdffKEtkPL',
+                    'destination': quote.accountId,
                 }
             },
-            stripe_account = 'acct_1QmXiwGxJCMHsai0',
+            expires_at = expiresAt,
         )
-         
-    except Exception as e:
-        print('ERROR: ', e)
-        return Response({'This category has not setup payment acceptance with Stripe yet !'}, status=status.HTTP_412_PRECONDITION_FAILED)
 
-    return Response({session.url}, status=status.HTTP_303_SEE_OTHER)
+    try:
+        session = await userCheckout.aget_session(request.user, addressID, createSession)
+    except userCheckout.EmptyCart as e:
+        return asyncviews.Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+    except userCheckout.PricesChanged:
+        # The cart takes the current prices, for the customer to review before checking out again
+        await sync_to_async(userCart.reprice_items)(request.user)
+        return asyncviews.Response({'Some prices changed, please review your cart ⚠️'}, status=status.HTTP_409_CONFLICT)
+    except userCheckout.NoPayoutAccount:
+        return asyncviews.Response({'This category has not setup payment acceptance with Stripe yet !'}, status=status.HTTP_412_PRECONDITION_FAILED)
+    except (userCheckout.CheckoutInProgress, gateways.IdempotencyConflict):
+        # Another checkout of the user (e.g. a double-click) is creating its session
+        return asyncviews.Response({'Your checkout is already in progress, please try again in a moment'}, status=status.HTTP_409_CONFLICT)
+    except gateways.PaymentsError as e:
+        logger.warning('Creating the checkout session failed: %s (%s)', e, e.code)
+        return asyncviews.Response({'The payment could not be started, please try again'}, status=status.HTTP_502_BAD_GATEWAY)
+    return asyncviews.Response({session.url}, status=status.HTTP_303_SEE_OTHER)
 
 
 
 
 # Stripe webhook to check if the payment is completed
-# If payment is successfully completed, then save the order details
+# The event is saved and answered at once, then processed in the background: if the payment is
+# successfully completed, the order is saved. Refer to FromOurKitchen/stripe_events.py
 @api_view(['POST'])
 def webhook_received(request):
 
-    stripe.api_key = os.getenv('STRIPE_API_KEY')
-    endpoint_secret = os.getenv('endpoint_secret') 
-
     payload = request.body
-    sig_header = request.META['HTTP_STRIPE_SIGNATURE']
-    event = None
-
-    print("Received payload:", payload)  # Debugging
-    print("Received signature:", sig_header)  # Debugging
+    sig_header = request.META.get('HTTP_STRIPE_SIGNATURE')
 
     if not sig_header:
         return HttpResponse({"error": "Missing Stripe-Signature header"}, status=400)
@@ -414,93 +447,62 @@ def webhook_received(request):
     # Verify webhook signature and extract the event.
     # See https://stripe.com/docs/webhooks/signatures for more information.
     try:
-        event = stripe.Webhook.construct_event(
-            payload, sig_header, endpoint_secret
-        )
-    except ValueError as e:
-        # Invalid payload.
-        print("Error: Invalid payload")  # Debugging
-        return HttpResponse({"error": "Invalid signature"},status=400)
-    except stripe.error.SignatureVerificationError as e:
-        # Invalid Signature.
-        print("Error: Invalid signature")  # Debugging
+        event = gateways.payments().construct_event(payload, sig_header)
+    except gateways.InvalidWebhook as e:
+        # Invalid payload or signature.
+        logger.warning('Invalid Stripe webhook: %s', e)
         return HttpResponse({"error": "Invalid signature"},status=400)
 
-    if event["type"] == "checkout.session.completed":
-        session = event["data"]["object"]
-
-        payment_intent_id = session['payment_intent']
-        # Fetch the PaymentIntent
-        payment_intent = stripe.PaymentIntent.retrieve(payment_intent_id)
-        # Get the destination connected account from transfer_data
-        connected_account_id = payment_intent['transfer_data']['destination']
-        handle_completed_checkout_session(connected_account_id, session, request)
-
-    else:
-        print('Unhandled event type {}'.format(event['type']))
-        
+    # A redelivered event (already saved) is answered the same
+    stripeEvents.receive(event, payload)
     return HttpResponse(status=200)
 
 
+# To get the orders of the logged in user, newest first, archived ones included (see FromOurKitchen/archive.py)
+# Pass ?cursor= and/or ?page_size= to get the orders one page at a time (see Categories/api/pagination.py),
+# and ?summary=1 to only get the number of items and the total of each order. Without pages, pass
+# ?since= and/or ?until= (YYYY-MM-DD) to only get the orders of those dates
+@api_view(['GET'])
+@authentication_classes([tokens.ClaimsAuthentication])
+@permission_classes([IsAuthenticated])
+def getOrders(request):
+    orders = ActiveOrders.objects.filter(user_id=request.user.id)
+    if request.query_params.get('summary') in ('1', 'true'):
+        orders = ActiveOrdersSummarySerializer.annotate(orders)
+        serializerClass = ActiveOrdersSummarySerializer
+    else:
+        orders = ActiveOrdersSerializer.prefetch(orders)
+        serializerClass = ActiveOrdersSerializer
 
+    if pagination.is_paginated(request):
+        try:
+            cursor, pageSize = pagination.get_page_params(request)
+        except pagination.InvalidPage as e:
+            return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+        page = orderArchive.paginate_orders(request.user, orders, cursor, pageSize)
+        return Response(pagination.page_data(page, serializerClass(page.results, many=True).data))
 
-# If the checkout is completed, then call this function
-def handle_completed_checkout_session(connected_account_id, session, request):
-    # Fulfill the purchase.
-    print('Connected account ID: ' + connected_account_id)
-    print('PAYMENT COMPLETED ✅', str(session))
-    
-    # ---- Save the order details ----
-
-    # Get the cart items of the user
-    sessionUser = User.objects.get(id = session.metadata.user)
-    cart = Cart.objects.filter(user=sessionUser)
-    # Get the chosen delivery address passed from the frontend
-    addressID = session.metadata.addressID
-    address = Address.objects.get(id=addressID)
-    # Save the details in active orders model
-    addOrder = ActiveOrders(user=sessionUser, address=address)
-    addOrder.save()
-    # Add the user's cart's foodItems to the active order which user has placed
-    for cartItem in cart:
-        addOrder.cart.add(cartItem)
-
-    print('Saved order details ✅')
-    
-
-    # ------- To send the user a text SMS using Twilio informing about their successfull order placement -----
-    if os.getenv('TWILIO_ENABLED', 'False') == 'True':
-        number = MobileNumber.objects.get(user=sessionUser).number
-
-        # Find your Account SID and Auth Token at twilio.com/console
-        # and set the environment variables. See http://twil.io/secure
-        account_sid = os.getenv('TWILIO_ACCOUNT_SID')
-        auth_token = os.getenv('TWILIO_AUTH_TOKEN')
-        client = Client(account_sid, auth_token)
-
-        message = client.messages \
-                        .create(
-                            messaging_service_sid='MGf50dd0f886cfaa39b05a96200c338c37',
-                            to='+' + str(number),
-                            body="From Our Kitchen: Order Placed (" + str(cart.count()) + " item(s), Rs." + str(cart.first().totalAmount) +").\nHappy Eating!"
-                        )
+    try:
+        since, until = orderArchive.get_date_range(request)
+    except orderArchive.InvalidDateRange as e:
+        return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
 
-        print('Message sent ✅:', message.status)
-    else:
-        print("🔕 Twilio messaging is currently disabled (TWILIO_ENABLED is False)")
+    serializer = serializerClass(orderArchive.get_orders(request.user, orders, since, until), many=True)
+    return Response(serializer.data)
 
 
-# To get the active orders of the logged in user
-@api_view(['GET'])
-@permission_classes([IsAuthenticated])
-def getOrders(request):
+# To push the logged in user's order events (order.created, order.status) as server-sent events
+# (see crud/events.py). Not a DRF view: those are sync, while this one waits for events on the
+# event loop of the ASGI app, without holding a thread
+async def orderEvents(request):
     try:
-        orders = ActiveOrders.objects.filter(user=request.user).order_by('-id')  # Adjust the filter based on your model
-        serializer = ActiveOrdersSerializer(orders, many=True)
-        return Response(serializer.data)
-    except Exception as e:
-        print("Error:", e)
-        return Response({"error": "Internal server error"}, status=500)
+        token = events.get_access_token(request)
+    except TokenError as e:
+        return HttpResponse(str(e), status=status.HTTP_401_UNAUTHORIZED)
+    userId = token['user_id']
+    if not await User.objects.filter(id=userId, is_active=True).aexists():
+        return HttpResponse('User not found', status=status.HTTP_401_UNAUTHORIZED)
+    return await events.stream(f'user:{userId}', token)
 
 
 # To get the info of the logged in user like name, email etc.
@@ -526,14 +528,23 @@ def getRoutes(request):
         '/api/category/',
         '/api/category/<int:id>/',
         '/api/category/info/<int:id>/',
+        '/api/catalog/cache-stats/',
+        '/api/query-stats/',
+        '/api/notification-stats/',
+        '/api/rate-limit-stats/',
+        '/api/menu/manifest/',
+        '/api/search/?q=<query>',
         '/api/get-cart-items/',
         '/api/add-to-cart/<int:id>/',
         '/api/remove-from-cart/<int:id>/',
+        '/api/update-cart/',
         '/api/add-address/',
         '/api/get-address/',
         '/api/checkout/',
         '/api/webhook/',
         '/api/get-orders/',
+        '/api/get-orders/?summary=1',
+        '/api/events/',
         '/api/get-user-info/',
         '/api/custom-login/',
     ]
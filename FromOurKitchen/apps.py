@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class FromourkitchenConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'FromOurKitchen'
+
+    def ready(self):
+        # Connects the token role cache invalidation signals
+        from . import signals  # noqa: F401
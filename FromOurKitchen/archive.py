@@ -0,0 +1,335 @@
+import json
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Prefetch
+from django.db.models.functions import Greatest, Least
+from django.utils.dateparse import parse_date
+
+from Categories.api import pagination
+from FromOurKitchen.models import ActiveOrders, Address, OrderArchivePartition, OrderLine
+
+
+# Archive of the delivered orders.
+#
+# Delivered orders (active=False) older than ORDER_ARCHIVE_AFTER_DAYS are moved out of ActiveOrders,
+# which every order view reads, into one table per month of the order date:
+#   - on Postgres, the monthly partitions of FromOurKitchen_orderarchive (PARTITION BY RANGE (date),
+#     created by migration 0012), so old months can be detached or dropped as a whole
+#   - on other databases (SQLite), plain tables FromOurKitchen_orderarchive_<year>_<month>
+# Both have the columns of CREATE_TABLE_QUERY. An archived order is a single row, with its address
+# and its lines as JSON: archived orders never change, and are read back with their lines in a single query.
+#
+# A customer's order history (newest first) only reads the archive once the page goes past the live
+# orders, and then only the month tables which can hold orders of the page:
+#   - ids grow with time, and archived orders are older than ORDER_ARCHIVE_AFTER_DAYS, so a page of
+#     live orders ending with a more recent order has no archived orders (no query)
+#   - otherwise OrderArchivePartition, the range of ids of each month table, gives the tables to read
+# The whole history can be limited to a range of order dates (?since=&until=), which only reads the
+# month tables of the range, and not the archive at all when the range starts after the cutoff.
+
+PARENT_TABLE = 'FromOurKitchen_orderarchive'
+
+COLUMNS = ['id', 'user_id', 'category_id', 'date', 'time', 'updated', 'totalPaise', 'itemCount', 'address', 'lines']
+
+CREATE_TABLE_QUERY = '''
+CREATE TABLE IF NOT EXISTS {table} (
+    "id" bigint NOT NULL,
+    "user_id" integer NOT NULL,
+    "category_id" bigint NULL,
+    "date" date NOT NULL,
+    "time" time NOT NULL,
+    "updated" timestamp NOT NULL,
+    "totalPaise" integer NOT NULL,
+    "itemCount" integer NOT NULL,
+    "address" text NOT NULL,
+    "lines" text NOT NULL,
+    PRIMARY KEY ("id", "date")
+){partitioning}
+'''
+
+# For a user's archived orders, newest first
+CREATE_INDEX_QUERY = 'CREATE INDEX IF NOT EXISTS {index} ON {table} ("user_id", "id")'
+
+CREATE_PARTITION_QUERY = 'CREATE TABLE IF NOT EXISTS {table} PARTITION OF {parent} FOR VALUES FROM (%s) TO (%s)'
+
+INSERT_QUERY = 'INSERT INTO {table} ({columns}) VALUES ({values}) ON CONFLICT DO NOTHING'
+
+
+class InvalidDateRange(Exception):
+    pass
+
+
+def is_partitioned():
+    return connection.vendor == 'postgresql'
+
+
+def _quote(name):
+    return connection.ops.quote_name(name)
+
+
+def month_start(day):
+    return day.replace(day=1)
+
+
+def next_month(day):
+    return (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+
+def table_name(month):
+    return f'{PARENT_TABLE}_{month.year}_{month.month:02d}'
+
+
+# To create the table of the month if needed, returns its OrderArchivePartition (covering orderIds)
+def _get_partition(month, orderIds):
+    table = table_name(month)
+    with connection.cursor() as cursor:
+        if is_partitioned():
+            cursor.execute(
+                CREATE_PARTITION_QUERY.format(table=_quote(table), parent=_quote(PARENT_TABLE)),
+                [month, next_month(month)],
+            )
+        else:
+            cursor.execute(CREATE_TABLE_QUERY.format(table=_quote(table), partitioning=''))
+            cursor.execute(CREATE_INDEX_QUERY.format(index=_quote(f'{table}_user_id_idx'), table=_quote(table)))
+
+    partition, created = OrderArchivePartition.objects.get_or_create(
+        month=month, defaults={'table': table, 'minId': min(orderIds), 'maxId': max(orderIds)},
+    )
+    if not created:
+        OrderArchivePartition.objects.filter(id=partition.id).update(
+            minId=Least('minId', min(orderIds)), maxId=Greatest('maxId', max(orderIds)),
+        )
+    return partition
+
+
+# The date and time columns, as stored by the database backend (e.g. strings on SQLite)
+def _temporal(name, value, prepare=True):
+    field = ActiveOrders._meta.get_field(name)
+    return field.get_db_prep_value(value, connection) if prepare else field.to_python(value)
+
+
+def _archive_row(order):
+    lines = [
+        {
+            'id': line.id, 'food': line.food_id, 'name': line.name, 'image': line.image.name,
+            'qty': line.qty, 'pricePaise': line.pricePaise, 'amountPaise': line.amountPaise,
+        }
+        for line in order.lines.all()
+    ]
+    address = {'id': order.address.id, 'user': order.address.user_id, 'area': order.address.area, 'label': order.address.label}
+    return [
+        order.id, order.user_id, order.category_id,
+        _temporal('date', order.date), _temporal('time', order.time), _temporal('updated', order.updated),
+        order.totalPaise, sum(line['qty'] for line in lines), json.dumps(address), json.dumps(lines),
+    ]
+
+
+def _archive_after_days():
+    return getattr(settings, 'ORDER_ARCHIVE_AFTER_DAYS', 90)
+
+
+def _cutoff(olderThanDays=None):
+    if olderThanDays is None:
+        olderThanDays = _archive_after_days()
+    return date.today() - timedelta(days=olderThanDays)
+
+
+# To move a batch of delivered orders (ordered before the cutoff) to the archive, in a transaction.
+# Returns the number of orders archived, 0 once there are none left
+def archive_batch(cutoff, batchSize):
+    with transaction.atomic():
+        orders = ActiveOrders.objects.filter(active=False, date__lt=cutoff).order_by('id')
+        if connection.features.has_select_for_update_skip_locked:
+            # Concurrent runs archive different orders
+            orders = orders.select_for_update(skip_locked=True, of=('self',))
+        orders = list(
+            orders.select_related('address')
+            .prefetch_related(Prefetch('lines', queryset=OrderLine.objects.order_by('id')))[:batchSize]
+        )
+        if not orders:
+            return 0
+
+        months = {}
+        for order in orders:
+            months.setdefault(month_start(order.date), []).append(order)
+        for month, monthOrders in sorted(months.items()):
+            partition = _get_partition(month, [order.id for order in monthOrders])
+            query = INSERT_QUERY.format(
+                table=_quote(partition.table),
+                columns=', '.join(_quote(column) for column in COLUMNS),
+                values=', '.join(['%s'] * len(COLUMNS)),
+            )
+            with connection.cursor() as cursor:
+                cursor.executemany(query, [_archive_row(order) for order in monthOrders])
+
+        # Deletes their lines too
+        ActiveOrders.objects.filter(id__in=[order.id for order in orders]).delete()
+    return len(orders)
+
+
+# To archive the delivered orders older than olderThanDays (ORDER_ARCHIVE_AFTER_DAYS by default),
+# batchSize orders per transaction and at most maxBatches batches (all of them by default).
+# Returns the number of orders archived
+def archive_orders(olderThanDays=None, batchSize=None, maxBatches=None):
+    if olderThanDays is not None and olderThanDays < _archive_after_days():
+        # The order history relies on archived orders being older than that
+        raise ValueError(f'Orders can only be archived after {_archive_after_days()} days (ORDER_ARCHIVE_AFTER_DAYS)')
+    cutoff = _cutoff(olderThanDays)
+    batchSize = batchSize or getattr(settings, 'ORDER_ARCHIVE_BATCH_SIZE', 500)
+    archived = batches = 0
+    while maxBatches is None or batches < maxBatches:
+        count = archive_batch(cutoff, batchSize)
+        archived += count
+        batches += 1
+        if count < batchSize:
+            break
+    return archived
+
+
+# An archived order, as an unsaved ActiveOrders with its address and its lines loaded, so that it
+# serializes like a live one
+def _from_archive_row(row):
+    values = dict(zip(COLUMNS, row))
+    address = json.loads(values.pop('address'))
+    lines = json.loads(values.pop('lines'))
+    itemCount = values.pop('itemCount')
+    for name in ('date', 'time', 'updated'):
+        values[name] = _temporal(name, values[name], prepare=False)
+    order = ActiveOrders(active=False, **values)
+    # As annotated by ActiveOrdersSummarySerializer
+    order.itemCount = itemCount
+    order.address = Address(id=address['id'], user_id=address['user'], area=address['area'], label=address['label'])
+    order._prefetched_objects_cache = {'lines': [
+        OrderLine(
+            id=line['id'], order=order, food_id=line['food'], name=line['name'], image=line['image'],
+            qty=line['qty'], pricePaise=line['pricePaise'], amountPaise=line['amountPaise'],
+        )
+        for line in lines
+    ]}
+    return order
+
+
+# The archived orders of the user in the partitions, with an id between after and before (excluded)
+# and ordered between since and until (included), at most limit of them, newest first (or oldest
+# first with descending=False). A single query
+def _read_archive(partitions, userId, before=None, after=None, limit=None, descending=True, since=None, until=None):
+    if not partitions:
+        return []
+    conditions, params = ['"user_id" = %s'], [userId]
+    if before is not None:
+        conditions.append('"id" < %s')
+        params.append(before)
+    if after is not None:
+        conditions.append('"id" > %s')
+        params.append(after)
+    if since is not None:
+        conditions.append('"date" >= %s')
+        params.append(_temporal('date', since))
+    if until is not None:
+        conditions.append('"date" <= %s')
+        params.append(_temporal('date', until))
+
+    columns = ', '.join(_quote(column) for column in COLUMNS)
+    selects = []
+    for partition in partitions:
+        selects.append(f'SELECT {columns} FROM {_quote(partition.table)} WHERE {" AND ".join(conditions)}')
+    query = ' UNION ALL '.join(selects) + f' ORDER BY "id" {"DESC" if descending else "ASC"}'
+    if limit is not None:
+        query += f' LIMIT {int(limit)}'
+
+    with connection.cursor() as cursor:
+        cursor.execute(query, params * len(partitions))
+        rows = cursor.fetchall()
+    return [_from_archive_row(row) for row in rows]
+
+
+# The partitions holding ids in (after, before), and the months of the dates from since to until
+def _partitions(before=None, after=None, since=None, until=None):
+    partitions = OrderArchivePartition.objects.order_by('-month')
+    if before is not None:
+        partitions = partitions.filter(minId__lt=before)
+    if after is not None:
+        partitions = partitions.filter(maxId__gt=after)
+    if since is not None:
+        partitions = partitions.filter(month__gte=month_start(since))
+    if until is not None:
+        partitions = partitions.filter(month__lte=until)
+    return list(partitions)
+
+
+# Returns the (since, until) range of order dates requested, validated (None for an open end)
+def get_date_range(request):
+    dates = []
+    for name in ('since', 'until'):
+        value = request.query_params.get(name) or None
+        # parse_date returns None for a string not looking like a date, raises ValueError for an invalid one
+        try:
+            day = parse_date(value) if value is not None else None
+        except ValueError:
+            day = None
+        if value is not None and day is None:
+            raise InvalidDateRange(f'Invalid {name}')
+        dates.append(day)
+    since, until = dates
+    if since is not None and until is not None and since > until:
+        raise InvalidDateRange('since is after until')
+    return since, until
+
+
+# All the orders of the user ordered from since to until (the whole history by default), newest
+# first: orders (the user's live orders, prefetched or annotated for the serializer), then the
+# archived ones. Only the month tables of the range are read, and none if it starts after the cutoff
+def get_orders(user, orders, since=None, until=None):
+    if since is not None:
+        orders = orders.filter(date__gte=since)
+    if until is not None:
+        orders = orders.filter(date__lte=until)
+    orders = list(orders.order_by('-id'))
+    if since is not None and since >= _cutoff():
+        # The orders archived so far were ordered before the cutoff
+        archived = []
+    else:
+        archived = _read_archive(_partitions(since=since, until=until), user.id, since=since, until=until)
+    return sorted(orders + archived, key=lambda order: order.id, reverse=True)
+
+
+# A page of the orders of the user, newest first, as pagination.paginate(orders, cursor, pageSize, descending=True)
+# returns it. The archive is read when the live orders don't fill the page, or when archived orders
+# are newer than the last live order of the page
+def paginate_orders(user, orders, cursor, pageSize):
+    direction, boundary = pagination.decode_cursor(cursor)
+    descending = direction == pagination.NEXT
+
+    if descending:
+        if boundary is not None:
+            orders = orders.filter(id__lt=boundary)
+        rows = list(orders.order_by('-id')[:pageSize + 1])
+    else:
+        rows = list(orders.filter(id__gt=boundary).order_by('id')[:pageSize + 1])
+
+    # Archived orders can only be part of the page between the boundary and the last live order read
+    # (or beyond it if there are no more live orders)
+    end = rows[-1].id if len(rows) > pageSize else None
+    if descending and end is not None and rows[-1].date >= _cutoff():
+        # The orders archived so far are older than the last live order read
+        archived = []
+    elif descending:
+        partitions = _partitions(before=boundary, after=end)
+        archived = _read_archive(partitions, user.id, before=boundary, after=end, limit=pageSize + 1)
+    else:
+        partitions = _partitions(before=end, after=boundary)
+        archived = _read_archive(partitions, user.id, before=end, after=boundary, limit=pageSize + 1, descending=False)
+
+    rows = sorted(rows + archived, key=lambda order: order.id, reverse=descending)[:pageSize + 1]
+    hasMore = len(rows) > pageSize
+    rows = rows[:pageSize]
+    if descending:
+        next = pagination.encode_cursor(pagination.NEXT, rows[-1].id) if hasMore else None
+        previous = pagination.encode_cursor(pagination.PREVIOUS, rows[0].id) if boundary is not None and rows else None
+    else:
+        rows.reverse()
+        previous = pagination.encode_cursor(pagination.PREVIOUS, rows[0].id) if hasMore else None
+        next = pagination.encode_cursor(pagination.NEXT, rows[-1].id) if rows else None
+    return pagination.Page(rows, next, previous, pageSize)
@@ -0,0 +1,207 @@
+from django.db import connection, transaction
+from django.db.models import F
+
+from Categories.models import FoodItem
+from FromOurKitchen.models import Cart, UserCart
+
+
+# Cart mutations. Each one is two statements in a transaction, one on the cart item and one on the
+# user's cart total, both done by the database (no read-modify-write), so concurrent clicks can't
+# lose updates. Prices and amounts are integers, in paise.
+#
+# The items are locked before the total, in every mutation, so concurrent mutations of the same
+# cart can't deadlock.
+#
+# The upserts are plain SQL, as the ORM can't insert from a select or increment on conflict. They
+# run on both SQLite and Postgres.
+
+# Adds the food item with qty 1 (at its current price), or increases the qty by 1.
+# An item removed earlier (qty 0) takes the current price again
+ADD_ITEM_QUERY = '''
+INSERT INTO "FromOurKitchen_cart" ("user_id", "food_id", "qty", "pricePaise", "amountPaise")
+SELECT %s, f."id", 1, CAST(ROUND(f."price" * 100) AS INTEGER), CAST(ROUND(f."price" * 100) AS INTEGER)
+FROM "Categories_fooditem" f
+WHERE f."id" = %s
+ON CONFLICT ("user_id", "food_id") DO UPDATE SET
+    "qty" = "FromOurKitchen_cart"."qty" + 1,
+    "pricePaise" = CASE WHEN "FromOurKitchen_cart"."qty" = 0
+        THEN excluded."pricePaise" ELSE "FromOurKitchen_cart"."pricePaise" END,
+    "amountPaise" = "FromOurKitchen_cart"."amountPaise" + CASE WHEN "FromOurKitchen_cart"."qty" = 0
+        THEN excluded."pricePaise" ELSE "FromOurKitchen_cart"."pricePaise" END
+RETURNING "id", "pricePaise"
+'''
+
+REMOVE_ITEM_QUERY = '''
+UPDATE "FromOurKitchen_cart" SET
+    "qty" = "qty" - 1,
+    "amountPaise" = "amountPaise" - "pricePaise"
+WHERE "user_id" = %s AND "food_id" = %s AND "qty" > 0
+RETURNING "id", "pricePaise"
+'''
+
+# Creates the user's cart on the first item added
+ADD_TO_TOTAL_QUERY = '''
+INSERT INTO "FromOurKitchen_usercart" ("user_id", "totalPaise")
+VALUES (%s, %s)
+ON CONFLICT ("user_id") DO UPDATE SET
+    "totalPaise" = "FromOurKitchen_usercart"."totalPaise" + excluded."totalPaise"
+'''
+
+
+# The cart items of a user, with the user's cart total (as totalPaise, see Cart.totalAmount)
+def get_items(user):
+    return (
+        Cart.objects.filter(user_id=user.id, qty__gt=0)
+        .select_related('food__category')
+        .annotate(totalPaise=F('user__userCart__totalPaise'))
+        .order_by('id')
+    )
+
+
+# The cart item of the given food item, for the response of the cart views
+def get_item(user, foodId):
+    return get_items(user).filter(food_id=foodId).first()
+
+
+# To add a food item to the user's cart. Returns False if the food item doesn't exist
+def add_item(user, foodId):
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(ADD_ITEM_QUERY, [user.id, foodId])
+            row = cursor.fetchone()
+            if row is None:
+                return False
+            cursor.execute(ADD_TO_TOTAL_QUERY, [user.id, row[1]])
+    return True
+
+
+# To remove a food item (qty 1) from the user's cart. Returns False if it's not in the cart
+def remove_item(user, foodId):
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(REMOVE_ITEM_QUERY, [user.id, foodId])
+            row = cursor.fetchone()
+        if row is None:
+            return False
+        UserCart.objects.filter(user=user).update(totalPaise=F('totalPaise') - row[1])
+    return True
+
+
+class InvalidCartUpdate(Exception):
+    pass
+
+
+# Max number of changes of a batch update
+MAX_BATCH_CHANGES = 100
+
+
+# Validates the changes of a batch update, [{'food_id': 3, 'qty': 2}, {'food_id': 5, 'delta': -1}, ...]
+# and merges them, in order, into one change per food item: ('qty', n) or ('delta', n)
+def parse_changes(changes):
+    if not isinstance(changes, list) or not changes:
+        raise InvalidCartUpdate('A list of changes is required')
+    if len(changes) > MAX_BATCH_CHANGES:
+        raise InvalidCartUpdate(f'At most {MAX_BATCH_CHANGES} changes can be applied at once')
+
+    merged = {}
+    for change in changes:
+        try:
+            foodId = int(change['food_id'])
+            if 'qty' in change:
+                kind, value = 'qty', int(change['qty'])
+            else:
+                kind, value = 'delta', int(change['delta'])
+        except (KeyError, TypeError, ValueError):
+            raise InvalidCartUpdate('Each change needs a food_id, and a qty or a delta')
+        if kind == 'qty' and value < 0:
+            raise InvalidCartUpdate('qty can\'t be negative')
+
+        previous = merged.get(foodId)
+        if kind == 'delta' and previous is not None:
+            # A delta applies on top of the earlier changes of the same food item
+            kind, value = previous[0], previous[1] + value
+        merged[foodId] = (kind, value)
+    return merged
+
+
+# To apply a batch of changes (see parse_changes) to the user's cart, all or nothing.
+# Raises FoodItem.DoesNotExist if one of the food items doesn't exist.
+#
+# Missing items are first inserted with qty 0, so that every item of the batch can be locked, even
+# the new ones: a concurrent update of the same items waits instead of overwriting this one.
+# The new quantities are then written with a single update, and the total with a single increment
+def update_items(user, changes):
+    changes = parse_changes(changes)
+    with transaction.atomic():
+        prices = {
+            foodId: int(round(price * 100))
+            for foodId, price in FoodItem.objects.filter(id__in=changes).values_list('id', 'price')
+        }
+        if len(prices) != len(changes):
+            raise FoodItem.DoesNotExist('Food item not found')
+
+        Cart.objects.bulk_create(
+            [Cart(user=user, food_id=foodId, qty=0, pricePaise=prices[foodId], amountPaise=0) for foodId in changes],
+            ignore_conflicts=True,
+        )
+        items = list(Cart.objects.select_for_update().filter(user=user, food_id__in=changes))
+
+        totalChange = 0
+        for item in items:
+            kind, value = changes[item.food_id]
+            qty = max(value if kind == 'qty' else item.qty + value, 0)
+            if item.qty == 0:
+                # Removed earlier, it takes the current price again
+                item.pricePaise = prices[item.food_id]
+            amountPaise = qty * item.pricePaise
+            totalChange += amountPaise - item.amountPaise
+            item.qty, item.amountPaise = qty, amountPaise
+
+        Cart.objects.bulk_update(items, ['qty', 'pricePaise', 'amountPaise'])
+        with connection.cursor() as cursor:
+            cursor.execute(ADD_TO_TOTAL_QUERY, [user.id, totalChange])
+
+
+# To bring the prices of the user's cart items up to date with their food items (e.g. before checking
+# out again, once the checkout found stale prices). Returns the items repriced
+def reprice_items(user):
+    with transaction.atomic():
+        # The items are locked before the total, as in the other mutations
+        items = list(Cart.objects.select_for_update(of=('self',)).filter(user=user, qty__gt=0).select_related('food'))
+        repriced = []
+        totalChange = 0
+        for item in items:
+            pricePaise = int(round(item.food.price * 100))
+            if item.pricePaise != pricePaise:
+                amountPaise = item.qty * pricePaise
+                totalChange += amountPaise - item.amountPaise
+                item.pricePaise, item.amountPaise = pricePaise, amountPaise
+                repriced.append(item)
+        if repriced:
+            Cart.objects.bulk_update(repriced, ['pricePaise', 'amountPaise'])
+            UserCart.objects.filter(user=user).update(totalPaise=F('totalPaise') + totalChange)
+    return repriced
+
+
+# To take the items of an order placed out of the user's cart (lines: the order lines, see
+# CheckoutSession.lines). Items added since the checkout stay in the cart
+def remove_ordered_items(user, lines):
+    ordered = {}
+    for line in lines:
+        ordered[line['food']] = ordered.get(line['food'], 0) + line['qty']
+    with transaction.atomic():
+        items = list(Cart.objects.select_for_update().filter(user=user, food_id__in=ordered, qty__gt=0))
+        totalChange = 0
+        for item in items:
+            qty = max(item.qty - ordered[item.food_id], 0)
+            amountPaise = qty * item.pricePaise
+            totalChange += amountPaise - item.amountPaise
+            item.qty, item.amountPaise = qty, amountPaise
+        if items:
+            Cart.objects.bulk_update(items, ['qty', 'amountPaise'])
+            UserCart.objects.filter(user=user).update(totalPaise=F('totalPaise') + totalChange)
+
+
+# The total amount of the user's cart, in paise
+def get_total(user):
+    return UserCart.objects.filter(user=user).values_list('totalPaise', flat=True).first() or 0
@@ -0,0 +1,233 @@
+import hashlib
+import time
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from Categories import cache as catalogCache
+from Categories.models import Stripe
+from FromOurKitchen import cart as userCart
+from FromOurKitchen.models import ActiveOrders, CheckoutSession
+
+
+# Idempotent checkout.
+#
+# A double-click, or a retry with the same cart, returns the Stripe checkout session already created
+# instead of creating another one (an external round trip, and a second payment page for the same
+# cart). The session is found by a hash of the user, the address and the cart items, and handed out
+# until a little before it expires at Stripe (CHECKOUT_SESSION_TTL seconds after the end of the
+# idempotency window it was created in), or until its order is placed (see stripe_events.py).
+#
+# The quote of the cart is saved with the session: the order is placed from what the customer paid
+# for, whatever happened to the cart since. The session is kept (not handed out) until its payment
+# can't complete anymore, and its event has had CHECKOUT_SESSION_KEEP seconds to be processed.
+#
+# The checkouts of a user are serialized: a pending CheckoutSession (without a session yet) is saved
+# before Stripe is called, and a user can only have one of them (a partial unique constraint). A
+# checkout running at the same time, e.g. a double-click, raises CheckoutInProgress instead of
+# paying a second time. The pending session is completed once Stripe answered, or deleted if it
+# failed; a request which died meanwhile is taken over after IDEMPOTENCY_WINDOW seconds. No lock is
+# held while Stripe is called: the checkout is async (see aget_session), the database is only
+# reached before and after the call.
+#
+# The session is created with an idempotency key derived from the same hash: a request retried after
+# a timeout gets the session created by the first one from Stripe.
+#
+# A session is created from a Quote of the cart, built without a query of its own: the cart items
+# come with their food item and category (one joined query), their prices are checked against the
+# food items' current prices, and the Stripe account of the category is read from the catalog cache.
+
+# Seconds during which a retried checkout gets the same session from Stripe
+IDEMPOTENCY_WINDOW = 300
+
+
+class EmptyCart(Exception):
+    pass
+
+
+# The price of food items changed since they were added to the cart (see cart.reprice_items)
+class PricesChanged(Exception):
+    def __init__(self, items):
+        super().__init__('The price of some items in the cart changed')
+        self.items = items
+
+
+# The category hasn't set up payment acceptance with Stripe
+class NoPayoutAccount(Exception):
+    pass
+
+
+# Another checkout of the user is creating its session
+class CheckoutInProgress(Exception):
+    pass
+
+
+# What the customer pays for the cart items: their lines (with the food item), the total, the
+# category the food is ordered from and its Stripe account (where the payment is transferred)
+class Quote:
+    def __init__(self, cart, accountId):
+        self.lines = cart
+        self.categoryId = cart[0].food.category_id
+        self.accountId = accountId
+        self.totalPaise = sum(item.amountPaise for item in cart)
+
+    # The line items of a Stripe checkout session.
+    # Refer: https://stripe.com/docs/api/checkout/sessions/create#create_checkout_session-line_items
+    def line_items(self, currency='inr'):
+        return [
+            {
+                'price_data': {
+                    'currency': currency,
+                    # In paise (as Stripe expects amounts in the smallest currency unit)
+                    'unit_amount': item.pricePaise,
+                    'product_data': {'name': item.food.name, 'description': item.food.description},
+                },
+                'quantity': item.qty,
+            }
+            for item in self.lines
+        ]
+
+    # The lines of the order, as saved with the checkout session (see CheckoutSession.lines)
+    def order_lines(self):
+        return [
+            {
+                'food': item.food_id, 'name': item.food.name, 'image': item.food.image.name,
+                'qty': item.qty, 'pricePaise': item.pricePaise, 'amountPaise': item.amountPaise,
+            }
+            for item in self.lines
+        ]
+
+
+def _payout_account(categoryId):
+    return catalogCache.get_payout_account(
+        categoryId, lambda: Stripe.objects.filter(category_id=categoryId).values_list('accountID', flat=True).first(),
+    )
+
+
+# Raises EmptyCart, or PricesChanged if an item isn't at the current price of its food item
+def check_items(cart):
+    if not cart:
+        raise EmptyCart('The cart is empty')
+    stale = [item for item in cart if item.pricePaise != int(round(item.food.price * 100))]
+    if stale:
+        raise PricesChanged(stale)
+
+
+# The quote of the cart items (see cart.get_items, which fetches their food item and category).
+# Raises the exceptions of check_items, or NoPayoutAccount if it can't be paid
+def get_quote(cart):
+    check_items(cart)
+    accountId = _payout_account(cart[0].food.category_id)
+    if accountId is None:
+        raise NoPayoutAccount('This category has not setup payment acceptance with Stripe yet')
+    return Quote(cart, accountId)
+
+
+def _ttl():
+    # Stripe sessions expire between 30 minutes and 24 hours after their creation (see _expires_at)
+    return min(max(getattr(settings, 'CHECKOUT_SESSION_TTL', 1800), 1800), 86400 - IDEMPOTENCY_WINDOW)
+
+
+# When the session of an idempotency window expires (a timestamp): TTL seconds after the end of the
+# window, so a request retried with the same key sends the same parameters (Stripe rejects a key
+# reused with others), and between TTL and TTL + IDEMPOTENCY_WINDOW seconds from now
+def _expires_at(window):
+    return (window + 1) * IDEMPOTENCY_WINDOW + _ttl()
+
+
+# The hash of a checkout: the user, the address and the cart items
+def cart_key(userId, addressId, cart):
+    lines = ','.join(f'{item.food_id}x{item.qty}@{item.pricePaise}' for item in sorted(cart, key=lambda item: item.food_id))
+    return hashlib.sha256(f'{userId}|{addressId}|{lines}'.encode()).hexdigest()
+
+
+# The checkout session of the user's cart, to be delivered to the address, if there is one. Otherwise
+# what creating it takes: (pending, quote, idempotencyKey, expiresAt), pending being the session saved for it.
+# Raises the exceptions of get_quote, or CheckoutInProgress
+def _find_session(user, addressId):
+    cart = list(userCart.get_items(user))
+    # A session already created is not handed out either once the prices changed
+    check_items(cart)
+
+    key = cart_key(user.id, addressId, cart)
+    now = timezone.now()
+    checkoutSession = CheckoutSession.objects.filter(key=key, expires__gt=now).first()
+    if checkoutSession is not None:
+        if not checkoutSession.sessionId:
+            raise CheckoutInProgress('Your checkout is already being created')
+        return checkoutSession
+
+    quote = get_quote(cart)
+    # Stripe keeps the session of an idempotency key for 24 hours: the key changes every
+    # IDEMPOTENCY_WINDOW seconds, so a session which expired here isn't returned again, and with
+    # each order placed, so a paid session isn't either
+    window = int(time.time() // IDEMPOTENCY_WINDOW)
+    lastOrderId = ActiveOrders.objects.filter(user=user).order_by('-id').values_list('id', flat=True).first()
+    return _claim(user, key, quote, now), quote, f'checkout-{key}-{window}-{lastOrderId or 0}', _expires_at(window)
+
+
+def _keep():
+    # Stripe retries a webhook event for 3 days
+    return getattr(settings, 'CHECKOUT_SESSION_KEEP', 3 * 86400)
+
+
+# A checkout session (unsaved) of the quote, for the user and the cart key
+def new_session(user, key, quote, expires, **fields):
+    return CheckoutSession(
+        user=user, key=key, expires=expires, category_id=quote.categoryId,
+        lines=quote.order_lines(), totalPaise=quote.totalPaise, **fields,
+    )
+
+
+# To save the pending session of the checkout, with its quote, before Stripe is called. Raises
+# CheckoutInProgress if the user has another one
+def _claim(user, key, quote, now):
+    try:
+        with transaction.atomic():
+            # The sessions of the user which can't be paid anymore, and a pending session left by a
+            # request which died
+            CheckoutSession.objects.filter(user=user).filter(
+                Q(sessionId='', expires__lte=now) | Q(paymentExpires__lte=now - timedelta(seconds=_keep())),
+            ).delete()
+            pending = new_session(user, key, quote, now + timedelta(seconds=IDEMPOTENCY_WINDOW))
+            pending.save(force_insert=True)
+            return pending
+    except IntegrityError:
+        raise CheckoutInProgress('Another checkout is already being created')
+
+
+# To complete the pending session with the Stripe session, expiring at expiresAt (a timestamp)
+def _save_session(pending, session, expiresAt):
+    pending.sessionId, pending.url = session.id, session.url
+    pending.paymentExpires = timezone.now() + timedelta(seconds=expiresAt - time.time())
+    # Not handed out in its last minutes, the customer needs time to pay
+    pending.expires = pending.paymentExpires - timedelta(seconds=IDEMPOTENCY_WINDOW)
+    pending.save(update_fields=['sessionId', 'url', 'expires', 'paymentExpires'])
+    return pending
+
+
+# To get the checkout session of the user's cart, to be delivered to the address. If there is none
+# (or it expired), the coroutine create(quote, idempotencyKey, expiresAt) creates it (and returns the
+# Stripe session). Raises the exceptions of get_quote and of create, or CheckoutInProgress
+async def aget_session(user, addressId, create):
+    found = await sync_to_async(_find_session)(user, addressId)
+    if isinstance(found, CheckoutSession):
+        return found
+
+    pending, quote, idempotencyKey, expiresAt = found
+    try:
+        session = await create(quote, idempotencyKey, expiresAt)
+    except BaseException:
+        # The user can check out again
+        await CheckoutSession.objects.filter(id=pending.id, sessionId='').adelete()
+        raise
+    return await sync_to_async(_save_session)(pending, session, expiresAt)
+
+
+# To forget the checkout session once its order is placed: checking out the same cart again is a new order
+def forget_session(sessionId):
+    CheckoutSession.objects.filter(sessionId=sessionId).delete()
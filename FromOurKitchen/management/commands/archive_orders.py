@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from FromOurKitchen import archive
+
+
+# Moves the delivered orders older than ORDER_ARCHIVE_AFTER_DAYS to the monthly archive tables
+# (see FromOurKitchen/archive.py), in batches of ORDER_ARCHIVE_BATCH_SIZE orders, each in its own
+# transaction. Run it from cron, or keep it running with --every
+class Command(BaseCommand):
+    help = 'Archive the delivered orders older than ORDER_ARCHIVE_AFTER_DAYS'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, help='Archive the orders older than this (ORDER_ARCHIVE_AFTER_DAYS by default, at least that)')
+        parser.add_argument('--batch-size', type=int, help='Orders archived per transaction (ORDER_ARCHIVE_BATCH_SIZE by default)')
+        parser.add_argument('--max-batches', type=int, help='Stop after this many batches (per run with --every)')
+        parser.add_argument('--every', type=int, metavar='SECONDS', help='Keep running, archiving every SECONDS seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                archived = archive.archive_orders(options['older_than_days'], options['batch_size'], options['max_batches'])
+            except ValueError as e:
+                raise CommandError(e)
+            self.stdout.write(self.style.SUCCESS(f'Archived {archived} order(s) ✅'))
+            if not options['every']:
+                break
+            close_old_connections()
+            time.sleep(options['every'])
@@ -0,0 +1,70 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from crud import querybudget, tokens
+
+
+# Throughput of the JWT issuance and verification (see crud/tokens.py), in this process, against the
+# configured database:
+#
+#     python manage.py benchmark_tokens --count 2000 --user customer
+#
+# Each step is run the way it was before the token service (the role queried on each mint, the user
+# loaded on each request) and the way it is now (the cached role, the claims alone)
+
+
+# The role queried on each mint, as the token views used to
+def _mint_uncached(user):
+    refresh = RefreshToken.for_user(user)
+    refresh['username'] = user.username
+    refresh['group'] = 'category' if user.groups.filter(name__iexact=tokens.CATEGORY_GROUP).exists() else 'None'
+    return str(refresh.access_token)
+
+
+def _mint(user):
+    return str(tokens.for_user(user).access_token)
+
+
+def _verifier(authentication):
+    def verify(rawToken):
+        return authentication.get_user(authentication.get_validated_token(rawToken))
+    return verify
+
+
+class Command(BaseCommand):
+    help = 'Measure the throughput of the JWT issuance and verification'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=1000, help='Tokens minted and verified per step')
+        parser.add_argument('--user', help='Username of the user the tokens are minted for, the first user by default')
+
+    def run(self, label, fn, args):
+        with querybudget.record_queries() as recorder:
+            start = time.perf_counter()
+            for arg in args:
+                fn(arg)
+            elapsed = time.perf_counter() - start
+        self.stdout.write(
+            f'{label:<32} {len(args) / elapsed:>10.0f}/s  {elapsed / len(args) * 1e6:>8.1f}µs/op  '
+            f'{recorder.count / len(args):.2f} queries/op'
+        )
+
+    def handle(self, *args, **options):
+        users = User.objects.order_by('id')
+        user = (users.filter(username=options['user']) if options['user'] else users).first()
+        if user is None:
+            raise CommandError('No user to mint the tokens for')
+        count = options['count']
+
+        # Both save the refresh token as outstanding (see the token_blacklist app), as the token views do
+        self.run('mint (role queried)', _mint_uncached, [user] * count)
+        self.run('mint (role cached)', _mint, [user] * count)
+
+        rawTokens = [_mint(user) for number in range(count)]
+        self.run('verify (user loaded)', _verifier(JWTAuthentication()), rawTokens)
+        self.run('verify (claims only)', _verifier(tokens.ClaimsAuthentication()), rawTokens)
+        self.stdout.write(self.style.SUCCESS(f'Role cache: {tokens.get_stats()} ✅'))
@@ -0,0 +1,110 @@
+import json
+import time
+import uuid
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from FromOurKitchen import cart as userCart
+from FromOurKitchen import checkout as userCheckout
+from FromOurKitchen.models import Address, CheckoutSession
+from crud.gateways import sign_webhook
+
+
+# Load test of the Stripe webhook: posts signed checkout.session.completed events (as Stripe sends
+# them) to a running server, some of them twice (as Stripe redelivers them), and reports the
+# response times. The events are signed with the webhook secret of the server (STRIPE_WEBHOOK_SECRET):
+#
+#     python manage.py generate_stripe_events --count 1000 --concurrency 20 --duplicates 0.1
+#
+# Each event is of a checkout session of the cart of the user, saved beforehand, and places its
+# order (see FromOurKitchen/stripe_events.py)
+
+
+# The checkout sessions (unsaved) of the user's cart, as checkout.aget_session saves them
+def build_sessions(user, count):
+    try:
+        quote = userCheckout.get_quote(list(userCart.get_items(user)))
+    except (userCheckout.EmptyCart, userCheckout.PricesChanged, userCheckout.NoPayoutAccount) as e:
+        raise CommandError(f'The cart of {user} can\'t be checked out: {e}')
+    now = timezone.now()
+    return [
+        userCheckout.new_session(
+            user, uuid.uuid4().hex, quote, now, sessionId=f'cs_load_{uuid.uuid4().hex}', paymentExpires=now,
+        )
+        for number in range(count)
+    ]
+
+
+# The checkout.session.completed event of a checkout session, to be delivered to the address
+def build_event(checkoutSession, addressId):
+    return {
+        'id': f'evt_load_{uuid.uuid4().hex}',
+        'object': 'event',
+        'type': 'checkout.session.completed',
+        'created': int(time.time()),
+        'data': {'object': {
+            'id': checkoutSession.sessionId,
+            'object': 'checkout.session',
+            'amount_total': checkoutSession.totalPaise,
+            'payment_intent': f'pi_load_{uuid.uuid4().hex}',
+            'metadata': {'user': str(checkoutSession.user_id), 'addressID': str(addressId)},
+        }},
+    }
+
+
+class Command(BaseCommand):
+    help = 'Post signed Stripe webhook events to a running server, for load tests'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=100, help='Events to send')
+        parser.add_argument('--url', default='http://localhost:8000/api/webhook/', help='URL of the webhook')
+        parser.add_argument('--secret', default=settings.STRIPE_WEBHOOK_SECRET, help='Webhook secret (STRIPE_WEBHOOK_SECRET by default)')
+        parser.add_argument('--address', type=int, help='Delivery address of the orders (of their user, whose cart is ordered), the first address by default')
+        parser.add_argument('--concurrency', type=int, default=10, help='Requests sent at the same time')
+        parser.add_argument('--duplicates', type=float, default=0, help='Fraction of the events sent twice')
+
+    def handle(self, *args, **options):
+        if not options['secret']:
+            raise CommandError('A webhook secret is required (--secret or STRIPE_WEBHOOK_SECRET)')
+        addresses = Address.objects.order_by('id')
+        address = (addresses.filter(id=options['address']) if options['address'] else addresses).first()
+        if address is None:
+            raise CommandError('No address to deliver the orders to')
+
+        checkoutSessions = CheckoutSession.objects.bulk_create(build_sessions(address.user, options['count']))
+        payloads = [json.dumps(build_event(checkoutSession, address.id)) for checkoutSession in checkoutSessions]
+        payloads += payloads[:int(len(payloads) * options['duplicates'])]
+
+        def post(payload):
+            request = urllib.request.Request(options['url'], data=payload.encode(), method='POST', headers={
+                'Content-Type': 'application/json', 'Stripe-Signature': sign_webhook(payload, options['secret']),
+            })
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(request, timeout=30) as response:
+                    code = response.status
+            except urllib.error.HTTPError as e:
+                code = e.code
+            except urllib.error.URLError:
+                code = None
+            return code, time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            results = list(executor.map(post, payloads))
+        elapsed = time.perf_counter() - start
+
+        codes = {}
+        for code, duration in results:
+            codes[code] = codes.get(code, 0) + 1
+        durations = sorted(duration for code, duration in results)
+        self.stdout.write(f'{len(results)} request(s) in {elapsed:.2f}s ({len(results) / elapsed:.0f}/s), status codes: {codes}')
+        self.stdout.write(
+            f'Response time: p50 {durations[len(durations) // 2] * 1000:.1f}ms, '
+            f'p95 {durations[int(len(durations) * 0.95)] * 1000:.1f}ms, max {durations[-1] * 1000:.1f}ms'
+        )
@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from FromOurKitchen import stripe_events
+
+
+# Processes the Stripe events left pending (see FromOurKitchen/stripe_events.py): the ones the
+# background pool didn't get to (e.g. the process restarted) and the failed ones due for a retry.
+# Run it from cron, or keep it running as a worker process with --every
+class Command(BaseCommand):
+    help = 'Process the pending Stripe webhook events'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help='Events claimed per batch (STRIPE_EVENTS_BATCH_SIZE by default)')
+        parser.add_argument('--max-batches', type=int, help='Stop after this many batches (per run with --every)')
+        parser.add_argument('--every', type=float, metavar='SECONDS', help='Keep running, processing the due events every SECONDS seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            processed, failed = stripe_events.process_events(options['batch_size'], options['max_batches'])
+            if processed or failed or not options['every']:
+                self.stdout.write(self.style.SUCCESS(f'Processed {processed} event(s), {failed} failed ✅'))
+            if not options['every']:
+                break
+            close_old_connections()
+            time.sleep(options['every'])
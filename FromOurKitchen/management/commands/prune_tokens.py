@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from crud import revocation
+
+
+# Deletes the expired outstanding and blacklisted refresh tokens (see crud/revocation.py), in
+# batches of TOKEN_PRUNE_BATCH_SIZE tokens, each in its own transaction. Run it from cron, or keep
+# it running with --every
+class Command(BaseCommand):
+    help = 'Delete the expired outstanding and blacklisted refresh tokens'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help='Tokens deleted per transaction (TOKEN_PRUNE_BATCH_SIZE by default)')
+        parser.add_argument('--max-batches', type=int, help='Stop after this many batches (per run with --every)')
+        parser.add_argument('--grace', type=int, metavar='SECONDS', help='Keep the tokens expired for less than this (TOKEN_PRUNE_GRACE by default)')
+        parser.add_argument('--every', type=int, metavar='SECONDS', help='Keep running, pruning every SECONDS seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            deleted = revocation.prune_tokens(options['batch_size'], options['max_batches'], options['grace'])
+            self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} expired token(s) ✅'))
+            if not options['every']:
+                break
+            close_old_connections()
+            time.sleep(options['every'])
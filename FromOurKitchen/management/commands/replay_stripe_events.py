@@ -0,0 +1,53 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+
+from FromOurKitchen import stripe_events
+from FromOurKitchen.models import StripeEvent
+from crud import gateways
+
+
+# Processes Stripe events again, whatever their status (processing is idempotent, see
+# FromOurKitchen/stripe_events.py), e.g. the failed ones once the cause is fixed:
+#
+#     python manage.py replay_stripe_events --status failed
+#     python manage.py replay_stripe_events evt_1 evt_2 --fetch
+#
+# With --fetch, the given events missing here (never delivered) are first fetched from Stripe
+class Command(BaseCommand):
+    help = 'Process Stripe webhook events again'
+
+    def add_arguments(self, parser):
+        parser.add_argument('event_ids', nargs='*', help='Stripe event ids (evt_...)')
+        parser.add_argument('--type', help='Only the events of this type (e.g. checkout.session.completed)')
+        parser.add_argument('--status', choices=[value for value, label in StripeEvent.STATUSES], help='Only the events with this status')
+        parser.add_argument('--since', help='Only the events received since then (ISO date and time)')
+        parser.add_argument('--fetch', action='store_true', help='Fetch the given events missing here from Stripe')
+
+    def handle(self, *args, **options):
+        if not (options['event_ids'] or options['type'] or options['status'] or options['since']):
+            raise CommandError('Give the event ids, or select the events with --type, --status or --since')
+
+        if options['fetch']:
+            known = set(StripeEvent.objects.filter(eventId__in=options['event_ids']).values_list('eventId', flat=True))
+            for eventId in options['event_ids']:
+                if eventId not in known:
+                    event = gateways.payments().retrieve_event(eventId)
+                    StripeEvent.objects.create(eventId=event['id'], type=event['type'], payload=json.dumps(event))
+
+        events = StripeEvent.objects.order_by('id')
+        if options['event_ids']:
+            events = events.filter(eventId__in=options['event_ids'])
+        if options['type']:
+            events = events.filter(type=options['type'])
+        if options['status']:
+            events = events.filter(status=options['status'])
+        if options['since']:
+            since = parse_datetime(options['since'])
+            if since is None:
+                raise CommandError('Invalid --since')
+            events = events.filter(received__gte=since)
+
+        processed, failed = stripe_events.replay(list(events))
+        self.stdout.write(self.style.SUCCESS(f'Replayed {processed} event(s), {failed} failed ✅'))
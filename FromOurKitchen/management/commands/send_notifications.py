@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from FromOurKitchen import notifications
+
+
+# Sends the text SMS of the outbox (see FromOurKitchen/notifications.py), in batches of
+# NOTIFICATIONS_BATCH_SIZE messages, NOTIFICATIONS_CONCURRENCY at a time. Run it from cron, or keep
+# it running as a worker process with --every
+class Command(BaseCommand):
+    help = 'Send the pending text SMS of the notification outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help='Messages claimed per batch (NOTIFICATIONS_BATCH_SIZE by default)')
+        parser.add_argument('--concurrency', type=int, help='Messages sent at the same time (NOTIFICATIONS_CONCURRENCY by default)')
+        parser.add_argument('--max-batches', type=int, help='Stop after this many batches (per run with --every)')
+        parser.add_argument('--every', type=float, metavar='SECONDS', help='Keep running, sending the due messages every SECONDS seconds')
+
+    def handle(self, *args, **options):
+        provider = notifications.get_provider()
+        while True:
+            sent, failed = notifications.send_notifications(
+                options['batch_size'], options['concurrency'], options['max_batches'], provider=provider,
+            )
+            if sent or failed or not options['every']:
+                self.stdout.write(self.style.SUCCESS(f'Sent {sent} message(s), {failed} failed ✅'))
+            if not options['every']:
+                break
+            close_old_connections()
+            time.sleep(options['every'])
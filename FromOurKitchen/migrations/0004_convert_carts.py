@@ -0,0 +1,60 @@
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.db import migrations
+
+
+def paise(amount):
+    return int((Decimal(amount) * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+
+# Converts the rupee amounts of the cart items to paise, merges duplicate items of a food item
+# (the unique constraint is added in the next migration) and creates the users' carts with their total
+def convert_carts(apps, schema_editor):
+    Cart = apps.get_model('FromOurKitchen', 'Cart')
+    UserCart = apps.get_model('FromOurKitchen', 'UserCart')
+    OrderItem = apps.get_model('FromOurKitchen', 'ActiveOrders').cart.through
+
+    items = {}
+    for item in Cart.objects.select_related('food').order_by('id'):
+        if item.qty > 0 and item.amount:
+            # The price when the item was added, amount = qty * price
+            item.pricePaise = paise(Decimal(item.amount) / item.qty)
+        else:
+            item.pricePaise = paise(item.food.price) if item.food else 0
+        item.qty = max(item.qty, 0)
+
+        kept = items.get((item.user_id, item.food_id))
+        if kept is None or item.food_id is None:
+            items[(item.user_id, item.food_id or -item.id)] = item
+            continue
+
+        # Merge into the first item, the orders referring to the duplicate refer to it instead. The
+        # merged qty takes the price of the first item, as adding to an item in the cart does (see
+        # FromOurKitchen/cart.py): the amount of the duplicate at its own price is dropped
+        kept.qty += item.qty
+        for orderItem in OrderItem.objects.filter(cart_id=item.id):
+            if OrderItem.objects.filter(cart_id=kept.id, activeorders_id=orderItem.activeorders_id).exists():
+                orderItem.delete()
+            else:
+                orderItem.cart_id = kept.id
+                orderItem.save()
+        item.delete()
+
+    totals = {}
+    for item in items.values():
+        item.amountPaise = item.pricePaise * item.qty
+        item.save(update_fields=['qty', 'pricePaise', 'amountPaise'])
+        totals[item.user_id] = totals.get(item.user_id, 0) + item.amountPaise
+
+    UserCart.objects.bulk_create([UserCart(user_id=userId, totalPaise=total) for userId, total in totals.items()])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('FromOurKitchen', '0003_usercart'),
+    ]
+
+    operations = [
+        migrations.RunPython(convert_carts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.1.5 on 2026-10-18 21:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('FromOurKitchen', '0004_convert_carts'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='cart',
+            name='amount',
+        ),
+        migrations.RemoveField(
+            model_name='cart',
+            name='totalAmount',
+        ),
+        migrations.AddConstraint(
+            model_name='cart',
+            constraint=models.UniqueConstraint(fields=('user', 'food'), name='cart_user_food_unique'),
+        ),
+    ]
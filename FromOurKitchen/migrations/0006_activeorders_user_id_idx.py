@@ -0,0 +1,19 @@
+# Generated by Django 5.1.5 on 2026-10-18 21:27
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('FromOurKitchen', '0005_remove_cart_amounts'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='activeorders',
+            index=models.Index(fields=['user', 'id'], name='activeorders_user_id_idx'),
+        ),
+    ]
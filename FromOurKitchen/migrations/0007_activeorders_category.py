@@ -0,0 +1,35 @@
+# Generated by Django 5.1.5 on 2026-10-18 21:28
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Categories', '0004_image_variants'),
+        ('FromOurKitchen', '0006_activeorders_user_id_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='activeorders',
+            name='category',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='categoryOrder', to='Categories.category'),
+        ),
+        migrations.AddField(
+            model_name='activeorders',
+            name='updated',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='activeorders',
+            index=models.Index(fields=['category', 'active', 'id'], name='activeorders_board_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='activeorders',
+            index=models.Index(fields=['category', 'updated'], name='activeorders_updated_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+from django.db import migrations
+from django.db.models import OuterRef, Subquery
+
+
+# Sets the category of the existing orders, from the food of their first cart item
+# (the category paid at checkout)
+def backfill_category(apps, schema_editor):
+    ActiveOrders = apps.get_model('FromOurKitchen', 'ActiveOrders')
+    OrderItem = ActiveOrders._meta.get_field('cart').remote_field.through
+
+    firstItemCategory = (
+        OrderItem.objects.filter(activeorders_id=OuterRef('pk'))
+        .order_by('cart_id')
+        .values('cart__food__category_id')[:1]
+    )
+    ActiveOrders.objects.filter(category__isnull=True).update(category_id=Subquery(firstItemCategory))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('FromOurKitchen', '0007_activeorders_category'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_category, migrations.RunPython.noop),
+    ]
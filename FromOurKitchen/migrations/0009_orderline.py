@@ -0,0 +1,33 @@
+# Generated by Django 5.1.5 on 2026-10-18 21:35
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Categories', '0004_image_variants'),
+        ('FromOurKitchen', '0008_backfill_order_category'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='activeorders',
+            name='totalPaise',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='OrderLine',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=32)),
+                ('image', models.ImageField(blank=True, upload_to='images/')),
+                ('qty', models.IntegerField()),
+                ('pricePaise', models.IntegerField()),
+                ('amountPaise', models.IntegerField()),
+                ('food', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='orderLine', to='Categories.fooditem')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='FromOurKitchen.activeorders')),
+            ],
+        ),
+    ]
@@ -0,0 +1,39 @@
+from django.db import migrations
+
+
+# Copies the cart items linked to each order into order lines, as they are now, and sets the order
+# total. Cart items removed since (qty 0) are not part of the order
+def copy_order_lines(apps, schema_editor):
+    ActiveOrders = apps.get_model('FromOurKitchen', 'ActiveOrders')
+    OrderLine = apps.get_model('FromOurKitchen', 'OrderLine')
+    OrderItem = ActiveOrders._meta.get_field('cart').remote_field.through
+
+    orders = {}
+    lines = []
+    items = OrderItem.objects.filter(cart__qty__gt=0).select_related('cart__food').order_by('activeorders_id', 'cart_id')
+    for orderItem in items.iterator(chunk_size=2000):
+        item = orderItem.cart
+        lines.append(OrderLine(
+            order_id=orderItem.activeorders_id, food_id=item.food_id,
+            name=item.food.name if item.food else '', image=item.food.image.name if item.food else '',
+            qty=item.qty, pricePaise=item.pricePaise, amountPaise=item.amountPaise,
+        ))
+        orders[orderItem.activeorders_id] = orders.get(orderItem.activeorders_id, 0) + item.amountPaise
+        if len(lines) >= 2000:
+            OrderLine.objects.bulk_create(lines)
+            lines = []
+    OrderLine.objects.bulk_create(lines)
+
+    for orderId, totalPaise in orders.items():
+        ActiveOrders.objects.filter(id=orderId).update(totalPaise=totalPaise)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('FromOurKitchen', '0009_orderline'),
+    ]
+
+    operations = [
+        migrations.RunPython(copy_order_lines, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('FromOurKitchen', '0010_copy_order_lines'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='activeorders',
+            name='cart',
+        ),
+    ]
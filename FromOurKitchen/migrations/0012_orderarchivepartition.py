@@ -0,0 +1,54 @@
+# Generated by Django 5.1.5 on 2026-10-18 21:40
+
+from django.db import migrations, models
+
+
+# The parent table of the monthly archive partitions, on Postgres (see FromOurKitchen/archive.py).
+# On other databases the month tables are standalone, created when first needed
+def create_archive_table(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('''
+        CREATE TABLE IF NOT EXISTS "FromOurKitchen_orderarchive" (
+            "id" bigint NOT NULL,
+            "user_id" integer NOT NULL,
+            "category_id" bigint NULL,
+            "date" date NOT NULL,
+            "time" time NOT NULL,
+            "updated" timestamp NOT NULL,
+            "totalPaise" integer NOT NULL,
+            "itemCount" integer NOT NULL,
+            "address" text NOT NULL,
+            "lines" text NOT NULL,
+            PRIMARY KEY ("id", "date")
+        ) PARTITION BY RANGE ("date")
+    ''')
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS "FromOurKitchen_orderarchive_user_id_idx" ON "FromOurKitchen_orderarchive" ("user_id", "id")'
+    )
+
+
+def drop_archive_table(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP TABLE IF EXISTS "FromOurKitchen_orderarchive" CASCADE')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('FromOurKitchen', '0011_remove_activeorders_cart'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderArchivePartition',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(unique=True)),
+                ('table', models.CharField(max_length=64, unique=True)),
+                ('minId', models.BigIntegerField()),
+                ('maxId', models.BigIntegerField()),
+            ],
+        ),
+        migrations.RunPython(create_archive_table, drop_archive_table),
+    ]
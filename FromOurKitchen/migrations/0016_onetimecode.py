@@ -0,0 +1,26 @@
+# Generated by Django 5.1.5 on 2026-10-18 22:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('FromOurKitchen', '0015_checkoutsession'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OneTimeCode',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.CharField(max_length=20, unique=True)),
+                ('codeHash', models.CharField(blank=True, max_length=64)),
+                ('expires', models.DateTimeField()),
+                ('attempts', models.IntegerField(default=0)),
+                ('sends', models.IntegerField(default=0)),
+                ('windowStart', models.DateTimeField()),
+                ('sent', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.1.5 on 2026-10-18 22:47
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('FromOurKitchen', '0016_onetimecode'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='checkoutsession',
+            name='sessionId',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='checkoutsession',
+            name='url',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddConstraint(
+            model_name='checkoutsession',
+            constraint=models.UniqueConstraint(condition=models.Q(('sessionId', '')), fields=('user',), name='checkoutsession_user_pending_unique'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.1.5 on 2026-10-18 22:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Categories', '0004_image_variants'),
+        ('FromOurKitchen', '0017_checkoutsession_pending'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='checkoutsession',
+            name='category',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='Categories.category'),
+        ),
+        migrations.AddField(
+            model_name='checkoutsession',
+            name='lines',
+            field=models.JSONField(default=list),
+        ),
+        migrations.AddField(
+            model_name='checkoutsession',
+            name='paymentExpires',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='checkoutsession',
+            name='totalPaise',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='checkoutsession',
+            name='key',
+            field=models.CharField(db_index=True, max_length=64),
+        ),
+        migrations.AlterField(
+            model_name='checkoutsession',
+            name='sessionId',
+            field=models.CharField(blank=True, db_index=True, max_length=255),
+        ),
+    ]
@@ -1,5 +1,8 @@
+from decimal import Decimal
+
 from django.db import models
 from django.contrib.auth.models import User 
+from django.utils import timezone
 from Categories.models import Category, FoodItem
 
 # To store the user's mobile number
@@ -12,29 +15,69 @@ class MobileNumber(models.Model):
     def is_valid_number_length(self):
         return len(str(self.number)) == 10
 
-# User's cart
+# Converts an amount in paise (1 rupee = 100 paise) to rupees, as returned by the API
+def rupees(paise):
+    return (Decimal(paise) / 100).quantize(Decimal('0.01'))
+
+# User's cart. Holds the total of the user's cart items (Cart rows).
+# Only updated through FromOurKitchen/cart.py, which keeps the total in step with the items
+class UserCart(models.Model):
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name="userCart")
+    # Total amount of all the food items in the user's cart, in paise
+    totalPaise = models.IntegerField(default=0)
+
+    @property
+    def totalAmount(self):
+        return rupees(self.totalPaise)
+
+    def __str__(self):
+        return f"{self.user}'s cart (Rs. {self.totalAmount})"
+
+# A food item in the user's cart.
+# Removing the last one only sets its qty to 0, so that adding it again is a single update.
+# Items with qty 0 are not part of the cart (see FromOurKitchen/cart.py)
 class Cart(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="cartOwner")
     food = models.ForeignKey(FoodItem, on_delete=models.CASCADE, related_name="cartFood", null=True , blank=True)
     qty = models.IntegerField(default=0)
-    # (Amount = qty * price) for a food item
-    amount = models.DecimalField(max_digits=6, decimal_places=2)
-    # Total amount is the in total amount of all the food items in cart of a user. 
-    totalAmount = models.DecimalField(max_digits=7, decimal_places=2, default=0)
+    # Price of the food item when it was added to the cart, in paise
+    pricePaise = models.IntegerField(default=0)
+    # (Amount = qty * price) for a food item, in paise
+    amountPaise = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            # A food item is added once per user, its qty is increased afterwards
+            models.UniqueConstraint(fields=['user', 'food'], name='cart_user_food_unique'),
+        ]
+
+    @property
+    def amount(self):
+        return rupees(self.amountPaise)
+
+    # Total amount of the user's cart. Annotated as totalPaise by the cart views, read from the
+    # user's cart otherwise
+    @property
+    def totalAmount(self):
+        if hasattr(self, 'totalPaise'):
+            # None if the user has no cart yet
+            return rupees(self.totalPaise or 0)
+        totalPaise = UserCart.objects.filter(user_id=self.user_id).values_list('totalPaise', flat=True).first()
+        return rupees(totalPaise or 0)
 
     # For testing: To check if values are positive
     def is_valid_amount(self):
-        return self.amount > 0 and self.qty > 0
+        return self.amountPaise > 0 and self.qty > 0
 
-    # For testing: To check the total amount
+    # For testing: To check the amount
     def is_valid_totalAmount(self):
-        return self.totalAmount == self.amount * self.qty
+        return self.amountPaise == self.pricePaise * self.qty
 
     # To serializer data as required by Stripe Payments during checkout
     def checkoutSerializer(self):
         return {
             "name" : self.food,
-            "amount" : int(self.food.price)*100,
+            "amount" : self.pricePaise,
             "currency" : 'inr',
             "quantity" : self.qty,
         }
@@ -74,27 +117,49 @@ class Address(models.Model):
 class ActiveOrders(models.Model):
     # User who has placed the order
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='userOrder')
-    # Cart items which the user has added
-    cart = models.ManyToManyField(Cart)
+    # Category the food was ordered from (the food items of the cart), for the category's order board
+    category = models.ForeignKey(Category, on_delete=models.SET_NULL, related_name='categoryOrder', null=True, blank=True)
+    # The food items ordered are OrderLine rows (order.lines), copied from the cart when the order is placed.
+    # Total amount of the order, in paise
+    totalPaise = models.IntegerField(default=0)
     # Address selected/chosen by the user to deliver to
     address = models.ForeignKey(Address, on_delete=models.CASCADE, related_name='addressOrder')
     
     date = models.DateField(auto_now_add=True)
     time = models.TimeField(auto_now_add=True)
     active = models.BooleanField(default=True)
+    # Last time the order was saved (e.g. marked as delivered)
+    updated = models.DateTimeField(auto_now=True)
+    # Stripe checkout session the order was paid with: a session places a single order, however many
+    # times its event is delivered or replayed (see FromOurKitchen/stripe_events.py)
+    checkoutSession = models.CharField(max_length=255, unique=True, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # For a user's orders, newest first (WHERE user_id = ? AND id < ? ORDER BY id DESC)
+            models.Index(fields=['user', 'id'], name='activeorders_user_id_idx'),
+            # For the order board of a category: its active orders after the last one seen
+            # (WHERE category_id = ? AND active AND id > ?), and its orders changed since the last poll
+            models.Index(fields=['category', 'active', 'id'], name='activeorders_board_idx'),
+            models.Index(fields=['category', 'updated'], name='activeorders_updated_idx'),
+        ]
+
+    @property
+    def totalAmount(self):
+        return rupees(self.totalPaise)
 
     def serializer(self):
         return{
             "cart": [{
                 "food" : {
-                    "id" :  self.cart.food.id,
-                    "name" : self.cart.food.name,
-                    "price" : self.cart.food.price,
+                    "id" :  line.food_id,
+                    "name" : line.name,
+                    "price" : line.price,
                 },
-                "qty" : self.cart.qty,
-                "amount" : self.cart.amount,
-                "totalAmount" : self.cart.totalAmount,
-            }for item in self.cart.all()
+                "qty" : line.qty,
+                "amount" : line.amount,
+                "totalAmount" : self.totalAmount,
+            }for line in self.lines.all()
             ],
             "address" : {
                 "area": self.address.area,
@@ -135,3 +200,173 @@ class ActiveOrders(models.Model):
 
     def __str__(self):
         return f"Order for {self.user.username}"
+
+
+# A month of archived orders (see FromOurKitchen/archive.py): the table holding them, and the range of
+# their ids, so that reading a page of order history only touches the tables it needs
+class OrderArchivePartition(models.Model):
+    # First day of the month of the orders' date
+    month = models.DateField(unique=True)
+    table = models.CharField(max_length=64, unique=True)
+    minId = models.BigIntegerField()
+    maxId = models.BigIntegerField()
+
+    def __str__(self):
+        return f"{self.table} (orders {self.minId} to {self.maxId})"
+
+
+# A food item of an order: a copy of the cart item when the order was placed, so that changing
+# (or deleting) the food item afterwards leaves the order as it was
+class OrderLine(models.Model):
+    order = models.ForeignKey(ActiveOrders, on_delete=models.CASCADE, related_name='lines')
+    # The food item ordered, while it still exists
+    food = models.ForeignKey(FoodItem, on_delete=models.SET_NULL, related_name='orderLine', null=True, blank=True)
+    name = models.CharField(max_length=32)
+    # Uploaded images are never overwritten (see crud/storage.py), the file stays the one ordered
+    image = models.ImageField(upload_to='images/', blank=True)
+    qty = models.IntegerField()
+    # Price of the food item when it was ordered, in paise
+    pricePaise = models.IntegerField()
+    # (Amount = qty * price), in paise
+    amountPaise = models.IntegerField()
+
+    @property
+    def price(self):
+        return rupees(self.pricePaise)
+
+    @property
+    def amount(self):
+        return rupees(self.amountPaise)
+
+    # The order line of a cart item (with its food item loaded)
+    @classmethod
+    def from_cart(cls, order, item):
+        return cls(
+            order=order, food_id=item.food_id, name=item.food.name, image=item.food.image.name,
+            qty=item.qty, pricePaise=item.pricePaise, amountPaise=item.amountPaise,
+        )
+
+    # The order line of a line of a checkout session (see CheckoutSession.lines)
+    @classmethod
+    def from_checkout(cls, order, line):
+        return cls(
+            order=order, food_id=line['food'], name=line['name'], image=line['image'],
+            qty=line['qty'], pricePaise=line['pricePaise'], amountPaise=line['amountPaise'],
+        )
+
+    def __str__(self):
+        return f"{self.name} X {self.qty} (order {self.order_id})"
+
+
+# A text SMS to send, written in the same transaction as the change it's about (e.g. an order
+# delivered), then sent by the send_notifications worker (see FromOurKitchen/notifications.py)
+class Notification(models.Model):
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUSES = [(PENDING, 'Pending'), (SENT, 'Sent'), (FAILED, 'Failed')]
+
+    # What the message is about (e.g. 'order.delivered:12'), a message is only enqueued once per key
+    key = models.CharField(max_length=64, unique=True)
+    to = models.CharField(max_length=20)
+    body = models.TextField()
+    status = models.CharField(max_length=8, choices=STATUSES, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    # When a pending message is due: the next retry, or the end of the lease of the worker sending it
+    nextAttempt = models.DateTimeField(default=timezone.now)
+    created = models.DateTimeField(auto_now_add=True)
+    sent = models.DateTimeField(null=True, blank=True)
+    # Time the provider took to accept the message, in ms
+    latencyMs = models.IntegerField(null=True, blank=True)
+    # Last error of the provider
+    error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            # For the worker: the pending messages due (WHERE status = 'pending' AND nextAttempt <= ?)
+            models.Index(fields=['status', 'nextAttempt'], name='notification_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.key} to {self.to} ({self.status})"
+
+
+# An event sent by Stripe to the webhook, saved as received (once per Stripe event id) and then
+# processed in the background (see FromOurKitchen/stripe_events.py)
+class StripeEvent(models.Model):
+    PENDING = 'pending'
+    PROCESSED = 'processed'
+    FAILED = 'failed'
+    STATUSES = [(PENDING, 'Pending'), (PROCESSED, 'Processed'), (FAILED, 'Failed')]
+
+    eventId = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=64)
+    # The body of the webhook request, the JSON of the event
+    payload = models.TextField()
+    status = models.CharField(max_length=9, choices=STATUSES, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    # When a pending event is due: the next retry, or the end of the lease of the processor handling it
+    nextAttempt = models.DateTimeField(default=timezone.now)
+    received = models.DateTimeField(auto_now_add=True)
+    processed = models.DateTimeField(null=True, blank=True)
+    # Last error of the processing
+    error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            # For the processor: the pending events due (WHERE status = 'pending' AND nextAttempt <= ?)
+            models.Index(fields=['status', 'nextAttempt'], name='stripeevent_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.type} {self.eventId} ({self.status})"
+
+
+# A Stripe checkout session created for a cart, returned again (until it expires) for the same cart,
+# address and user instead of creating a new one (see FromOurKitchen/checkout.py).
+# Saved before Stripe is called, without a session (sessionId empty) while it's being created: a user
+# has a single checkout being created at a time.
+# The order is placed from what the customer paid for, the quote of the cart saved with the session,
+# so the session is kept after it's no longer handed out (expires), until its payment can't complete
+# anymore (paymentExpires, plus the time for the webhook event to be processed)
+class CheckoutSession(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='checkoutSessions')
+    # Hash of the user, the address and the cart items (food items, quantities and prices)
+    key = models.CharField(max_length=64, db_index=True)
+    sessionId = models.CharField(max_length=255, blank=True, db_index=True)
+    url = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    expires = models.DateTimeField()
+    # When the Stripe session expires
+    paymentExpires = models.DateTimeField(null=True, blank=True)
+    # The quote: the category the food is ordered from, the order lines (food, name, image, qty,
+    # pricePaise and amountPaise, as OrderLine) and the total, in paise
+    category = models.ForeignKey(Category, on_delete=models.SET_NULL, related_name='+', null=True, blank=True)
+    lines = models.JSONField(default=list)
+    totalPaise = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user'], condition=models.Q(sessionId=''), name='checkoutsession_user_pending_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.sessionId} of {self.user} (until {self.expires})"
+
+
+# The verification code last sent to a mobile number, one row per number (see FromOurKitchen/otp.py)
+class OneTimeCode(models.Model):
+    # With the country code, e.g. '+919876543210'
+    number = models.CharField(max_length=20, unique=True)
+    # HMAC of the number and the code (the code itself isn't stored). Empty once the code is used
+    codeHash = models.CharField(max_length=64, blank=True)
+    expires = models.DateTimeField()
+    # Checks of the code
+    attempts = models.IntegerField(default=0)
+    # Codes sent since windowStart, for the rate limit of the number
+    sends = models.IntegerField(default=0)
+    windowStart = models.DateTimeField()
+    sent = models.DateTimeField()
+
+    def __str__(self):
+        return f"Code of {self.number} (until {self.expires})"
@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, Min
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from FromOurKitchen.models import Notification
+from crud import gateways
+
+logger = logging.getLogger(__name__)
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+# Outbox of the text SMS sent to the customers.
+#
+# The views never call the SMS provider: they enqueue Notification rows in the transaction of the
+# change they're about (so a message is sent if and only if the change is committed), and the
+# send_notifications worker sends them:
+#   - a batch of due messages is claimed in a short transaction (FOR UPDATE SKIP LOCKED on Postgres,
+#     so several workers can run), by moving their nextAttempt to the end of a lease
+#   - the batch is sent outside of any transaction, NOTIFICATIONS_CONCURRENCY messages at a time
+#   - the outcomes are written back with a single bulk update. A failed message is retried with
+#     an exponential backoff, and given up after NOTIFICATIONS_MAX_ATTEMPTS attempts
+# A worker dying mid-batch leaves its messages pending, sent again once the lease ends: a message
+# is sent at least once. The unique key keeps a change from enqueuing the same message twice.
+#
+# The provider is NOTIFICATIONS_PROVIDER:
+#   - TwilioProvider: Twilio's Messaging API (through crud/gateways.py)
+#   - FakeProvider: keeps the messages in memory (tests, local runs and load tests)
+
+
+class TwilioProvider:
+    # Raises an exception if the message isn't accepted
+    def send(self, to, body):
+        gateways.messaging().send_sms(to, body)
+
+    async def asend(self, to, body):
+        await gateways.messaging().asend_sms(to, body)
+
+
+class FakeProvider:
+    # The messages sent by every FakeProvider of the process, as (to, body)
+    outbox = []
+    lock = threading.Lock()
+
+    def send(self, to, body):
+        # Simulated latency of the provider, in seconds
+        latency = _setting('NOTIFICATIONS_FAKE_LATENCY', 0)
+        if latency:
+            time.sleep(latency)
+        with self.lock:
+            self.outbox.append((to, body))
+
+    async def asend(self, to, body):
+        latency = _setting('NOTIFICATIONS_FAKE_LATENCY', 0)
+        if latency:
+            await asyncio.sleep(latency)
+        with self.lock:
+            self.outbox.append((to, body))
+
+
+def get_provider():
+    return import_string(_setting('NOTIFICATIONS_PROVIDER', 'FromOurKitchen.notifications.FakeProvider'))()
+
+
+# To enqueue text SMS, [(key, to, body), ...], in the current transaction. Keys already enqueued are skipped
+def enqueue(messages):
+    Notification.objects.bulk_create(
+        [Notification(key=key, to=to, body=body) for key, to, body in messages],
+        ignore_conflicts=True,
+    )
+
+
+# Delay before the next attempt of a message which failed `attempts` times
+def _backoff(attempts):
+    delay = _setting('NOTIFICATIONS_RETRY_DELAY', 30) * 2 ** (attempts - 1)
+    return timedelta(seconds=min(delay, _setting('NOTIFICATIONS_MAX_RETRY_DELAY', 3600)))
+
+
+# To claim a batch of due messages for this worker, until the lease ends
+def claim_batch(batchSize):
+    now = timezone.now()
+    with transaction.atomic():
+        due = Notification.objects.filter(status=Notification.PENDING, nextAttempt__lte=now).order_by('nextAttempt')
+        if connection.features.has_select_for_update_skip_locked:
+            # Concurrent workers claim different messages
+            due = due.select_for_update(skip_locked=True)
+        batch = list(due[:batchSize])
+        if batch:
+            lease = now + timedelta(seconds=_setting('NOTIFICATIONS_LEASE', 300))
+            Notification.objects.filter(id__in=[message.id for message in batch]).update(nextAttempt=lease)
+    return batch
+
+
+def _send(provider, message):
+    start = time.perf_counter()
+    try:
+        provider.send(message.to, message.body)
+        error = None
+    except Exception as e:
+        logger.warning('Sending the notification %s failed: %s', message.key, e)
+        error = str(e) or e.__class__.__name__
+    return error, int((time.perf_counter() - start) * 1000)
+
+
+# To send a batch of claimed messages and save the outcomes. Returns the number of messages sent
+def send_batch(batch, provider, executor):
+    now = timezone.now()
+    maxAttempts = _setting('NOTIFICATIONS_MAX_ATTEMPTS', 5)
+    sent = 0
+    for message, (error, latencyMs) in zip(batch, executor.map(lambda message: _send(provider, message), batch)):
+        message.attempts += 1
+        message.latencyMs = latencyMs
+        if error is None:
+            message.status, message.sent, message.error = Notification.SENT, now, ''
+            sent += 1
+        else:
+            message.error = error[:1000]
+            if message.attempts >= maxAttempts:
+                message.status = Notification.FAILED
+            else:
+                message.nextAttempt = now + _backoff(message.attempts)
+    Notification.objects.bulk_update(batch, ['status', 'attempts', 'nextAttempt', 'sent', 'latencyMs', 'error'])
+    return sent
+
+
+# To send the due messages, batchSize at a time, until none are left (or maxBatches batches).
+# Returns the number of messages (sent, failed to send)
+def send_notifications(batchSize=None, concurrency=None, maxBatches=None, provider=None):
+    batchSize = batchSize or _setting('NOTIFICATIONS_BATCH_SIZE', 50)
+    concurrency = concurrency or _setting('NOTIFICATIONS_CONCURRENCY', 8)
+    provider = provider or get_provider()
+    sent = failed = batches = 0
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='notifications') as executor:
+        while maxBatches is None or batches < maxBatches:
+            batch = claim_batch(batchSize)
+            if not batch:
+                break
+            count = send_batch(batch, provider, executor)
+            sent += count
+            failed += len(batch) - count
+            batches += 1
+    return sent, failed
+
+
+# Queue depth and send latency, for monitoring: the messages by status, how long the oldest
+# pending one has waited, and the latency (in ms) of the last NOTIFICATIONS_STATS_SAMPLE sends
+def get_stats():
+    now = timezone.now()
+    counts = dict(Notification.objects.values_list('status').annotate(Count('id')).order_by())
+    pending = Notification.objects.filter(status=Notification.PENDING)
+    oldest = pending.aggregate(oldest=Min('created'))['oldest']
+    latencies = sorted(
+        Notification.objects.filter(latencyMs__isnull=False)
+        .order_by('-id').values_list('latencyMs', flat=True)[:_setting('NOTIFICATIONS_STATS_SAMPLE', 1000)]
+    )
+    return {
+        'pending': counts.get(Notification.PENDING, 0),
+        'due': pending.filter(nextAttempt__lte=now).count(),
+        'sent': counts.get(Notification.SENT, 0),
+        'failed': counts.get(Notification.FAILED, 0),
+        'oldestPendingSeconds': int((now - oldest).total_seconds()) if oldest else 0,
+        'latencyMs': {
+            'avg': int(sum(latencies) / len(latencies)) if latencies else None,
+            'p95': latencies[int(len(latencies) * 0.95)] if latencies else None,
+            'max': latencies[-1] if latencies else None,
+        },
+    }
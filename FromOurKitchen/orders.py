@@ -0,0 +1,183 @@
+from collections import namedtuple
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from FromOurKitchen import notifications
+from FromOurKitchen.models import ActiveOrders, MobileNumber, rupees
+from crud import events
+
+
+# Order board of a category (the partner's kitchen), polled every few seconds.
+#
+# The client passes back the watermarks of its previous poll:
+#   - since: the id of the last order it has, so only the orders placed after it are returned
+#     (WHERE category_id = ? AND active AND id > ?, a range scan of activeorders_board_idx)
+#   - updatedAfter: when it last polled, so the orders changed since (e.g. marked as delivered)
+#     are returned too (WHERE category_id = ? AND updated > ?, a range scan of activeorders_updated_idx)
+# Without watermarks, the board is every active order of the category.
+#
+# A transaction committing after a poll may have saved its order a little before the poll's
+# updatedAfter, so the changed orders are looked up ORDER_BOARD_OVERLAP seconds further back.
+# An order can then be returned by two consecutive polls: the client replaces it by id.
+
+Board = namedtuple('Board', ['orders', 'since', 'updatedAfter'])
+
+
+class InvalidBoardParams(Exception):
+    pass
+
+
+def _overlap():
+    return timedelta(seconds=getattr(settings, 'ORDER_BOARD_OVERLAP', 5))
+
+
+# Returns the (since, updatedAfter) watermarks requested, validated
+def get_board_params(request):
+    since = request.query_params.get('since') or None
+    updatedAfter = request.query_params.get('updated_after') or None
+    try:
+        since = int(since) if since is not None else None
+    except ValueError:
+        raise InvalidBoardParams('Invalid since')
+    if updatedAfter is not None:
+        # parse_datetime returns None for a string not looking like a datetime, raises ValueError for an invalid one
+        try:
+            updatedAfter = parse_datetime(updatedAfter)
+        except ValueError:
+            updatedAfter = None
+        if updatedAfter is None:
+            raise InvalidBoardParams('Invalid updated_after')
+    if updatedAfter is not None and timezone.is_aware(updatedAfter) and not settings.USE_TZ:
+        updatedAfter = timezone.make_naive(updatedAfter)
+    return since, updatedAfter
+
+
+# To get the new and changed orders of the category. prefetch loads what the serializer reads
+# (e.g. ActiveOrdersSerializer.prefetch), in a single query for all the orders
+def get_board(categoryId, since=None, updatedAfter=None, prefetch=None):
+    # Taken before reading, so that an order saved during the poll is returned by the next one
+    now = timezone.now()
+
+    orders = ActiveOrders.objects.filter(category_id=categoryId)
+    newOrders = orders.filter(active=True)
+    if since is not None:
+        newOrders = newOrders.filter(id__gt=since)
+    orderIds = newOrders.values('id')
+    if updatedAfter is not None:
+        orderIds = orderIds.union(orders.filter(updated__gt=updatedAfter - _overlap()).values('id'))
+    orderIds = [row['id'] for row in orderIds]
+
+    board = ActiveOrders.objects.filter(id__in=orderIds).order_by('id') if orderIds else ActiveOrders.objects.none()
+    if prefetch:
+        board = prefetch(board)
+    board = list(board)
+
+    if board:
+        since = max(since or 0, board[-1].id)
+    return Board(board, since, now)
+
+
+ORDER_CREATED = 'order.created'
+ORDER_STATUS = 'order.status'
+
+
+# To push an order event (see crud/events.py) to the customer who placed the order and to the
+# category it's ordered from, once the transaction commits
+def publish_order_event(eventType, order):
+    data = {'order': order.id, 'active': order.active}
+    events.publish(f'user:{order.user_id}', eventType, data)
+    if order.category_id is not None:
+        events.publish(f'category:{order.category_id}', eventType, data)
+
+
+# Delivery of many orders at once, e.g. at the end of a rush.
+#
+# The orders of the category still active are marked as delivered by a single
+# UPDATE ... WHERE category_id = ? AND active AND id IN (...), which returns the ids it changed.
+# Only when some ids weren't changed, a second query tells the orders already delivered from the
+# ones which don't exist (or belong to another category). The SMS to the customers are enqueued in
+# the same transaction, and sent by the notifications worker (see notifications.py).
+
+MARK_DELIVERED_QUERY = '''
+UPDATE "FromOurKitchen_activeorders" SET "active" = %s, "updated" = %s
+WHERE "category_id" = %s AND "active" = %s AND "id" IN ({ids})
+RETURNING "id", "user_id"
+'''
+
+# Max number of orders of a bulk status update
+MAX_BULK_ORDERS = 100
+
+# Outcome of each order of a bulk status update
+DELIVERED = 'delivered'
+ALREADY_DELIVERED = 'already_delivered'
+NOT_FOUND = 'not_found'
+
+
+class InvalidStatusUpdate(Exception):
+    pass
+
+
+# Validates the order ids of a bulk status update, [12, 15, ...], without duplicates (in order)
+def parse_order_ids(orderIds):
+    if not isinstance(orderIds, list) or not orderIds:
+        raise InvalidStatusUpdate('A list of order ids is required')
+    if len(orderIds) > MAX_BULK_ORDERS:
+        raise InvalidStatusUpdate(f'At most {MAX_BULK_ORDERS} orders can be updated at once')
+    try:
+        orderIds = [int(orderId) for orderId in orderIds]
+    except (TypeError, ValueError):
+        raise InvalidStatusUpdate('Order ids must be integers')
+    return list(dict.fromkeys(orderIds))
+
+
+# To mark the orders of the category as delivered. Returns the outcome of each order id,
+# [{'id': 12, 'outcome': DELIVERED}, ...], in the order of the ids given
+def mark_delivered(categoryId, orderIds):
+    orderIds = parse_order_ids(orderIds)
+    updated = ActiveOrders._meta.get_field('updated').get_db_prep_value(timezone.now(), connection)
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                MARK_DELIVERED_QUERY.format(ids=', '.join(['%s'] * len(orderIds))),
+                [False, updated, categoryId, True, *orderIds],
+            )
+            delivered = dict(cursor.fetchall())
+
+        for orderId, userId in delivered.items():
+            publish_order_event(ORDER_STATUS, ActiveOrders(id=orderId, user_id=userId, category_id=categoryId, active=False))
+        if delivered:
+            notify_delivered(list(delivered))
+
+    others = [orderId for orderId in orderIds if orderId not in delivered]
+    existing = set(ActiveOrders.objects.filter(id__in=others, category_id=categoryId).values_list('id', flat=True)) if others else set()
+    return [
+        {'id': orderId, 'outcome': DELIVERED if orderId in delivered else ALREADY_DELIVERED if orderId in existing else NOT_FOUND}
+        for orderId in orderIds
+    ]
+
+
+# To text the customers that their orders have been delivered (enqueued in the current transaction)
+def notify_delivered(orderIds):
+    numbers = ActiveOrders.objects.filter(id__in=orderIds, user__userNumber__isnull=False).values_list('id', 'user__userNumber__number')
+    notifications.enqueue([
+        (
+            f'order.delivered:{orderId}', '+' + str(number),
+            "Your order #" + str(orderId) + " has been delivered! Thanks for ordering at From Our Kitchen ! ",
+        )
+        for orderId, number in numbers
+    ])
+
+
+# To text the customer that the order has been placed (enqueued in the current transaction)
+def notify_placed(order, itemCount):
+    number = MobileNumber.objects.filter(user_id=order.user_id).values_list('number', flat=True).first()
+    if number is None:
+        return
+    notifications.enqueue([(
+        f'order.placed:{order.id}', '+' + str(number),
+        "From Our Kitchen: Order Placed (" + str(itemCount) + " item(s), Rs." + str(rupees(order.totalPaise)) + ").\nHappy Eating!",
+    )])
@@ -0,0 +1,199 @@
+import hmac
+import logging
+import re
+import secrets
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.crypto import salted_hmac
+from django.utils.module_loading import import_string
+
+from FromOurKitchen.models import OneTimeCode
+from crud import asyncviews
+
+logger = logging.getLogger(__name__)
+
+
+# One time codes verifying the mobile numbers.
+#
+# Codes are issued and checked here, without calling an external service: only the text SMS with
+# the code goes out, through the OTP_PROVIDER (a provider of FromOurKitchen/notifications.py, Twilio
+# by default whatever the NOTIFICATIONS_PROVIDER), once the code is saved. It's sent during the
+# request, so a code which couldn't be sent is an error of the request (DeliveryFailed), not a code
+# silently lost. It isn't put in the notifications outbox: the code would be stored in plain text,
+# and wait for the worker. aissue() is issue() for the async views: the code is saved on a thread,
+# and the message sent without holding one (nor a database connection).
+# A number has a single code at a time, in OneTimeCode:
+#   - the code is stored as an HMAC of the number and the code (keyed by SECRET_KEY), and compared
+#     in constant time
+#   - it expires after OTP_TTL seconds, or after OTP_MAX_ATTEMPTS wrong checks, and is used once
+#   - a number is sent a code at most every OTP_RESEND_INTERVAL seconds, and at most OTP_MAX_SENDS
+#     codes per OTP_SEND_WINDOW seconds
+# The row of the number is locked while a code is issued or checked, so concurrent requests can't
+# exceed the limits.
+
+# Outcomes of a check
+APPROVED = 'approved'
+# A wrong code, with attempts left
+INVALID = 'invalid'
+# No code, or expired, or already used
+EXPIRED = 'expired'
+TOO_MANY_ATTEMPTS = 'too_many_attempts'
+
+# With the country code, e.g. '+919876543210'
+NUMBER_REGEX = re.compile(r'^\+[1-9]\d{7,14}$')
+
+
+class InvalidNumber(ValueError):
+    pass
+
+
+# The number was sent too many codes. retryAfter is in seconds
+class RateLimited(Exception):
+    def __init__(self, retryAfter):
+        super().__init__(f'Try again in {retryAfter} seconds')
+        self.retryAfter = retryAfter
+
+
+# The code couldn't be sent, with the error code of the provider (e.g. Twilio's 21211 for an invalid number)
+class DeliveryFailed(Exception):
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+
+# Twilio's error codes of a number which can't receive the code. Refer: https://www.twilio.com/docs/api/errors
+INVALID_NUMBER_CODES = (21211, 21614, 60200)
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _hash(number, code):
+    return salted_hmac('FromOurKitchen.otp', f'{number}:{code}', algorithm='sha256').hexdigest()
+
+
+def get_provider():
+    return import_string(_setting('OTP_PROVIDER', 'FromOurKitchen.notifications.TwilioProvider'))()
+
+
+def _message(code):
+    minutes = _setting('OTP_TTL', 600) // 60
+    return f'From Our Kitchen: your verification code is {code}. It expires in {minutes} minutes.'
+
+
+def _failed(number, e):
+    logger.warning('Sending the verification code to %s failed: %s', number, e)
+    return DeliveryFailed(str(e) or e.__class__.__name__, getattr(e, 'code', None))
+
+
+# Raises DeliveryFailed if the provider didn't accept the message
+def _deliver(number, code):
+    try:
+        get_provider().send(number, _message(code))
+    except Exception as e:
+        raise _failed(number, e)
+
+
+async def _adeliver(number, code):
+    try:
+        await get_provider().asend(number, _message(code))
+    except Exception as e:
+        raise _failed(number, e)
+
+
+# A new code for the number. Raises InvalidNumber
+def _new_code(number):
+    if not NUMBER_REGEX.match(number):
+        raise InvalidNumber('Invalid phone number')
+    digits = _setting('OTP_DIGITS', 6)
+    return f'{secrets.randbelow(10 ** digits):0{digits}d}'
+
+
+# To save the code as the number's one. Returns the time it's sent at.
+# Raises RateLimited if the number was sent too many codes
+def _save(number, code):
+    now = timezone.now()
+    fields = {
+        'codeHash': _hash(number, code),
+        'expires': now + timedelta(seconds=_setting('OTP_TTL', 600)),
+        'attempts': 0,
+        'sent': now,
+    }
+
+    with transaction.atomic():
+        oneTimeCode, created = OneTimeCode.objects.select_for_update().get_or_create(
+            number=number, defaults={**fields, 'sends': 1, 'windowStart': now},
+        )
+        if not created:
+            resendAt = oneTimeCode.sent + timedelta(seconds=_setting('OTP_RESEND_INTERVAL', 30))
+            if now < resendAt:
+                raise RateLimited(int((resendAt - now).total_seconds()) + 1)
+            windowEnd = oneTimeCode.windowStart + timedelta(seconds=_setting('OTP_SEND_WINDOW', 3600))
+            if now >= windowEnd:
+                oneTimeCode.windowStart, oneTimeCode.sends = now, 0
+            elif oneTimeCode.sends >= _setting('OTP_MAX_SENDS', 5):
+                raise RateLimited(int((windowEnd - now).total_seconds()) + 1)
+
+            for name, value in fields.items():
+                setattr(oneTimeCode, name, value)
+            oneTimeCode.sends += 1
+            oneTimeCode.save(update_fields=[*fields, 'sends', 'windowStart'])
+    return now
+
+
+# The code which couldn't be sent is dropped, and another one can be sent right away (it still
+# counts in OTP_MAX_SENDS)
+def _drop(number, sent):
+    OneTimeCode.objects.filter(number=number).update(
+        codeHash='', sent=sent - timedelta(seconds=_setting('OTP_RESEND_INTERVAL', 30)),
+    )
+
+
+# To send a new code to the number. Returns the code.
+# Raises InvalidNumber, RateLimited if the number was sent too many codes, or DeliveryFailed
+def issue(number):
+    code = _new_code(number)
+    sent = _save(number, code)
+    try:
+        _deliver(number, code)
+    except DeliveryFailed:
+        _drop(number, sent)
+        raise
+    return code
+
+
+async def aissue(number):
+    code = _new_code(number)
+    sent = await sync_to_async(_save)(number, code)
+    await asyncviews.release_connection()
+    try:
+        await _adeliver(number, code)
+    except DeliveryFailed:
+        await sync_to_async(_drop)(number, sent)
+        raise
+    return code
+
+
+# To check the code sent to the number. Returns APPROVED, INVALID, EXPIRED or TOO_MANY_ATTEMPTS
+def check(number, code):
+    with transaction.atomic():
+        oneTimeCode = OneTimeCode.objects.select_for_update().filter(number=number).first()
+        if oneTimeCode is None or not oneTimeCode.codeHash or oneTimeCode.expires <= timezone.now():
+            return EXPIRED
+        if oneTimeCode.attempts >= _setting('OTP_MAX_ATTEMPTS', 5):
+            return TOO_MANY_ATTEMPTS
+
+        oneTimeCode.attempts += 1
+        if hmac.compare_digest(oneTimeCode.codeHash, _hash(number, str(code).strip())):
+            # Used once
+            oneTimeCode.codeHash = ''
+            outcome = APPROVED
+        else:
+            outcome = INVALID
+        oneTimeCode.save(update_fields=['attempts', 'codeHash'])
+    return outcome
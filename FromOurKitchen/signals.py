@@ -0,0 +1,29 @@
+from django.contrib.auth.models import Group, User
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from crud import tokens
+
+
+# The role claim of the tokens is cached (see crud/tokens.py). Covers every write path: the partner
+# registration, the admin and the shell
+@receiver(m2m_changed, sender=User.groups.through)
+def invalidate_user_roles(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        # user.groups changed
+        tokens.invalidate_roles([instance.id])
+    elif pk_set:
+        # group.user_set changed
+        tokens.invalidate_roles(pk_set)
+    else:
+        # group.user_set.clear(), the users aren't known anymore
+        tokens.invalidate_all_roles()
+
+
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+def invalidate_group_roles(sender, instance, created=False, **kwargs):
+    if not created:
+        tokens.invalidate_all_roles()
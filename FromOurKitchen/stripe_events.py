@@ -0,0 +1,195 @@
+import json
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+
+from FromOurKitchen import cart as userCart
+from FromOurKitchen import checkout as userCheckout
+from FromOurKitchen import orders
+from FromOurKitchen.models import ActiveOrders, Address, CheckoutSession, OrderLine, StripeEvent, User
+from crud import background
+
+logger = logging.getLogger(__name__)
+
+
+# Stripe webhook events.
+#
+# The webhook only verifies the signature and saves the event, keyed by its Stripe event id, then
+# answers 200 at once: Stripe redelivers an event answered slowly (or not at all), and a
+# redelivered event is not saved again. The event is processed afterwards:
+#   - right away, in the 'webhooks' background pool once the event is committed
+#   - otherwise by the process_stripe_events worker, which also retries the failed events with an
+#     exponential backoff (up to STRIPE_EVENTS_MAX_ATTEMPTS attempts)
+# An event is claimed before being processed (FOR UPDATE SKIP LOCKED on Postgres, and a lease of
+# STRIPE_EVENTS_LEASE seconds), so it's processed by one of them at a time.
+#
+# Processing has to be idempotent all the same (an event can be replayed, see the
+# replay_stripe_events command): e.g. a checkout session places a single order
+# (ActiveOrders.checkoutSession is unique).
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+# Handlers of the event types, called with the object of the event (e.g. the checkout session)
+HANDLERS = {}
+
+
+def handler(eventType):
+    def register(fn):
+        HANDLERS[eventType] = fn
+        return fn
+    return register
+
+
+# To save an event received by the webhook (event, as verified by stripe.Webhook.construct_event,
+# and payload, the body of the request) and process it in the background.
+# Returns False if it was already received
+def receive(event, payload):
+    try:
+        with transaction.atomic():
+            stripeEvent = StripeEvent.objects.create(
+                eventId=event['id'], type=event['type'],
+                payload=payload.decode() if isinstance(payload, bytes) else payload,
+            )
+    except IntegrityError:
+        return False
+    background.submit_on_commit('webhooks', process_event, stripeEvent.id)
+    return True
+
+
+def _backoff(attempts):
+    delay = _setting('STRIPE_EVENTS_RETRY_DELAY', 10) * 2 ** (attempts - 1)
+    return timedelta(seconds=min(delay, _setting('STRIPE_EVENTS_MAX_RETRY_DELAY', 3600)))
+
+
+# To claim the pending events due (all of them, or the given ones), at most batchSize of them
+def claim(batchSize, ids=None):
+    now = timezone.now()
+    with transaction.atomic():
+        due = StripeEvent.objects.filter(status=StripeEvent.PENDING, nextAttempt__lte=now).order_by('nextAttempt')
+        if ids is not None:
+            due = due.filter(id__in=ids)
+        if connection.features.has_select_for_update_skip_locked:
+            # Concurrent processors claim different events
+            due = due.select_for_update(skip_locked=True)
+        batch = list(due[:batchSize])
+        if batch:
+            lease = now + timedelta(seconds=_setting('STRIPE_EVENTS_LEASE', 300))
+            StripeEvent.objects.filter(id__in=[stripeEvent.id for stripeEvent in batch]).update(nextAttempt=lease)
+    return batch
+
+
+# To process a claimed event, and save the outcome. Returns True if it was processed
+def process(stripeEvent):
+    event = json.loads(stripeEvent.payload)
+    fn = HANDLERS.get(stripeEvent.type)
+    attempts = stripeEvent.attempts + 1
+    try:
+        if fn is not None:
+            fn(event['data']['object'])
+        else:
+            logger.info('Unhandled event type %s', stripeEvent.type)
+    except Exception as e:
+        logger.exception('Processing the Stripe event %s failed', stripeEvent.eventId)
+        failed = attempts >= _setting('STRIPE_EVENTS_MAX_ATTEMPTS', 8)
+        StripeEvent.objects.filter(id=stripeEvent.id).update(
+            attempts=attempts, error=(str(e) or e.__class__.__name__)[:1000],
+            status=StripeEvent.FAILED if failed else StripeEvent.PENDING,
+            nextAttempt=timezone.now() + _backoff(attempts),
+        )
+        return False
+    StripeEvent.objects.filter(id=stripeEvent.id).update(
+        attempts=attempts, error='', status=StripeEvent.PROCESSED, processed=timezone.now(),
+    )
+    return True
+
+
+# To process the event, if it's still pending (the background task of receive())
+def process_event(id):
+    for stripeEvent in claim(1, ids=[id]):
+        process(stripeEvent)
+
+
+# To process the pending events due, batchSize at a time, until none are left (or maxBatches
+# batches). Returns the number of events (processed, failed to process)
+def process_events(batchSize=None, maxBatches=None):
+    batchSize = batchSize or _setting('STRIPE_EVENTS_BATCH_SIZE', 50)
+    processed = failed = batches = 0
+    while maxBatches is None or batches < maxBatches:
+        batch = claim(batchSize)
+        if not batch:
+            break
+        for stripeEvent in batch:
+            if process(stripeEvent):
+                processed += 1
+            else:
+                failed += 1
+        batches += 1
+    return processed, failed
+
+
+# To process the given events again (e.g. after fixing a handler), whatever their status.
+# Returns the number of events (processed, failed to process)
+def replay(stripeEvents):
+    ids = [stripeEvent.id for stripeEvent in stripeEvents]
+    StripeEvent.objects.filter(id__in=ids).update(status=StripeEvent.PENDING, attempts=0, nextAttempt=timezone.now())
+    processed = failed = 0
+    for start in range(0, len(ids), 50):
+        for stripeEvent in claim(50, ids=ids[start:start + 50]):
+            if process(stripeEvent):
+                processed += 1
+            else:
+                failed += 1
+    return processed, failed
+
+
+# The order of a checkout session can't be placed from what was saved at checkout
+class InvalidCheckout(Exception):
+    pass
+
+
+# A checkout session paid: places the order of the quote saved with the session at checkout (see
+# checkout.py), to the address chosen at checkout (passed as the session's metadata by the checkout
+# view), and takes its items out of the user's cart
+@handler('checkout.session.completed')
+def complete_checkout(session):
+    if ActiveOrders.objects.filter(checkoutSession=session['id']).exists():
+        # Already placed (the event was replayed)
+        return
+
+    checkoutSession = CheckoutSession.objects.filter(sessionId=session['id']).first()
+    if checkoutSession is None:
+        raise InvalidCheckout(f'No checkout session {session["id"]}')
+    if not checkoutSession.lines or session.get('amount_total') != checkoutSession.totalPaise:
+        # Not what the customer paid for
+        raise InvalidCheckout(
+            f'Checkout session {session["id"]} paid {session.get("amount_total")}, its quote is {checkoutSession.totalPaise}'
+        )
+    sessionUser = User.objects.get(id=session['metadata']['user'])
+    # Get the chosen delivery address passed from the frontend
+    address = Address.objects.get(id=session['metadata']['addressID'])
+    try:
+        with transaction.atomic():
+            # With the category the food is ordered from, for the category's order board
+            addOrder = ActiveOrders.objects.create(
+                user=sessionUser, address=address, category_id=checkoutSession.category_id,
+                totalPaise=checkoutSession.totalPaise, checkoutSession=session['id'],
+            )
+            # Later changes to the food items don't change the order
+            OrderLine.objects.bulk_create([OrderLine.from_checkout(addOrder, line) for line in checkoutSession.lines])
+            userCart.remove_ordered_items(sessionUser, checkoutSession.lines)
+            # To send the user a text SMS about the order placed (by the notifications worker)
+            orders.notify_placed(addOrder, len(checkoutSession.lines))
+            # Checking out the same cart again is a new order
+            userCheckout.forget_session(session['id'])
+    except IntegrityError:
+        if ActiveOrders.objects.filter(checkoutSession=session['id']).exists():
+            # Placed meanwhile
+            return
+        raise
+    orders.publish_order_event(orders.ORDER_CREATED, addOrder)
+    logger.info('Saved order %s of checkout session %s', addOrder.id, session['id'])
@@ -0,0 +1,110 @@
+import json
+import math
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+
+# Async views, for the endpoints waiting on an external service (Stripe, Twilio): under ASGI a request
+# waiting on it doesn't hold a thread, so a process serves hundreds of them at a time. DRF's views
+# are sync, these are plain Django views made to behave like them:
+#   - @api_view(methods) answers the other methods with a 405, authenticates the request with its
+#     JWT access token (401 without one), and parses the JSON or form body into request.data
+#   - @api_view(methods, throttles=...) checks the DRF throttles of crud/ratelimit.py, like
+#     @throttle_classes: a throttled request gets a 429 with a Retry-After header
+#   - Response(data, status) renders the data like DRF does (sets as lists)
+# The database is only reached through the async ORM (aget, acreate, ...) or sync_to_async, on a
+# thread (and a connection) of the request: release_connection() closes the connection before waiting
+# on the service, so that the requests in flight don't each hold one.
+
+User = get_user_model()
+
+
+def Response(data=None, status=200):
+    if isinstance(data, set):
+        data = list(data)
+    return JsonResponse(data, status=status, safe=False, json_dumps_params={'ensure_ascii': False})
+
+
+# The active user of the request's access token, or None (and the reason)
+async def authenticate(request):
+    authentication = JWTAuthentication()
+    header = authentication.get_header(request)
+    raw = authentication.get_raw_token(header) if header is not None else None
+    if raw is None:
+        return None, 'Authentication credentials were not provided.'
+    try:
+        token = authentication.get_validated_token(raw)
+    except InvalidToken:
+        return None, 'Given token not valid for any token type'
+    user = await User.objects.filter(
+        **{api_settings.USER_ID_FIELD: token.get(api_settings.USER_ID_CLAIM), 'is_active': True},
+    ).afirst()
+    if user is None:
+        return None, 'User not found'
+    return user, None
+
+
+def _close_connection():
+    # Not within a transaction (e.g. a TestCase)
+    if not connection.in_atomic_block:
+        connection.close()
+
+
+async def release_connection():
+    await sync_to_async(_close_connection)()
+
+
+def _parse(request):
+    if request.content_type == 'application/json':
+        return json.loads(request.body or b'{}')
+    return request.POST
+
+
+# The seconds to wait if one of the throttles refuses the request, else None
+def _throttle(request, throttles):
+    waits = []
+    for throttle in throttles:
+        throttle = throttle()
+        if not throttle.allow_request(request, None):
+            waits.append(throttle.wait())
+    if waits:
+        return math.ceil(max(wait or 0 for wait in waits))
+    return None
+
+
+def api_view(methods, authenticated=True, throttles=()):
+    def decorator(view):
+        # Authenticated by the Authorization header, not by a cookie
+        @csrf_exempt
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in methods:
+                return Response({'detail': f'Method "{request.method}" not allowed.'}, status=405)
+            if authenticated:
+                request.user, error = await authenticate(request)
+                if request.user is None:
+                    response = Response({'detail': error}, status=401)
+                    response['WWW-Authenticate'] = 'Bearer realm="api"'
+                    return response
+            try:
+                request.data = _parse(request)
+            except ValueError as e:
+                return Response({'detail': f'JSON parse error - {e}'}, status=400)
+            if throttles:
+                # The buckets may be in the database (see crud/ratelimit.py)
+                wait = await sync_to_async(_throttle)(request, throttles)
+                if wait is not None:
+                    response = Response({'detail': f'Request was throttled. Expected available in {wait} seconds.'}, status=429)
+                    response['Retry-After'] = str(wait)
+                    return response
+            return await view(request, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,59 @@
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+logger = logging.getLogger(__name__)
+
+
+# Small in-process worker pools for work which shouldn't make a request wait (image processing,
+# notifications, ...). Each named pool is created on first use, with BACKGROUND_WORKERS[name]
+# threads (2 by default).
+#
+# With BACKGROUND_TASKS_EAGER = True tasks run inline instead, which keeps tests deterministic.
+
+_executors = {}
+_executorsLock = threading.Lock()
+
+
+def _get_executor(pool):
+    executor = _executors.get(pool)
+    if executor is None:
+        with _executorsLock:
+            executor = _executors.get(pool)
+            if executor is None:
+                workers = getattr(settings, 'BACKGROUND_WORKERS', {}).get(pool, 2)
+                executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'background-{pool}')
+                _executors[pool] = executor
+    return executor
+
+
+def _run(fn, args, kwargs):
+    try:
+        return fn(*args, **kwargs)
+    except Exception:
+        logger.exception('Background task %s failed', getattr(fn, '__name__', fn))
+        raise
+    finally:
+        # Worker threads keep their own database connection, don't let it go stale
+        close_old_connections()
+
+
+# To run fn(*args, **kwargs) in the given pool. Returns a Future
+def submit(pool, fn, *args, **kwargs):
+    if getattr(settings, 'BACKGROUND_TASKS_EAGER', False):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            logger.exception('Background task %s failed', getattr(fn, '__name__', fn))
+            future.set_exception(e)
+        return future
+    return _get_executor(pool).submit(_run, fn, args, kwargs)
+
+
+# Same as submit(), but only once the current transaction commits (so the task sees the committed rows)
+def submit_on_commit(pool, fn, *args, **kwargs):
+    transaction.on_commit(lambda: submit(pool, fn, *args, **kwargs))
@@ -12,7 +12,9 @@ SECRET_KEY = os.environ.get['SECRET_KEY']
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware', 
     'django.contrib.sessions.middleware.SessionMiddleware',
-    "whitenoise.middleware.WhiteNoiseMiddleware",
+    "crud.middleware.CatalogWhiteNoiseMiddleware",
+    'crud.middleware.LoadSheddingMiddleware',
+    'crud.middleware.QueryBudgetMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -25,17 +27,35 @@ MIDDLEWARE = [
 
 STORAGES = {
     'default': {
-        'BACKEND':'django.core.files.storage.FileSystemStorage',
+        'BACKEND':'crud.storage.ContentAddressedStorage',
+        'OPTIONS': {'base_url': MEDIA_CDN_URL} if MEDIA_CDN_URL else {},
     },
     'staticfiles': {
         'BACKEND':'whitenoise.storage.CompressedStaticFilesStorage'
     }
 }
 
+# Served by the ASGI app (see the Procfile), where persistent connections aren't reused across
+# requests, so they're closed at the end of each request
 DATABASES = {
     'default': dj_database_url.config(
         default=os.environ['DATABASE_URL'],
-        conn_max_age=600
+        conn_max_age=0
     )
 }
 
+# The catalog cache is shared by the workers, so that an invalidation reaches them all (see
+# CATALOG_CACHE_BACKEND). Its table is created by `python manage.py createcachetable`, run on start
+CATALOG_CACHE_BACKEND = os.getenv('CATALOG_CACHE_BACKEND', 'db')
+CACHES[CATALOG_CACHE_ALIAS] = CATALOG_CACHE_BACKENDS[CATALOG_CACHE_BACKEND]
+# As are the rate limits: with LocalBackend each worker would have its own buckets, and a burst
+# spread over the workers would get WEB_CONCURRENCY times the rates
+RATELIMIT_BACKEND = os.getenv('RATELIMIT_BACKEND', 'crud.ratelimit.CacheBackend')
+CACHES[RATELIMIT_CACHE_ALIAS] = {
+    'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+    'LOCATION': 'ratelimit_cache',
+}
+
+# Events reach the streams of every worker, through Postgres LISTEN/NOTIFY
+EVENTS_BACKEND = 'crud.events.PostgresBackend'
+
@@ -0,0 +1,233 @@
+import asyncio
+import json
+import logging
+import select
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connections, transaction
+from django.http import StreamingHttpResponse
+from django.utils.module_loading import import_string
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.tokens import AccessToken
+
+logger = logging.getLogger(__name__)
+
+
+# Server-sent events (SSE), pushed to the browsers over long-lived responses of the ASGI app.
+#
+# Events are published to a channel (e.g. 'user:3' for the orders of a customer, 'category:5' for
+# the orders of a partner) and delivered to every stream subscribed to it:
+#
+#     publish('user:3', 'order.status', {'order': 12, 'active': False})
+#
+# A stream is an async generator waiting on an asyncio queue, so an idle connection costs a few KB
+# of memory and no thread. Publishing is thread safe: events published by the sync views (running
+# in worker threads) are handed to the event loop of each stream.
+#
+# The broker delivers the events to the streams of this process. Reaching the streams of the other
+# worker processes is the job of the backend, EVENTS_BACKEND:
+#   - LocalBackend: this process only (development, a single worker)
+#   - PostgresBackend: every process listening on the same database, through LISTEN/NOTIFY
+#
+# Events are a hint that something changed, not a log: a client which missed some (disconnected,
+# or too slow and sent a "resync" event) fetches the current state again (e.g. the order board).
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+class Subscription:
+    def __init__(self, channel):
+        self.channel = channel
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=_setting('EVENTS_QUEUE_SIZE', 100))
+        # Set when events were dropped, as the client doesn't read them fast enough
+        self.lost = False
+
+    # Called in the event loop of the stream
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.lost = True
+
+
+class Broker:
+    def __init__(self):
+        self.subscriptions = {}
+        self.lock = threading.Lock()
+        self._backend = None
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            with self.lock:
+                if self._backend is None:
+                    self._backend = import_string(_setting('EVENTS_BACKEND', 'crud.events.LocalBackend'))(self)
+        return self._backend
+
+    # To be called from a coroutine (the stream is bound to its event loop)
+    def subscribe(self, channel):
+        self.backend.start()
+        subscription = Subscription(channel)
+        with self.lock:
+            self.subscriptions.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.channel, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self.subscriptions.pop(subscription.channel, None)
+
+    # To send the event to the streams of this process subscribed to the channel. Called by the backend,
+    # from any thread
+    def deliver(self, channel, event):
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.put, event)
+            except RuntimeError:
+                # The event loop is closed, the stream is gone
+                self.unsubscribe(subscription)
+
+    # To tell every stream of this process that events may have been missed (see PostgresBackend)
+    def resync(self):
+        with self.lock:
+            subscriptions = [subscription for channel in self.subscriptions.values() for subscription in channel]
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.put, {'type': 'resync', 'data': {}})
+            except RuntimeError:
+                self.unsubscribe(subscription)
+
+
+# Delivers the events to the streams of the publishing process only
+class LocalBackend:
+    def __init__(self, broker):
+        self.broker = broker
+
+    def start(self):
+        pass
+
+    def publish(self, channel, event):
+        self.broker.deliver(channel, event)
+
+
+# Delivers the events to every process through Postgres LISTEN/NOTIFY: publishing sends a NOTIFY,
+# and a thread of each process serving streams LISTENs on its own connection (started on the first
+# subscription). The payload of a NOTIFY is limited to 8000 bytes, events only carry ids.
+class PostgresBackend:
+    CHANNEL = 'fromourkitchen_events'
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.listen, name='events-listener', daemon=True)
+                self.thread.start()
+
+    def publish(self, channel, event):
+        with connections['default'].cursor() as cursor:
+            cursor.execute('SELECT pg_notify(%s, %s)', [self.CHANNEL, json.dumps({'channel': channel, 'event': event})])
+
+    def listen(self):
+        import psycopg2
+
+        while True:
+            connection = None
+            try:
+                connection = psycopg2.connect(**connections['default'].get_connection_params())
+                connection.autocommit = True
+                with connection.cursor() as cursor:
+                    cursor.execute(f'LISTEN {self.CHANNEL}')
+                while True:
+                    if select.select([connection], [], [], 60) == ([], [], []):
+                        continue
+                    connection.poll()
+                    while connection.notifies:
+                        payload = json.loads(connection.notifies.pop(0).payload)
+                        self.broker.deliver(payload['channel'], payload['event'])
+            except Exception:
+                logger.exception('Listening to the events failed, reconnecting')
+            finally:
+                if connection is not None:
+                    connection.close()
+            # Events published while disconnected are lost
+            self.broker.resync()
+            time.sleep(5)
+
+
+broker = Broker()
+
+
+# To publish an event once the current transaction commits (at once outside of a transaction)
+def publish(channel, eventType, data):
+    event = {'type': eventType, 'data': data}
+    transaction.on_commit(lambda: broker.backend.publish(channel, event))
+
+
+# The access token of the request, validated. EventSource (the browser's SSE client) can't send
+# headers, so it can also be passed as ?token= (it then shows in the access logs, but expires within
+# minutes). Raises TokenError if it's missing, invalid or expired
+def get_access_token(request):
+    header = request.headers.get('Authorization', '')
+    raw = header[len('Bearer '):] if header.startswith('Bearer ') else request.GET.get('token')
+    # AccessToken() without a token would create a new one
+    if not raw:
+        raise TokenError('No access token')
+    return AccessToken(raw)
+
+
+def _format(eventType, data):
+    return f'event: {eventType}\ndata: {json.dumps(data)}\n\n'
+
+
+async def _stream(subscription, expires):
+    heartbeat = _setting('EVENTS_HEARTBEAT', 15)
+    try:
+        # How long the browser waits before reconnecting, in ms
+        yield f'retry: {_setting("EVENTS_RETRY", 3000)}\n\n'
+        while time.time() < expires:
+            try:
+                event = await asyncio.wait_for(subscription.queue.get(), min(heartbeat, max(expires - time.time(), 0)))
+            except asyncio.TimeoutError:
+                # Keeps proxies from closing the idle connection
+                yield ': keep-alive\n\n'
+                continue
+            yield _format(event['type'], event['data'])
+            if subscription.lost and subscription.queue.empty():
+                subscription.lost = False
+                yield _format('resync', {})
+        # The access token expired, the client reconnects with a new one
+        yield _format('expired', {})
+    finally:
+        broker.unsubscribe(subscription)
+
+
+# A stream may stay open for hours, it shouldn't hold a database connection that long
+def _release_connections():
+    for connection in connections.all(initialized_only=True):
+        if not connection.in_atomic_block:
+            connection.close()
+
+
+# Response streaming the events of the channel until the access token expires
+async def stream(channel, token):
+    await sync_to_async(_release_connections)()
+    subscription = broker.subscribe(channel)
+    response = StreamingHttpResponse(_stream(subscription, token['exp']), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Not buffered by nginx
+    response['X-Accel-Buffering'] = 'no'
+    return response
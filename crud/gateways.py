@@ -0,0 +1,337 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import threading
+import time
+import uuid
+import weakref
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+
+# Gateways to the external services: payments (Stripe) and messaging (Twilio).
+#
+# The views never import the SDKs: they call gateways.payments() and gateways.messaging(), which
+# return the gateway of PAYMENTS_GATEWAY and MESSAGING_GATEWAY, created on first use. So:
+#   - the SDKs are imported on the first payment or message, not when the app starts (importing
+#     stripe alone takes more than a second)
+#   - each process configures the SDK once, with the credentials of the settings, and reuses a
+#     keep-alive HTTP connection pool (GATEWAY_POOL_SIZE connections) with GATEWAY_TIMEOUT seconds timeouts
+#   - FakePaymentsGateway and FakeMessagingGateway run the whole API offline (local runs, load tests)
+#
+# The gateways also have async methods (acreate_checkout_session, asend_sms, ...), for the async
+# views: their requests go through aiohttp (Stripe's up to GATEWAY_ASYNC_POOL_SIZE connections per
+# event loop), and don't hold a thread while waiting on Stripe or Twilio.
+
+
+# A messaging error, with the error code of the service (e.g. Twilio's 60200 for an invalid number)
+class MessagingError(Exception):
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+
+# A payments error, with the error code of the service (e.g. Stripe's 'resource_missing')
+class PaymentsError(Exception):
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+
+# An idempotency key reused with other parameters, or while its first request is still running
+class IdempotencyConflict(PaymentsError):
+    pass
+
+
+# The payload of a webhook request isn't signed by the payment service
+class InvalidWebhook(ValueError):
+    pass
+
+
+# A setting the gateway can't do without (e.g. the Stripe account of the checkout sessions), set from
+# the environment
+def _required(name):
+    value = getattr(settings, name, None)
+    if not value:
+        raise ImproperlyConfigured(f'{name} is not set')
+    return value
+
+
+def _requests_session():
+    import requests
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=getattr(settings, 'GATEWAY_POOL_SIZE', 10))
+    session.mount('https://', adapter)
+    return session
+
+
+# Stripe's aiohttp client, with a session per event loop: an aiohttp session can't be used from
+# another loop than the one it was created in (the ASGI app has one loop per process, but
+# async_to_sync, e.g. under the WSGI dev server, runs each call in a new one)
+def _aiohttp_client():
+    import aiohttp
+    import ssl
+    import stripe
+
+    class AIOHTTPClient(stripe.AIOHTTPClient):
+        def __init__(self, **kwargs):
+            super().__init__(**kwargs)
+            self.sessions = weakref.WeakKeyDictionary()
+
+        @property
+        def _session(self):
+            loop = asyncio.get_running_loop()
+            session = self.sessions.get(loop)
+            if session is None:
+                connector = aiohttp.TCPConnector(
+                    ssl=ssl.create_default_context(cafile=stripe.ca_bundle_path),
+                    limit=getattr(settings, 'GATEWAY_ASYNC_POOL_SIZE', 500),
+                )
+                session = self.sessions[loop] = aiohttp.ClientSession(connector=connector)
+            return session
+
+    return AIOHTTPClient(timeout=getattr(settings, 'GATEWAY_TIMEOUT', 10))
+
+
+class StripeGateway:
+    def __init__(self):
+        import stripe
+
+        self.stripe = stripe
+        stripe.api_key = settings.STRIPE_API_KEY
+        stripe.default_http_client = stripe.RequestsClient(
+            timeout=getattr(settings, 'GATEWAY_TIMEOUT', 10), session=_requests_session(),
+            # Used by the async methods
+            async_fallback_client=_aiohttp_client(),
+        )
+        # Requests are retried on network errors, with an idempotency key (see https://stripe.com/docs/error-low-level)
+        stripe.max_network_retries = 2
+
+    def _error(self, e):
+        if isinstance(e, self.stripe.error.IdempotencyError):
+            return IdempotencyConflict(str(e), e.code)
+        return PaymentsError(str(e), e.code)
+
+    # Refer: https://stripe.com/docs/api/checkout/sessions/create
+    def create_checkout_session(self, idempotencyKey=None, **params):
+        try:
+            return self.stripe.checkout.Session.create(
+                stripe_account=_required('STRIPE_CHECKOUT_ACCOUNT'), idempotency_key=idempotencyKey, **params,
+            )
+        except self.stripe.error.StripeError as e:
+            raise self._error(e)
+
+    async def acreate_checkout_session(self, idempotencyKey=None, **params):
+        try:
+            return await self.stripe.checkout.Session.create_async(
+                stripe_account=_required('STRIPE_CHECKOUT_ACCOUNT'), idempotency_key=idempotencyKey, **params,
+            )
+        except self.stripe.error.StripeError as e:
+            raise self._error(e)
+
+    # The event of a webhook request, once its signature verified.
+    # See https://stripe.com/docs/webhooks/signatures for more information.
+    def construct_event(self, payload, signature):
+        try:
+            return self.stripe.Webhook.construct_event(payload, signature, settings.STRIPE_WEBHOOK_SECRET)
+        except (ValueError, self.stripe.error.SignatureVerificationError) as e:
+            raise InvalidWebhook(str(e))
+
+    # Refer: https://stripe.com/docs/api/events/retrieve
+    def retrieve_event(self, eventId):
+        return self.stripe.Event.retrieve(eventId)
+
+    # For more info refer to: https://stripe.com/docs/connect/enable-payment-acceptance-guide?platform=web#web-create-standard-account
+    def create_account(self, email):
+        return self.stripe.Account.create(type='standard', country='US', email=email)
+
+    async def acreate_account(self, email):
+        return await self.stripe.Account.create_async(type='standard', country='US', email=email)
+
+    # Refer: https://stripe.com/docs/api/accounts/retrieve
+    def retrieve_account(self, accountId):
+        return self.stripe.Account.retrieve(accountId)
+
+    async def aretrieve_account(self, accountId):
+        return await self.stripe.Account.retrieve_async(accountId)
+
+    # The URL of the onboarding of the account.
+    # Refer: https://stripe.com/docs/connect/enable-payment-acceptance-guide?platform=web#web-create-account-link
+    def create_account_link(self, accountId):
+        return self.stripe.AccountLink.create(
+            account=accountId,
+            refresh_url=settings.STRIPE_ONBOARDING_REFRESH_URL,
+            return_url=settings.STRIPE_ONBOARDING_RETURN_URL,
+            type='account_onboarding',
+        ).url
+
+    async def acreate_account_link(self, accountId):
+        accountLink = await self.stripe.AccountLink.create_async(
+            account=accountId,
+            refresh_url=settings.STRIPE_ONBOARDING_REFRESH_URL,
+            return_url=settings.STRIPE_ONBOARDING_RETURN_URL,
+            type='account_onboarding',
+        )
+        return accountLink.url
+
+
+class TwilioGateway:
+    def __init__(self):
+        from twilio.http.http_client import TwilioHttpClient
+        from twilio.rest import Client
+
+        # Find your Account SID and Auth Token at https://twilio.com/console
+        # and set the environment variables. See http://twil.io/secure
+        self.client = Client(
+            settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN,
+            http_client=TwilioHttpClient(pool_connections=True, timeout=getattr(settings, 'GATEWAY_TIMEOUT', 10), max_retries=2),
+        )
+        # The clients of the async methods, per event loop (see _aiohttp_client)
+        self.asyncClients = weakref.WeakKeyDictionary()
+
+    # Twilio's client on aiohttp, for the running event loop
+    def _async_client(self):
+        from twilio.http.async_http_client import AsyncTwilioHttpClient
+        from twilio.rest import Client
+
+        loop = asyncio.get_running_loop()
+        client = self.asyncClients.get(loop)
+        if client is None:
+            client = self.asyncClients[loop] = Client(
+                settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN,
+                http_client=AsyncTwilioHttpClient(pool_connections=True, timeout=getattr(settings, 'GATEWAY_TIMEOUT', 10), max_retries=2),
+            )
+        return client
+
+    def _call(self, fn, **params):
+        from twilio.base.exceptions import TwilioRestException
+
+        try:
+            return fn(**params)
+        except TwilioRestException as e:
+            raise MessagingError(e.msg, e.code)
+
+    async def _acall(self, fn, **params):
+        from twilio.base.exceptions import TwilioRestException
+
+        try:
+            return await fn(**params)
+        except TwilioRestException as e:
+            raise MessagingError(e.msg, e.code)
+
+    def send_sms(self, to, body):
+        return self._call(self.client.messages.create, messaging_service_sid=_required('TWILIO_MESSAGING_SERVICE_SID'), to=to, body=body)
+
+    async def asend_sms(self, to, body):
+        return await self._acall(
+            self._async_client().messages.create_async,
+            messaging_service_sid=_required('TWILIO_MESSAGING_SERVICE_SID'), to=to, body=body,
+        )
+
+
+# The Stripe-Signature header of a webhook payload (see https://stripe.com/docs/webhooks/signatures)
+def sign_webhook(payload, secret, timestamp=None):
+    timestamp = int(timestamp or time.time())
+    signature = hmac.new(secret.encode(), f'{timestamp}.{payload}'.encode(), hashlib.sha256).hexdigest()
+    return f't={timestamp},v1={signature}'
+
+
+# Answers like Stripe, without calling it: sessions and accounts are made up, and the webhook
+# requests are verified against STRIPE_WEBHOOK_SECRET (e.g. signed by the generate_stripe_events command).
+# The calls take GATEWAY_FAKE_LATENCY seconds, as Stripe would (load tests)
+class FakePaymentsGateway:
+    def _latency(self):
+        return getattr(settings, 'GATEWAY_FAKE_LATENCY', 0)
+
+    def create_checkout_session(self, idempotencyKey=None, **params):
+        time.sleep(self._latency())
+        sessionId = f'cs_fake_{uuid.uuid4().hex}'
+        return SimpleNamespace(id=sessionId, url=f'https://checkout.stripe.com/c/pay/{sessionId}', params=params)
+
+    async def acreate_checkout_session(self, idempotencyKey=None, **params):
+        await asyncio.sleep(self._latency())
+        sessionId = f'cs_fake_{uuid.uuid4().hex}'
+        return SimpleNamespace(id=sessionId, url=f'https://checkout.stripe.com/c/pay/{sessionId}', params=params)
+
+    def construct_event(self, payload, signature):
+        payload = payload.decode() if isinstance(payload, bytes) else payload
+        try:
+            timestamp = dict(part.split('=', 1) for part in signature.split(','))['t']
+        except (KeyError, ValueError):
+            raise InvalidWebhook('Invalid Stripe-Signature header')
+        if not hmac.compare_digest(sign_webhook(payload, settings.STRIPE_WEBHOOK_SECRET or '', timestamp), signature):
+            raise InvalidWebhook('No signature matching the payload')
+        try:
+            return json.loads(payload)
+        except ValueError as e:
+            raise InvalidWebhook(str(e))
+
+    def retrieve_event(self, eventId):
+        raise LookupError(f'No such event: {eventId}')
+
+    def create_account(self, email):
+        time.sleep(self._latency())
+        return SimpleNamespace(id=f'acct_fake_{uuid.uuid4().hex[:16]}', email=email)
+
+    async def acreate_account(self, email):
+        await asyncio.sleep(self._latency())
+        return SimpleNamespace(id=f'acct_fake_{uuid.uuid4().hex[:16]}', email=email)
+
+    def retrieve_account(self, accountId):
+        time.sleep(self._latency())
+        return SimpleNamespace(id=accountId, details_submitted=True, charges_enabled=True)
+
+    async def aretrieve_account(self, accountId):
+        await asyncio.sleep(self._latency())
+        return SimpleNamespace(id=accountId, details_submitted=True, charges_enabled=True)
+
+    def create_account_link(self, accountId):
+        time.sleep(self._latency())
+        return f'https://connect.stripe.com/setup/fake/{accountId}'
+
+    async def acreate_account_link(self, accountId):
+        await asyncio.sleep(self._latency())
+        return f'https://connect.stripe.com/setup/fake/{accountId}'
+
+
+# Keeps the text SMS in memory
+class FakeMessagingGateway:
+    def __init__(self):
+        # The messages sent, as (to, body)
+        self.outbox = []
+        self.lock = threading.Lock()
+
+    def send_sms(self, to, body):
+        with self.lock:
+            self.outbox.append((to, body))
+        return SimpleNamespace(status='accepted')
+
+    async def asend_sms(self, to, body):
+        return self.send_sms(to, body)
+
+
+_gateways = {}
+_gatewaysLock = threading.Lock()
+
+
+def _get(path):
+    gateway = _gateways.get(path)
+    if gateway is None:
+        with _gatewaysLock:
+            gateway = _gateways.get(path)
+            if gateway is None:
+                gateway = _gateways[path] = import_string(path)()
+    return gateway
+
+
+def payments():
+    return _get(getattr(settings, 'PAYMENTS_GATEWAY', 'crud.gateways.StripeGateway'))
+
+
+def messaging():
+    return _get(getattr(settings, 'MESSAGING_GATEWAY', 'crud.gateways.TwilioGateway'))
@@ -0,0 +1,188 @@
+import logging
+import os
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings as django_settings
+from django.http import JsonResponse
+from whitenoise.middleware import WhiteNoiseMiddleware
+from whitenoise.responders import IsDirectoryError, MissingFileError
+from whitenoise.string_utils import ensure_leading_trailing_slash
+
+from Categories.menu_export import HASHED_NAME_REGEX
+from crud import querybudget, ratelimit
+from crud.storage import CONTENT_ADDRESSED_NAME_REGEX
+
+logger = logging.getLogger(__name__)
+
+
+# WhiteNoise, also serving the static menu export (see Categories/menu_export.py) under MENU_EXPORT_URL
+# and the uploaded media (see crud/storage.py) under MEDIA_URL, with ETag/Last-Modified validators,
+# conditional and Range requests handled before the request reaches Django.
+#
+# WhiteNoise only indexes its directories at startup, while the menu files and uploads are written
+# at runtime. Files under these prefixes which are not indexed yet are therefore looked up on disk
+# when first requested; content-hashed ones are remembered (they never change) and served with
+# far-future, immutable cache headers. Once deployed, the uploads are best served by a CDN pulling
+# them from here (see MEDIA_CDN_URL), which then only asks for each file once.
+#
+# Both sync and async: under ASGI a sync middleware would run the async views (e.g. the event
+# streams, see crud/events.py) in a thread.
+class CatalogWhiteNoiseMiddleware(WhiteNoiseMiddleware):
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, settings=django_settings):
+        # Set before WhiteNoise indexes STATIC_ROOT, as immutable_file_test() needs it
+        self.menu_prefix = ensure_leading_trailing_slash(settings.MENU_EXPORT_URL)
+        self.menu_root = os.path.abspath(settings.MENU_EXPORT_ROOT).rstrip(os.path.sep) + os.path.sep
+        self.media_prefix = ensure_leading_trailing_slash(settings.MEDIA_URL)
+        self.media_root = os.path.abspath(settings.MEDIA_ROOT).rstrip(os.path.sep) + os.path.sep
+        self.lazy_directories = [(self.menu_root, self.menu_prefix), (self.media_root, self.media_prefix)]
+
+        super().__init__(get_response, settings=settings)
+        # Where a file may be found on disk (the static directories are only listed with autorefresh)
+        self.disk_prefixes = (
+            *(prefix for root, prefix in self.directories), self.static_prefix, self.menu_prefix, self.media_prefix,
+        )
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        static_file = self.find_static_file(request.path_info)
+        if static_file is not None:
+            return self.serve(static_file, request)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        url = request.path_info
+        if self.reads_disk(url):
+            static_file = await sync_to_async(self.find_static_file, thread_sensitive=False)(url)
+        else:
+            static_file = self.files.get(url)
+        if static_file is not None:
+            return self.serve(static_file, request)
+        return await self.get_response(request)
+
+    # Whether looking up the file of the URL reads the disk (done in a thread under ASGI): the files
+    # not indexed yet under the lazy prefixes, and any static file with autorefresh. The other
+    # requests (the API) don't leave the event loop
+    def reads_disk(self, url):
+        if self.autorefresh:
+            return url.startswith(self.disk_prefixes)
+        return url not in self.files and url.startswith((self.menu_prefix, self.media_prefix))
+
+    def find_static_file(self, url):
+        if self.autorefresh:
+            static_file = self.find_file(url)
+        else:
+            static_file = self.files.get(url)
+        if static_file is None:
+            static_file = self.find_lazy_file(url)
+        return static_file
+
+    def find_lazy_file(self, url):
+        for root, prefix in self.lazy_directories:
+            if not url.startswith(prefix) or not self.url_is_canonical(url):
+                continue
+            path = os.path.join(root, url[len(prefix):])
+            if os.path.commonprefix((root, path)) != root or self.is_compressed_variant(path):
+                return None
+            try:
+                static_file = self.get_static_file(path, url)
+            except (MissingFileError, IsDirectoryError):
+                return None
+            if self.immutable_file_test(path, url):
+                self.files[url] = static_file
+            return static_file
+        return None
+
+    def immutable_file_test(self, path, url):
+        if url.startswith(self.menu_prefix):
+            return bool(HASHED_NAME_REGEX.search(url))
+        if url.startswith(self.media_prefix):
+            return bool(CONTENT_ADDRESSED_NAME_REGEX.search(url))
+        return super().immutable_file_test(path, url)
+
+
+# Records the queries of each request (see crud/querybudget.py): the totals per view are kept
+# in-process, and requests running more than QUERY_BUDGET_WARNING queries are logged with their
+# duplicate queries. With QUERY_BUDGET_HEADERS (DEBUG by default) the response also gets
+#   X-DB-Queries     number of queries
+#   X-DB-Time        time spent in the database, in ms
+#   X-DB-Duplicates  number of queries repeating an earlier one (with other parameters)
+# For streaming responses, only the queries run before the response is returned are recorded.
+class QueryBudgetMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.headers = getattr(django_settings, 'QUERY_BUDGET_HEADERS', django_settings.DEBUG)
+        self.warning = getattr(django_settings, 'QUERY_BUDGET_WARNING', 20)
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with querybudget.record_queries() as recorder:
+            response = self.get_response(request)
+        return self.process_recorder(request, response, recorder)
+
+    async def __acall__(self, request):
+        async with querybudget.arecord_queries() as recorder:
+            response = await self.get_response(request)
+        return self.process_recorder(request, response, recorder)
+
+    def process_recorder(self, request, response, recorder):
+        match = getattr(request, 'resolver_match', None)
+        viewName = match.view_name if match else request.path_info
+        querybudget.record_view(viewName, recorder)
+        if recorder.count > self.warning:
+            logger.warning('%s %s ran %s', request.method, viewName, recorder.summary())
+
+        if self.headers:
+            response['X-DB-Queries'] = str(recorder.count)
+            response['X-DB-Time'] = f'{recorder.time * 1000:.1f}'
+            response['X-DB-Duplicates'] = str(sum(count - 1 for count in recorder.duplicates.values()))
+        return response
+
+
+# Sheds load before the requests reach the views (see crud/ratelimit.py): once the process has too
+# many requests in flight, those of the lower lanes are answered with a 503 and a Retry-After header,
+# so that checkout and the webhooks go on. For streaming responses, a request is in flight until the
+# response is returned.
+class LoadSheddingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.shedder = ratelimit.get_shedder()
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def shed_response(self):
+        response = JsonResponse(['Server busy. Try again in a moment ⚠️'], safe=False, status=503)
+        response['Retry-After'] = str(getattr(django_settings, 'RATELIMIT_SHED_RETRY_AFTER', 5))
+        return response
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.shedder.admit(ratelimit.get_lane(request.path_info)):
+            return self.shed_response()
+        try:
+            return self.get_response(request)
+        finally:
+            self.shedder.release()
+
+    async def __acall__(self, request):
+        if not self.shedder.admit(ratelimit.get_lane(request.path_info)):
+            return self.shed_response()
+        try:
+            return await self.get_response(request)
+        finally:
+            self.shedder.release()
@@ -0,0 +1,119 @@
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import ExitStack, asynccontextmanager, contextmanager
+
+from asgiref.sync import sync_to_async
+from django.db import connections
+
+
+# Query instrumentation. Records the queries run while handling a request (see
+# QueryBudgetMiddleware in crud/middleware.py) or inside a test (see QueryBudgetMixin):
+#   - the number of queries and the time spent in the database
+#   - the fingerprint of each query (its SQL without the parameters), so that the same query run
+#     again and again with different parameters, i.e. an N+1 pattern, shows up as a duplicate
+
+# "IN (%s, %s, %s)" has as many placeholders as values
+_IN_LIST_REGEX = re.compile(r'\((?:\s*%s\s*,)*\s*%s\s*\)')
+_WHITESPACE_REGEX = re.compile(r'\s+')
+
+# Per view totals of this process
+_stats = {}
+_statsLock = threading.Lock()
+
+
+def fingerprint(sql):
+    return _WHITESPACE_REGEX.sub(' ', _IN_LIST_REGEX.sub('(...)', sql)).strip()
+
+
+# Database execute wrapper, see https://docs.djangoproject.com/en/5.1/topics/db/instrumentation/
+class QueryRecorder:
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.queries = []
+        self.fingerprints = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.time += time.perf_counter() - start
+            self.queries.append(sql)
+            self.fingerprints[fingerprint(sql)] += 1
+
+    # Fingerprints of the queries run more than once, with their number of runs
+    @property
+    def duplicates(self):
+        return {sql: count for sql, count in self.fingerprints.items() if count > 1}
+
+    def summary(self):
+        lines = [f'{self.count} queries in {self.time * 1000:.1f}ms']
+        lines += [f'  {count}x {sql}' for sql, count in self.duplicates.items()]
+        return '\n'.join(lines)
+
+
+# To record the queries run by the current thread, on every database connection
+@contextmanager
+def record_queries():
+    recorder = QueryRecorder()
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(recorder))
+        yield recorder
+
+
+# record_queries() for async code. The connections are per thread, and the queries run in the thread
+# of sync_to_async (the same one for the whole request under ASGI), so the recording is started and
+# stopped in that thread
+@asynccontextmanager
+async def arecord_queries():
+    stack = ExitStack()
+    recorder = await sync_to_async(stack.enter_context)(record_queries())
+    try:
+        yield recorder
+    finally:
+        await sync_to_async(stack.close)()
+
+
+def record_view(viewName, recorder):
+    with _statsLock:
+        stats = _stats.setdefault(viewName, {'requests': 0, 'queries': 0, 'maxQueries': 0, 'time': 0.0, 'duplicates': 0})
+        stats['requests'] += 1
+        stats['queries'] += recorder.count
+        stats['maxQueries'] = max(stats['maxQueries'], recorder.count)
+        stats['time'] += recorder.time
+        stats['duplicates'] += sum(count - 1 for count in recorder.duplicates.values())
+
+
+# Requests, queries and DB time (in seconds) of each view, for the current process
+def get_stats():
+    with _statsLock:
+        return {viewName: dict(stats) for viewName, stats in _stats.items()}
+
+
+def reset_stats():
+    with _statsLock:
+        _stats.clear()
+
+
+# For TestCase classes: fails the test if the block runs more queries than the budget.
+# As TestCase runs each test in a transaction, transaction.atomic() blocks count 2 more queries
+# (SAVEPOINT and RELEASE SAVEPOINT)
+#
+#     with self.assertQueryBudget(4):
+#         self.client.get('/api/get-cart-items/')
+class QueryBudgetMixin:
+    @contextmanager
+    def assertQueryBudget(self, budget):
+        with record_queries() as recorder:
+            yield recorder
+        if recorder.count > budget:
+            self.fail(
+                f'Query budget exceeded: {recorder.count} queries, the budget is {budget}\n'
+                + recorder.summary() + '\n'
+                + '\n'.join(f'{number}. {fingerprint(sql)}' for number, sql in enumerate(recorder.queries[:50], 1))
+            )
@@ -0,0 +1,227 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+from rest_framework.throttling import BaseThrottle
+
+
+# Rate limiting of the authentication and SMS endpoints, and load shedding.
+#
+# Each limit is a token bucket: RATELIMIT_RATES[scope] = 'N/period' (period: s, min, hour or day)
+# allows bursts of N requests, and refills N per period. A scope is '<name>.<key>', the key telling
+# whose bucket a request takes from:
+#   ip      the client's address (behind NUM_PROXIES proxies, see DRF's throttling)
+#   user    the authenticated user, or the username posted (e.g. to the token view)
+#   number  the mobile number posted
+# The views opt in with @throttle_classes(ratelimit.throttles('login', 'ip', 'number')), the async
+# views with @asyncviews.api_view(..., throttles=...) (see crud/asyncviews.py). A throttled request
+# gets a 429 with a Retry-After header, before the view runs (no password hashed, no SMS sent).
+#
+# The buckets are kept by RATELIMIT_BACKEND:
+#   - LocalBackend: in the memory of the process, exact but per process (the limits are multiplied
+#     by the number of processes)
+#   - CacheBackend: in the RATELIMIT_CACHE_ALIAS cache, shared by the processes when the cache is (the
+#     database once deployed, see crud/deployment_settings.py). Not atomic: requests of the same bucket
+#     racing in different processes can take the same token, a burst may get a few requests more
+#
+# The load shedding (see LoadSheddingMiddleware in crud/middleware.py) refuses the requests of a
+# lane with a 503 once the process has that many requests in flight: the low lane (authentication
+# and SMS) at RATELIMIT_SHED_AT['low'] * RATELIMIT_MAX_IN_FLIGHT, the normal lane (everything else)
+# at RATELIMIT_SHED_AT['normal'] * ..., and the high lane (checkout and webhooks) only at
+# RATELIMIT_MAX_IN_FLIGHT. The lanes are matched by path prefix, RATELIMIT_PRIORITY_PATHS.
+
+LOW = 'low'
+NORMAL = 'normal'
+HIGH = 'high'
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+# Throttled requests per scope and shed requests per lane, in this process
+_stats = {'throttled': {}, 'shed': {}}
+_statsLock = threading.Lock()
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _count(counter, name):
+    with _statsLock:
+        _stats[counter][name] = _stats[counter].get(name, 0) + 1
+
+
+# 'N/period' to (capacity, seconds to refill it), e.g. '10/min' to (10, 60)
+def parse_rate(rate):
+    number, period = rate.split('/')
+    return int(number), PERIODS[period[0]]
+
+
+# To take a token from the bucket (tokens, updated) at `now`. Returns the new bucket and the seconds
+# to wait for a token (0 if one was taken)
+def _take(bucket, now, capacity, period):
+    refill = capacity / period
+    tokens, updated = bucket if bucket is not None else (capacity, now)
+    tokens = min(capacity, tokens + max(now - updated, 0) * refill)
+    if tokens >= 1:
+        return (tokens - 1, now), 0
+    return (tokens, now), (1 - tokens) / refill
+
+
+class LocalBackend:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # {key: (tokens, updated)}, least recently used first
+        self.buckets = OrderedDict()
+
+    def take(self, key, capacity, period):
+        with self.lock:
+            self.buckets[key], wait = _take(self.buckets.get(key), time.monotonic(), capacity, period)
+            self.buckets.move_to_end(key)
+            # A bucket dropped is full again, as it would be after a while
+            while len(self.buckets) > _setting('RATELIMIT_LOCAL_MAX_KEYS', 100000):
+                self.buckets.popitem(last=False)
+        return wait
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+
+class CacheBackend:
+    def __init__(self):
+        self.cache = caches[_setting('RATELIMIT_CACHE_ALIAS', 'ratelimit')]
+
+    def take(self, key, capacity, period):
+        bucket, wait = _take(self.cache.get(key), time.time(), capacity, period)
+        # Full again after a period, the bucket can go
+        self.cache.set(key, bucket, timeout=period)
+        return wait
+
+    # Clears the whole RATELIMIT_CACHE_ALIAS cache
+    def clear(self):
+        self.cache.clear()
+
+
+_backend = None
+_backendLock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backendLock:
+            if _backend is None:
+                _backend = import_string(_setting('RATELIMIT_BACKEND', 'crud.ratelimit.LocalBackend'))()
+    return _backend
+
+
+# A DRF throttle taking a token from the bucket of the request in its scope (see above). Requests
+# without a key (e.g. no number posted) and scopes without a rate aren't limited
+class BucketThrottle(BaseThrottle):
+    scope = None
+
+    def get_key(self, request):
+        raise NotImplementedError
+
+    def allow_request(self, request, view):
+        self.waitSeconds = None
+        rate = _setting('RATELIMIT_RATES', {}).get(self.scope)
+        if not _setting('RATELIMIT_ENABLED', True) or rate is None:
+            return True
+        key = self.get_key(request)
+        if not key:
+            return True
+
+        capacity, period = parse_rate(rate)
+        digest = hashlib.blake2b(str(key).encode(), digest_size=12).hexdigest()
+        wait = get_backend().take(f'ratelimit:{self.scope}:{digest}', capacity, period)
+        if wait:
+            self.waitSeconds = wait
+            _count('throttled', self.scope)
+            return False
+        return True
+
+    def wait(self):
+        return self.waitSeconds
+
+
+class IPThrottle(BucketThrottle):
+    def get_key(self, request):
+        return self.get_ident(request)
+
+
+class UserThrottle(BucketThrottle):
+    def get_key(self, request):
+        if request.user and request.user.is_authenticated:
+            return f'id:{request.user.id}'
+        username = request.data.get('username') if hasattr(request.data, 'get') else None
+        return f'username:{username}' if username else None
+
+
+class NumberThrottle(BucketThrottle):
+    def get_key(self, request):
+        number = request.data.get('number') if hasattr(request.data, 'get') else None
+        # '+919876543210' and '919876543210' are the same number
+        return str(number).strip().lstrip('+') if number else None
+
+
+THROTTLES = {'ip': IPThrottle, 'user': UserThrottle, 'number': NumberThrottle}
+
+
+# The throttle classes of the scopes '<name>.<key>' of the given keys, e.g. throttles('login', 'ip', 'user')
+def throttles(name, *keys):
+    return [
+        type(f'{THROTTLES[key].__name__}_{name}', (THROTTLES[key],), {'scope': f'{name}.{key}'})
+        for key in keys
+    ]
+
+
+# The lane of a request path
+def get_lane(path):
+    for lane in (HIGH, LOW):
+        if path.startswith(tuple(_setting('RATELIMIT_PRIORITY_PATHS', {}).get(lane, ()))):
+            return lane
+    return NORMAL
+
+
+# Requests in flight in this process, admitted or shed by lane
+class Shedder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inFlight = 0
+
+    # Whether a request of the lane is admitted. An admitted request must be released
+    def admit(self, lane):
+        maxInFlight = _setting('RATELIMIT_MAX_IN_FLIGHT', 0)
+        with self.lock:
+            if maxInFlight and self.inFlight >= maxInFlight * _setting('RATELIMIT_SHED_AT', {}).get(lane, 1):
+                shed = True
+            else:
+                shed = False
+                self.inFlight += 1
+        if shed:
+            _count('shed', lane)
+        return not shed
+
+    def release(self):
+        with self.lock:
+            self.inFlight -= 1
+
+
+_shedder = Shedder()
+
+
+# The load shedder of this process
+def get_shedder():
+    return _shedder
+
+
+def get_stats():
+    with _statsLock:
+        stats = {counter: dict(counts) for counter, counts in _stats.items()}
+    stats['inFlight'] = _shedder.inFlight
+    return stats
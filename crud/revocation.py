@@ -0,0 +1,199 @@
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.utils import aware_utcnow
+
+
+# Revoked (blacklisted) refresh tokens.
+#
+# Every refresh blacklists the refresh token it rotates, so the blacklist grows with each refresh of
+# each client. Two things keep it cheap:
+#   - prune_tokens() deletes the expired outstanding tokens (and their blacklisted rows, an expired
+#     token is refused anyway), in batches of TOKEN_PRUNE_BATCH_SIZE, see the prune_tokens command
+#   - checking a refresh token doesn't query the blacklist: each process keeps a RevocationFilter of
+#     the revoked token ids (jti): a Bloom filter, which answers "not revoked" for certain, and a
+#     LRU of the recently revoked ids and of those the database was asked about (when the Bloom
+#     filter answers "maybe revoked")
+#
+# The filter of a process learns the tokens revoked by the other processes by reading the rows
+# blacklisted since its last sync, at most every TOKEN_REVOCATION_SYNC_INTERVAL seconds (with a
+# TOKEN_REVOCATION_SYNC_OVERLAP seconds overlap, for the transactions committed late). It can be
+# that many seconds behind: a rotated token is still refused, as the refresh blacklists it with an
+# insert, which fails if another process already did (see tokens.RefreshToken.blacklist).
+#
+# The filter is rebuilt from the unexpired rows every TOKEN_REVOCATION_REBUILD_INTERVAL seconds
+# (the expired ids don't have to be kept), or once it holds more than TOKEN_REVOCATION_CAPACITY ids.
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+class BloomFilter:
+    def __init__(self, capacity, errorRate):
+        # Bits and hashes for the error rate at capacity (see https://en.wikipedia.org/wiki/Bloom_filter)
+        self.size = max(int(-capacity * math.log(errorRate) / math.log(2) ** 2), 8)
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    # Double hashing: the positions are h1 + i * h2, of a single 128-bit digest
+    def _positions(self, value):
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+
+class RevocationFilter:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Held by the thread syncing, the others go on with the filter as it is
+        self.syncLock = threading.Lock()
+        self.bloom = None
+        # {jti: revoked} of the ids revoked lately and of the database lookups, least recently used first
+        self.recent = OrderedDict()
+        self.syncedAt = None
+        self.syncedMonotonic = 0
+        self.builtMonotonic = 0
+        # Checks answered by the filter alone and by the database, syncs and rebuilds
+        self.stats = {'filtered': 0, 'lookups': 0, 'syncs': 0, 'rebuilds': 0}
+
+    def _count(self, counter):
+        with self.lock:
+            self.stats[counter] += 1
+
+    # To load the revoked ids: all the unexpired ones (rebuild) or those blacklisted since the last sync
+    def sync(self, rebuild=False):
+        # blacklisted_at is in local time, expires_at in UTC (as set by simplejwt)
+        now = timezone.now()
+        if rebuild or self.bloom is None:
+            bloom = BloomFilter(_setting('TOKEN_REVOCATION_CAPACITY', 1000000), _setting('TOKEN_REVOCATION_ERROR_RATE', 0.01))
+            revoked = BlacklistedToken.objects.filter(token__expires_at__gt=aware_utcnow())
+            # Filled before being swapped in, the checks go on meanwhile
+            for jti in revoked.values_list('token__jti', flat=True).iterator(chunk_size=10000):
+                bloom.add(jti)
+            with self.lock:
+                self.bloom = bloom
+                self.recent.clear()
+                self.builtMonotonic = time.monotonic()
+                self.stats['rebuilds'] += 1
+        else:
+            since = self.syncedAt - timedelta(seconds=_setting('TOKEN_REVOCATION_SYNC_OVERLAP', 10))
+            jtis = list(BlacklistedToken.objects.filter(blacklisted_at__gte=since).values_list('token__jti', flat=True))
+            with self.lock:
+                for jti in jtis:
+                    self._add(jti)
+        with self.lock:
+            self.syncedAt = now
+            self.syncedMonotonic = time.monotonic()
+            self.stats['syncs'] += 1
+
+    def _sync_if_due(self):
+        if self.bloom is None:
+            # The first check of the process waits for the filter
+            with self.syncLock:
+                if self.bloom is None:
+                    self.sync()
+            return
+        rebuild = (
+            time.monotonic() - self.builtMonotonic >= _setting('TOKEN_REVOCATION_REBUILD_INTERVAL', 3600)
+            or self.bloom.count > _setting('TOKEN_REVOCATION_CAPACITY', 1000000)
+        )
+        if not rebuild and time.monotonic() - self.syncedMonotonic < _setting('TOKEN_REVOCATION_SYNC_INTERVAL', 5):
+            return
+        if self.syncLock.acquire(blocking=False):
+            try:
+                self.sync(rebuild=rebuild)
+            finally:
+                self.syncLock.release()
+
+    # Called with the lock held
+    def _remember(self, jti, revoked):
+        self.recent[jti] = revoked
+        self.recent.move_to_end(jti)
+        while len(self.recent) > _setting('TOKEN_REVOCATION_LRU_SIZE', 10000):
+            self.recent.popitem(last=False)
+
+    # Called with the lock held
+    def _add(self, jti):
+        self.bloom.add(jti)
+        self._remember(jti, True)
+
+    # To add a token revoked by this process
+    def add(self, jti):
+        with self.lock:
+            if self.bloom is not None:
+                self._add(jti)
+
+    # Whether the token is revoked, as of the last sync
+    def is_revoked(self, jti):
+        self._sync_if_due()
+        if jti not in self.bloom:
+            self._count('filtered')
+            return False
+
+        with self.lock:
+            revoked = self.recent.get(jti)
+            if revoked is not None:
+                self.recent.move_to_end(jti)
+                return revoked
+            self.stats['lookups'] += 1
+        revoked = BlacklistedToken.objects.filter(token__jti=jti).exists()
+        with self.lock:
+            # A revocation synced meanwhile isn't overwritten
+            self._remember(jti, self.recent.get(jti) or revoked)
+        return revoked
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['revoked'] = self.bloom.count if self.bloom is not None else None
+        return stats
+
+
+_filter = RevocationFilter()
+
+
+# The revocation filter of this process
+def get_filter():
+    return _filter
+
+
+# To delete the outstanding tokens expired for at least `graceSeconds` seconds, with their blacklisted
+# rows, batchSize at a time (each batch in its own transaction), until none are left (or maxBatches
+# batches). Returns the number of outstanding tokens deleted
+def prune_tokens(batchSize=None, maxBatches=None, graceSeconds=None):
+    batchSize = batchSize or _setting('TOKEN_PRUNE_BATCH_SIZE', 1000)
+    grace = graceSeconds if graceSeconds is not None else _setting('TOKEN_PRUNE_GRACE', 3600)
+    before = aware_utcnow() - timedelta(seconds=grace)
+    deleted = batches = 0
+    while maxBatches is None or batches < maxBatches:
+        with transaction.atomic():
+            # In id order: expires_at isn't indexed, and the expired tokens are the oldest ones
+            ids = list(
+                OutstandingToken.objects.filter(expires_at__lt=before)
+                .order_by('id').values_list('id', flat=True)[:batchSize]
+            )
+            if not ids:
+                break
+            BlacklistedToken.objects.filter(token_id__in=ids).delete()
+            OutstandingToken.objects.filter(id__in=ids).delete()
+        deleted += len(ids)
+        batches += 1
+    return deleted
@@ -48,6 +48,118 @@ REST_FRAMEWORK = {
     )
 }
 
+# Token bucket rate limits of the authentication and SMS endpoints, 'N/period' per scope (see
+# crud/ratelimit.py). RATELIMIT_BACKEND is crud.ratelimit.LocalBackend (per process) or
+# crud.ratelimit.CacheBackend (in the RATELIMIT_CACHE_ALIAS cache: local memory here, the database
+# once deployed, shared by the workers, see crud/deployment_settings.py)
+RATELIMIT_ENABLED = os.getenv('RATELIMIT_ENABLED', 'True') == 'True'
+RATELIMIT_BACKEND = os.getenv('RATELIMIT_BACKEND', 'crud.ratelimit.LocalBackend')
+RATELIMIT_CACHE_ALIAS = 'ratelimit'
+RATELIMIT_RATES = {
+    'login.ip': '30/min',
+    'login.user': '10/min',
+    'login.number': '10/min',
+    'refresh.ip': '60/min',
+    'register.ip': '20/hour',
+    'sms.ip': '20/hour',
+    'sms.number': '5/hour',
+    'verify.ip': '30/min',
+    'verify.number': '10/min',
+}
+# Requests in flight per process from which the low and normal lanes are shed (a fraction of
+# RATELIMIT_MAX_IN_FLIGHT), the high lane at RATELIMIT_MAX_IN_FLIGHT. 0 to never shed. Under ASGI, the
+# async views waiting on Stripe are in flight by the hundreds
+RATELIMIT_MAX_IN_FLIGHT = int(os.getenv('RATELIMIT_MAX_IN_FLIGHT', 1000))
+RATELIMIT_SHED_AT = {'low': 0.5, 'normal': 0.8}
+RATELIMIT_SHED_RETRY_AFTER = 5
+RATELIMIT_PRIORITY_PATHS = {
+    'high': ('/api/checkout/', '/api/webhook/'),
+    'low': (
+        '/api/register/', '/api/mobile-send-message/', '/api/mobile-verification/', '/api/token/',
+        '/api/custom-login/', '/partner-with-us/register/', '/partner-with-us/api/token/',
+    ),
+}
+
+# Keyset pagination of the list endpoints (see Categories/api/pagination.py)
+PAGINATION_DEFAULT_PAGE_SIZE = 20
+PAGINATION_MAX_PAGE_SIZE = 100
+
+# How far back (in seconds) the order board looks for changed orders, before the client's last poll
+# (see FromOurKitchen/orders.py)
+ORDER_BOARD_OVERLAP = 5
+
+# Delivered orders older than this (in days) are moved to the archive, by batches of
+# ORDER_ARCHIVE_BATCH_SIZE orders (see FromOurKitchen/archive.py and the archive_orders command)
+ORDER_ARCHIVE_AFTER_DAYS = 90
+ORDER_ARCHIVE_BATCH_SIZE = 500
+
+# Gateways to Stripe and Twilio (see crud/gateways.py). crud.gateways.FakePaymentsGateway and
+# crud.gateways.FakeMessagingGateway run the API without them (offline, load tests)
+PAYMENTS_GATEWAY = os.getenv('PAYMENTS_GATEWAY', 'crud.gateways.StripeGateway')
+MESSAGING_GATEWAY = os.getenv('MESSAGING_GATEWAY', 'crud.gateways.TwilioGateway')
+# Seconds before a request to Stripe or Twilio times out, and kept-alive connections per process
+GATEWAY_TIMEOUT = 10
+GATEWAY_POOL_SIZE = 10
+# Connections of the async requests (see the async views) per event loop, i.e. per process under ASGI
+GATEWAY_ASYNC_POOL_SIZE = 500
+# Seconds each call of the fake payments gateway takes (load tests)
+GATEWAY_FAKE_LATENCY = float(os.getenv('GATEWAY_FAKE_LATENCY', 0))
+
+# Credentials of Stripe and Twilio, from the environment
+STRIPE_API_KEY = os.getenv('STRIPE_API_KEY')
+STRIPE_WEBHOOK_SECRET = os.getenv('endpoint_secret')
+TWILIO_ACCOUNT_SID = os.getenv('TWILIO_ACCOUNT_SID')
+TWILIO_AUTH_TOKEN = os.getenv('TWILIO_AUTH_TOKEN')
+# Stripe account the checkout sessions are created on, and Twilio service of the SMS. Required by
+# the gateways (ImproperlyConfigured when creating a session or sending a SMS without them)
+STRIPE_CHECKOUT_ACCOUNT = os.getenv('STRIPE_CHECKOUT_ACCOUNT')
+TWILIO_MESSAGING_SERVICE_SID = os.getenv('TWILIO_MESSAGING_SERVICE_SID')
+# Pages of the frontend the partners are sent back to from the Stripe onboarding
+STRIPE_ONBOARDING_REFRESH_URL = 'https://online-food-delivery-system.vercel.app/partner-with-us/account-setup/refresh-url'
+STRIPE_ONBOARDING_RETURN_URL = 'https://online-food-delivery-system.vercel.app/partner-with-us/account-setup/return-url'
+
+# Text SMS to the customers, sent from the outbox by the send_notifications worker (see
+# FromOurKitchen/notifications.py). FakeProvider only keeps them in memory
+NOTIFICATIONS_PROVIDER = (
+    'FromOurKitchen.notifications.TwilioProvider' if os.getenv('TWILIO_ENABLED', 'False') == 'True'
+    else 'FromOurKitchen.notifications.FakeProvider'
+)
+# Messages claimed per batch, and sent at the same time
+NOTIFICATIONS_BATCH_SIZE = 50
+NOTIFICATIONS_CONCURRENCY = 8
+# A failed message is retried after NOTIFICATIONS_RETRY_DELAY seconds, doubled at each attempt
+NOTIFICATIONS_MAX_ATTEMPTS = 5
+NOTIFICATIONS_RETRY_DELAY = 30
+
+# Seconds a Stripe checkout session stays valid (30 minutes to 24 hours less the idempotency window),
+# and is returned again for the same cart (see FromOurKitchen/checkout.py)
+CHECKOUT_SESSION_TTL = 1800
+
+# One time codes verifying the mobile numbers (see FromOurKitchen/otp.py), sent with the
+# OTP_PROVIDER: Twilio unless set otherwise (FakeProvider drops the codes, a customer would never
+# get one). A code expires after OTP_TTL seconds or OTP_MAX_ATTEMPTS wrong checks. A
+# number is sent a code at most every OTP_RESEND_INTERVAL seconds, and OTP_MAX_SENDS per OTP_SEND_WINDOW
+OTP_PROVIDER = os.getenv('OTP_PROVIDER', 'FromOurKitchen.notifications.TwilioProvider')
+OTP_DIGITS = 6
+OTP_TTL = 600
+OTP_MAX_ATTEMPTS = 5
+OTP_RESEND_INTERVAL = 30
+OTP_MAX_SENDS = 5
+OTP_SEND_WINDOW = 3600
+
+# Stripe webhook events, processed in the background (see FromOurKitchen/stripe_events.py). A failed
+# event is retried after STRIPE_EVENTS_RETRY_DELAY seconds, doubled at each attempt
+STRIPE_EVENTS_MAX_ATTEMPTS = 8
+STRIPE_EVENTS_RETRY_DELAY = 10
+
+# Server-sent events of the orders (see crud/events.py). LocalBackend only reaches the streams of
+# the publishing process
+EVENTS_BACKEND = 'crud.events.LocalBackend'
+# Seconds between two keep-alive comments on an idle stream
+EVENTS_HEARTBEAT = 15
+# Events waiting to be sent to a stream, beyond which the client is asked to resync
+EVENTS_QUEUE_SIZE = 100
+
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=5),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=90), 
@@ -76,11 +188,36 @@ SIMPLE_JWT = {
     'SLIDING_TOKEN_REFRESH_EXP_CLAIM': 'refresh_exp',
     'SLIDING_TOKEN_LIFETIME': timedelta(minutes=5),
     'SLIDING_TOKEN_REFRESH_LIFETIME': timedelta(days=1),
+
+    # Checks the refresh tokens against the revocation filter of the process (see crud/revocation.py)
+    'TOKEN_REFRESH_SERIALIZER': 'crud.tokens.TokenRefreshSerializer',
 }
 
+# Cache of the role claim of the tokens (see crud/tokens.py), and the seconds a role is kept. Use a
+# shared cache (not locmem) for a group change to reach every process at once
+TOKEN_CACHE_ALIAS = 'default'
+TOKEN_ROLE_CACHE_TIMEOUT = int(os.getenv('TOKEN_ROLE_CACHE_TIMEOUT', 300))
+
+# Revoked refresh tokens (see crud/revocation.py). The filter of each process holds up to
+# TOKEN_REVOCATION_CAPACITY token ids (about 1.2MB for 1M ids at a 1% error rate), learns those
+# revoked by the other processes every TOKEN_REVOCATION_SYNC_INTERVAL seconds, and is rebuilt every
+# TOKEN_REVOCATION_REBUILD_INTERVAL seconds
+TOKEN_REVOCATION_CAPACITY = int(os.getenv('TOKEN_REVOCATION_CAPACITY', 1000000))
+TOKEN_REVOCATION_ERROR_RATE = 0.01
+TOKEN_REVOCATION_LRU_SIZE = 10000
+TOKEN_REVOCATION_SYNC_INTERVAL = 5
+TOKEN_REVOCATION_SYNC_OVERLAP = 10
+TOKEN_REVOCATION_REBUILD_INTERVAL = 3600
+# The prune_tokens command deletes the tokens expired for more than TOKEN_PRUNE_GRACE seconds,
+# TOKEN_PRUNE_BATCH_SIZE at a time
+TOKEN_PRUNE_BATCH_SIZE = 1000
+TOKEN_PRUNE_GRACE = 3600
+
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
-    "whitenoise.middleware.WhiteNoiseMiddleware",
+    "crud.middleware.CatalogWhiteNoiseMiddleware",
+    'crud.middleware.LoadSheddingMiddleware',
+    'crud.middleware.QueryBudgetMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -91,6 +228,11 @@ MIDDLEWARE = [
 
 ]
 
+# Requests running more queries than this are logged, with their duplicate queries (see crud/middleware.py)
+QUERY_BUDGET_WARNING = int(os.getenv('QUERY_BUDGET_WARNING', 20))
+# Add the X-DB-Queries, X-DB-Time and X-DB-Duplicates headers to the responses
+QUERY_BUDGET_HEADERS = DEBUG
+
 CORS_ALLOWED_ORIGINS = ["http://localhost:3000","http://localhost:8000","https://online-food-delivery-system.vercel.app"]
 ROOT_URLCONF = 'crud.urls'
 
@@ -134,6 +276,50 @@ else:
         }
     }
 
+
+# Caches
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+
+# Backend of the catalog cache (category list, menus and category info). One of:
+#   locmem - per process local memory (default). An invalidation only reaches the process which saved
+#            the row, the others serve their entries until CATALOG_CACHE_TIMEOUT: for a single process
+#   file   - shared between the processes of a machine, stored in CATALOG_CACHE_LOCATION
+#   db     - shared through the database. Run `python manage.py createcachetable` once
+CATALOG_CACHE_BACKEND = os.getenv('CATALOG_CACHE_BACKEND', 'locmem')
+CATALOG_CACHE_BACKENDS = {
+    'locmem': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'catalog',
+    },
+    'file': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.getenv('CATALOG_CACHE_LOCATION', os.path.join(BASE_DIR, '.cache', 'catalog')),
+    },
+    'db': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'catalog_cache',
+    },
+}
+CATALOG_CACHE_ALIAS = 'catalog'
+# Seconds after which a cached catalog entry expires, even if it was never invalidated
+CATALOG_CACHE_TIMEOUT = int(os.getenv('CATALOG_CACHE_TIMEOUT', 60 * 60))
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    CATALOG_CACHE_ALIAS: CATALOG_CACHE_BACKENDS[CATALOG_CACHE_BACKEND],
+    # The buckets of crud.ratelimit.CacheBackend, on their own as it clears the whole cache
+    RATELIMIT_CACHE_ALIAS: {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'ratelimit',
+    },
+}
+
+# Seconds after which the in-process search index (used when not on Postgres) is rebuilt from the database,
+# to pick up catalog changes made by other processes
+SEARCH_INDEX_MAX_AGE = int(os.getenv('SEARCH_INDEX_MAX_AGE', 300))
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -172,9 +358,42 @@ STATIC_URL = 'static/'
 STATIC_ROOT = os.path.join(BASE_DIR, "staticfiles")
 STATICFILES_STORAGE="whitenoise.storage.CompressedManifestStaticFilesStorage"
 
+# Static, precompressed export of the menu (python manage.py export_menu), served by WhiteNoise
+MENU_EXPORT_URL = '/menu/'
+MENU_EXPORT_ROOT = os.getenv('MENU_EXPORT_ROOT', os.path.join(BASE_DIR, 'menu_export'))
+# Re-export the changed category (and the index) whenever a Category or FoodItem is saved or deleted
+MENU_EXPORT_ON_CHANGE = os.getenv('MENU_EXPORT_ON_CHANGE', 'False') == 'True'
+
+# Widths of the resized copies generated for the uploaded FoodItem/Category images (see Categories/images.py)
+IMAGE_DERIVATIVE_WIDTHS = (320, 640, 1024)
+
+# Threads of the in-process background pools (see crud/background.py)
+BACKGROUND_WORKERS = {
+    'images': 2,
+    'webhooks': 2,
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 MEDIA_URL = '/media/'  # URL to access uploaded media files
-MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
\ No newline at end of file
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+# Public URL of the uploads, e.g. 'https://cdn.example.com/media/' for a CDN pulling them from MEDIA_URL
+# on this app. They never change (see crud/storage.py) and are cached for good, so the workers serve
+# each file once instead of streaming the images of every request. Unset, they're served from MEDIA_URL
+MEDIA_CDN_URL = os.getenv('MEDIA_CDN_URL')
+
+# Uploaded files are named after their content hash (see crud/storage.py) and served by WhiteNoise
+# with immutable cache headers (see crud/middleware.py)
+STORAGES = {
+    'default': {
+        'BACKEND': 'crud.storage.ContentAddressedStorage',
+        'OPTIONS': {'base_url': MEDIA_CDN_URL} if MEDIA_CDN_URL else {},
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+}
+# Directories (of upload_to) in which files are renamed after their content hash
+MEDIA_CONTENT_ADDRESSED_DIRECTORIES = ('images',)
\ No newline at end of file
@@ -0,0 +1,76 @@
+import hashlib
+import os
+import posixpath
+import re
+import uuid
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+
+
+# Media storage naming uploaded files after a hash of their content, e.g. images/Veg_Burger.jpg is
+# stored as images/3f1c...9a2e.jpg.
+#
+# - Uploading the same file twice (e.g. updateFoodItem re-sending an unchanged image) writes nothing,
+#   the existing file is reused.
+# - A stored file never changes, so it is served with immutable, far-future cache headers
+#   (see crud/middleware.py).
+#
+# Only files saved directly in one of MEDIA_CONTENT_ADDRESSED_DIRECTORIES are renamed. Files in
+# other directories, e.g. the resized copies in images/derivatives/ (whose names are already
+# derived from the hashed original), keep the name they are saved with.
+
+HASH_LENGTH = 32
+CONTENT_ADDRESSED_NAME_REGEX = re.compile(r'/[0-9a-f]{%d}(-\d+w)?\.\w+$' % HASH_LENGTH)
+
+
+def content_hash(content):
+    digest = hashlib.sha256()
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    for chunk in content.chunks():
+        digest.update(chunk)
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    return digest.hexdigest()[:HASH_LENGTH]
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    def _is_content_addressed(self, name):
+        directories = getattr(settings, 'MEDIA_CONTENT_ADDRESSED_DIRECTORIES', ('images',))
+        return posixpath.dirname(name.replace('\\', '/')) in directories
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not self._is_content_addressed(name):
+            return super().save(name, content, max_length=max_length)
+
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        directory = posixpath.dirname(name.replace('\\', '/'))
+        extension = os.path.splitext(name)[1].lower()
+        name = posixpath.join(directory, content_hash(content) + extension)
+
+        # Identical content is already stored under this name
+        if self.exists(name):
+            return name
+        return super().save(name, content, max_length=max_length)
+
+    # The name is the content hash, so an existing file with the same name has the same content.
+    # Keep the name instead of letting FileSystemStorage add a random suffix (e.g. two uploads racing)
+    def get_available_name(self, name, max_length=None):
+        if self._is_content_addressed(name):
+            return name
+        return super().get_available_name(name, max_length=max_length)
+
+    # Content addressed files are written under a temporary name, then atomically renamed. A request
+    # storing the same content at the same time just replaces the file with identical bytes, and
+    # readers never see a partially written file.
+    def _save(self, name, content):
+        if not self._is_content_addressed(name):
+            return super()._save(name, content)
+        temporaryName = super()._save(f'{name}.{uuid.uuid4().hex}.tmp', content)
+        os.replace(self.path(temporaryName), self.path(name))
+        return name
@@ -0,0 +1,173 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt import serializers, tokens as jwtTokens
+from rest_framework_simplejwt.authentication import JWTStatelessUserAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.utils import datetime_from_epoch
+
+from crud import revocation
+
+
+# JWT issuance and claims.
+#
+# Every token carries the username and the role of the user, the 'group' claim: 'category' for the
+# partners (members of the Category group), 'None' for the customers. Access tokens live
+# 5 minutes, so they're minted again and again: the role is cached (in the TOKEN_CACHE_ALIAS
+# cache, for TOKEN_ROLE_CACHE_TIMEOUT seconds) instead of being queried on each mint. Adding or
+# removing a user to/from a group invalidates the user's role, renaming or deleting a group those
+# of every user (see FromOurKitchen/signals.py). With a cache local to the process (locmem), the
+# other processes see the change once the entry expires.
+#
+# ClaimsAuthentication authenticates a request with the claims of its access token alone (user id
+# and role), without loading the user. It's opted in by the read-only views which only need the
+# user's id: a user deactivated or deleted keeps access to them until the token expires.
+#
+# Refresh tokens are checked against the revocation filter of the process instead of the blacklist
+# table (see crud/revocation.py). Set as SIMPLE_JWT's TOKEN_REFRESH_SERIALIZER.
+
+CATEGORY_GROUP = 'Category'
+CATEGORY_ROLE = 'category'
+NO_ROLE = 'None'
+
+ROLES_VERSION_KEY = 'tokens:roles:version'
+
+# Hit and miss counters of the role cache in this process
+_stats = {'hits': 0, 'misses': 0}
+_statsLock = threading.Lock()
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _cache():
+    return caches[_setting('TOKEN_CACHE_ALIAS', 'default')]
+
+
+def _count(counter):
+    with _statsLock:
+        _stats[counter] += 1
+
+
+# The roles are stored under a version (bumped when a group changes), as in Categories/cache.py
+def _role_key(userId):
+    cache = _cache()
+    version = cache.get(ROLES_VERSION_KEY)
+    if version is None:
+        cache.add(ROLES_VERSION_KEY, int(time.time() * 1000), timeout=None)
+        version = cache.get(ROLES_VERSION_KEY)
+    return f'tokens:role:{userId}:v{version}'
+
+
+# The role of the user, CATEGORY_ROLE or NO_ROLE
+def get_role(user):
+    key = _role_key(user.id)
+    role = _cache().get(key)
+    if role is not None:
+        _count('hits')
+        return role
+
+    _count('misses')
+    # The group is created as 'Category' (see the partner registration), matched whatever its case
+    isPartner = user.groups.filter(name__iexact=CATEGORY_GROUP).exists()
+    role = CATEGORY_ROLE if isPartner else NO_ROLE
+    _cache().set(key, role, timeout=_setting('TOKEN_ROLE_CACHE_TIMEOUT', 300))
+    return role
+
+
+# To add the custom claims of the user to a token (a refresh token passes them on to its access tokens)
+def add_claims(token, user):
+    token['username'] = user.username
+    token['group'] = get_role(user)
+    # Read by IsAdminUser on the admin routes authenticated with the claims (as TokenUser.is_staff)
+    token['is_staff'] = user.is_staff
+    return token
+
+
+# A refresh token checked against the revocation filter. Blacklisting it fails if it already is
+# (e.g. refreshed by another process meanwhile), so a refresh token is rotated once
+class RefreshToken(jwtTokens.RefreshToken):
+    def check_blacklist(self):
+        if revocation.get_filter().is_revoked(self.payload[api_settings.JTI_CLAIM]):
+            raise TokenError(_('Token is blacklisted'))
+
+    def blacklist(self):
+        jti = self.payload[api_settings.JTI_CLAIM]
+        outstandingToken, created = OutstandingToken.objects.get_or_create(
+            jti=jti,
+            defaults={
+                'user_id': self.payload.get(api_settings.USER_ID_CLAIM),
+                'created_at': self.current_time,
+                'token': str(self),
+                'expires_at': datetime_from_epoch(self.payload['exp']),
+            },
+        )
+        try:
+            with transaction.atomic():
+                blacklisted = BlacklistedToken.objects.create(token=outstandingToken)
+        except IntegrityError:
+            raise TokenError(_('Token is blacklisted'))
+        revocation.get_filter().add(jti)
+        return blacklisted, True
+
+
+class TokenRefreshSerializer(serializers.TokenRefreshSerializer):
+    token_class = RefreshToken
+
+
+# A refresh token of the user, with the custom claims
+def for_user(user):
+    return add_claims(RefreshToken.for_user(user), user)
+
+
+# Invalidation is deferred until the surrounding transaction commits (see Categories/cache.py)
+def invalidate_roles(userIds):
+    keys = [_role_key(userId) for userId in userIds]
+    transaction.on_commit(lambda: _cache().delete_many(keys))
+
+
+def invalidate_all_roles():
+    def bump():
+        try:
+            _cache().incr(ROLES_VERSION_KEY)
+        except ValueError:
+            # No role has been cached yet
+            pass
+    transaction.on_commit(bump)
+
+
+def get_stats():
+    with _statsLock:
+        stats = dict(_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hitRatio'] = round(stats['hits'] / lookups, 4) if lookups else None
+    return stats
+
+
+# The user of a request authenticated by ClaimsAuthentication: its id, username and role, as signed
+# in the access token. Not a User, so querysets are filtered by user_id=request.user.id
+class ClaimsUser(TokenUser):
+    @cached_property
+    def role(self):
+        return self.token.get('group', NO_ROLE)
+
+    @property
+    def is_partner(self):
+        return self.role == CATEGORY_ROLE
+
+
+# To authenticate a request with the claims of its access token, without a query (see above)
+class ClaimsAuthentication(JWTStatelessUserAuthentication):
+    def get_user(self, validated_token):
+        if api_settings.USER_ID_CLAIM not in validated_token:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+        return ClaimsUser(validated_token)
@@ -1,13 +1,9 @@
 from django.contrib import admin
 from django.urls import path, include
 
-from django.conf.urls.static import static
-from django.conf import settings
-
+# Uploaded media is served by WhiteNoise (see crud/middleware.py)
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('FromOurKitchen.api.urls')),
     path('partner-with-us/', include('Categories.api.urls')),
 ]
-
-urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -0,0 +1,29 @@
+import multiprocessing
+import os
+
+# Deployment profile of the web process (see the Procfile): gunicorn managing uvicorn workers, each
+# running the ASGI app (crud/asgi.py) in an event loop. The async views (checkout and the Stripe
+# account views, see crud/asyncviews.py) wait on Stripe in the loop, so a worker has hundreds of
+# them in flight; the sync views run in threads of the worker.
+#
+#     gunicorn crud.asgi:application -c gunicorn.conf.py
+#
+# Tuned with the environment: WEB_CONCURRENCY workers (2 per CPU by default), PORT.
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+worker_class = 'uvicorn.workers.UvicornWorker'
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2))
+
+# Seconds a worker may not answer the arbiter before it's restarted, and to finish its requests on a
+# restart. Longer than GATEWAY_TIMEOUT (with its retries), so a request waiting on Stripe isn't cut
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 60))
+graceful_timeout = 30
+# Kept-alive connections, behind the platform's proxy
+keepalive = 75
+
+# Workers are replaced after that many requests (give or take the jitter, so they don't all restart
+# at once), which bounds the memory of the in-process caches and pools
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 10000))
+max_requests_jitter = 1000
+
+errorlog = '-'